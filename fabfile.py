@@ -106,13 +106,9 @@ def start_supervisord():
             run("supervisord -c ~/supervisord.conf")
 
 def create_index():
-    MONGO_URI = env.get('mongo_db')
-    url = urlparse.urlparse(MONGO_URI)
-    MONGODB_DATABASE = url.path[1:]
-
-    # @TODO: this will likely error on first run as the collection won't exist
-    run('mongo "%s" --eval "db.getCollection(\'stats\').ensureIndex({\'created\':-1})"' % MONGODB_DATABASE)
-    run('mongo "%s" --eval "db.getCollection(\'metadatas\').ensureIndex({\'ref_id\':1, \'ref_type\':1})"' % MONGODB_DATABASE)
+    monitoring()
+    # the indexes are declared on the models, see ioos_catalog.models.indexes
+    run("$HOME/manage.sh ensure_indexes")
 
 def db_snapshot():
     admin()
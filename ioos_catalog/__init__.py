@@ -43,7 +43,15 @@ redis_connection = redis.Redis(connection_pool=redis_pool)
 
 # rq
 from rq import Queue
+# pings have their own lane so they are never starved by long harvests
+ping_queue = Queue('ping', connection=redis_connection)
+# manually triggered and recently failed harvests
+priority_queue = Queue('harvest_priority', connection=redis_connection)
 queue = Queue('default', connection=redis_connection)
+# compliance checker/metamap stage, worked by its own (CPU-bound) workers
+ccheck_queue = Queue('ccheck', connection=redis_connection)
+# harvests of services whose history shows they run long
+long_queue = Queue('long', connection=redis_connection)
 
 # Create the database connection
 from flask.ext.mongokit import MongoKit
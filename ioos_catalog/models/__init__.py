@@ -1,3 +1,4 @@
 from ioos_catalog.models import (service, stat, dataset, metric_counts,
                                  ping_latest, ping_archive, metadata,
-                                 migrations, harvests)
+                                 migrations, harvests, metadata_blob,
+                                 map_feature)
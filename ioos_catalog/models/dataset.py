@@ -36,7 +36,9 @@ class Dataset(BaseDocument):
                 'service_type'      : unicode,    # service type cached here
                 'data_provider'     : unicode,    # service data_prodiver cached here
                 'metadata_type'     : unicode,    # sensorml, ncml, iso, wmsgetcaps
-                'metadata_value'    : unicode,    # value of the metadata (actual xml)
+                'metadata_hash'     : unicode,    # hash of the metadata document (actual xml) in the MetadataBlob store
+                'digest'            : unicode,    # digest of this entry's content, see tasks.harvest.service_entry_digest
+                'active'            : bool,       # service active flag cached here, see tasks.activation
                 'keywords'          : [unicode],  # Search keywords
                 'variables'         : [unicode],  # Environmental properties measured by this dataset
                 'asset_type'        : unicode,    # See the IOOS vocablary for assets: http://mmisw.org/orr/#http://mmisw.org/ont/ioos/platform
@@ -57,6 +59,30 @@ class Dataset(BaseDocument):
         'created': datetime.utcnow
     }
 
+    indexes = [
+        {
+            # harvest lookup of a station's dataset
+            'fields': ['uid']
+        },
+        {
+            # inventory of recent updates
+            'fields': [('updated', -1)]
+        },
+    ]
+
+    # indexes on fields of the services list, which MongoKit can't validate
+    # (see models.indexes)
+    array_indexes = [
+        {
+            # datasets of a service
+            'fields': ['services.service_id']
+        },
+        {
+            # datasets of active services, by provider (see tasks.activation)
+            'fields': ['services.active', 'services.data_provider']
+        },
+    ]
+
     @classmethod
     def count_types(cls):
         # @TODO this doesn't do as expected, see count_types_by_provider instead
@@ -77,10 +103,10 @@ class Dataset(BaseDocument):
             ...
         """
         # intersect with active services only
-        service_ids = [s._id for s in db.Service.find({'active':True}, {'_id':1})]
         counts = db.Dataset.aggregate([
-            { '$match' : {'services.service_id':{'$in':service_ids}}},
+            { '$match' : {'services.active':True}},
             { '$unwind' : '$services' },
+            { '$match' : {'services.active':True}},
             { '$group' : { '_id' : {'asset_type' : '$services.asset_type',
                                     'data_provider' : '$services.data_provider'},
                           'cnt'  : {'$sum':1}}},
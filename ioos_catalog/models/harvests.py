@@ -1,15 +1,19 @@
 #!/usr/bin/env python
 from bson import ObjectId
-from ioos_catalog import app, db
+from ioos_catalog import app, db, redis_connection
 from ioos_catalog.models.base_document import BaseDocument
-from ioos_catalog.tasks.harvest import DapHarvest, SosHarvest, WmsHarvest, WcsHarvest
 from lxml.etree import XMLSyntaxError
-from datetime import datetime
+from datetime import datetime, timedelta
 from traceback import format_exc
-from owslib import ows
 
 import requests
 import socket
+import time
+
+# Redis hash per service of the compliance check and metamap time of its
+# latest harvest run, as <phase>:<seconds|count>. The ccheck jobs mostly
+# finish after the harvest saved its profile, so their time is kept apart.
+CCHECK_PROFILE_KEY = 'ioos_catalog:harvest:ccheck_profile:%s'
 
 @db.register
 class Harvest(BaseDocument):
@@ -17,6 +21,7 @@ class Harvest(BaseDocument):
     Model for a harvest and the reporting of a harvest's status
     '''
     MAX_MESSAGES = 20
+    MAX_DURATIONS = 20
 
     __collection__   = 'harvests'
     use_dot_notation = True
@@ -27,15 +32,41 @@ class Harvest(BaseDocument):
         'harvest_date'       : datetime,
         'harvest_status'     : unicode,
         'harvest_successful' : bool,
+        'harvest_run'        : unicode,   # run id of the sharded run that wrote the status
+        'next_harvest'       : datetime,  # when the scheduler should harvest the service again
         'harvest_messages'   : [ {
             'date'       : datetime,
             'successful' : bool,
             'message'    : unicode
-        } ]
-
+        } ],
+        # recent harvest run times, used to size the harvest job timeout
+        'durations'          : [ {
+            'date'       : datetime,
+            'successful' : bool,
+            'total'      : float,  # seconds
+            'shards'     : int,    # number of parallel jobs the harvest ran as
+            'changed'    : bool,   # did the harvest change any dataset
+            'phases'     : dict    # phase name -> seconds
+        } ],
+        # where the time of the last harvest went
+        'profile'            : {
+            'date'   : datetime,
+            'total'  : float,          # seconds, summed over the shards
+            'shards' : int,
+            'run_id' : unicode,        # sharded run the profile is of
+            'phases' : dict            # phase name -> {seconds, bytes, count, requests, retries}
+        }
     }
 
-    def harvest(self, ignore_active=False):
+    indexes = [
+        {
+            # one document per service, shards upsert it concurrently
+            'fields': ['service_id'],
+            'unique': True,
+        },
+    ]
+
+    def harvest(self, ignore_active=False, shard=None, shards=1):
 
         service_id = self.service_id
 
@@ -60,6 +91,7 @@ class Harvest(BaseDocument):
             return
 
         # ping it first to see if alive
+        ping_start = time.time()
         try:
             _, response_code = service.ping(timeout=60)
             operational_status = True if response_code in [200,400] else False
@@ -71,6 +103,7 @@ class Harvest(BaseDocument):
             self.set_status("Timed Out")
             self.harvest_successful = False
             return
+        ping_seconds = time.time() - ping_start
 
 
         if not operational_status:
@@ -88,22 +121,34 @@ class Harvest(BaseDocument):
             self.harvest_successful = False
             return
 
+        # only the workers import the harvesters
+        from ioos_catalog.tasks.harvest import DapHarvest, SosHarvest, WmsHarvest, WcsHarvest
+        from owslib import ows
+
+        harvester = None
+        start = time.time()
         try:
             message = ''
             if service.service_type == "DAP":
-                message = DapHarvest(service).harvest()
+                harvester = DapHarvest(service)
             elif service.service_type == "SOS":
-                message = SosHarvest(service).harvest()
+                harvester = SosHarvest(service, shard=shard, shards=shards)
             elif service.service_type == "WMS":
-                message = WmsHarvest(service).harvest()
+                harvester = WmsHarvest(service)
             elif service.service_type == "WCS":
-                message = WcsHarvest(service).harvest()
-            self.new_message(message or 'Harvest Successful', True)
+                harvester = WcsHarvest(service)
+            if harvester is not None:
+                message = harvester.harvest()
+            message = message or 'Harvest Successful'
+            if harvester is not None and harvester.harvest_summary():
+                app.logger.info("%s: %s", service_id, harvester.harvest_summary())
+                message = '%s\n%s' % (message, harvester.harvest_summary())
+            self.new_message(message, True)
             self.set_status("Harvest Successful")
             self.harvest_successful = True
             return
 
-        except socket.timeout as e:
+        except (socket.timeout, requests.Timeout) as e:
             app.logger.exception("Failed to harvest service due to timeout")
             self.new_message("Service Timeout: %s" % e.message, False)
             self.set_status("Timed Out")
@@ -148,6 +193,19 @@ class Harvest(BaseDocument):
             self.harvest_successful = False
             return
 
+        finally:
+            if harvester is not None:
+                # also after a failure, for the datasets changed until then
+                try:
+                    harvester.refresh_map()
+                except Exception:
+                    app.logger.exception("Failed refreshing the map features of service %s", service_id)
+                phases = dict(harvester.profile)
+                phases['ping'] = {'seconds': ping_seconds, 'bytes': 0, 'count': 1,
+                                  'requests': 1, 'retries': 0}
+                self.record_profile(time.time() - start, phases, shards,
+                                    harvester.datasets_changed > 0)
+
 
     def new_message(self, message, successful):
         if not isinstance(message, unicode):
@@ -159,6 +217,90 @@ class Harvest(BaseDocument):
 
         self.harvest_messages.insert(0, {'date' : dtg, 'message' : message, 'successful': successful})
 
+    def record_profile(self, total, phases, shards=1, changed=False):
+        dtg = datetime.utcnow()
+
+        self.profile = {'date'   : dtg,
+                        'total'  : float(total),
+                        'shards' : int(shards),
+                        'phases' : phases}
+
+        while len(self.durations) > (self.MAX_DURATIONS-1):
+            self.durations.pop()
+
+        self.durations.insert(0, {'date'       : dtg,
+                                  'successful' : bool(self.harvest_successful),
+                                  'total'      : float(total),
+                                  'shards'     : int(shards),
+                                  'changed'    : bool(changed),
+                                  'phases'     : {k: float(v['seconds']) for k, v in phases.iteritems()}})
+
+    def save_run(self, started, run_id=None):
+        '''
+        Writes the outcome of the harvest run (or shard of a sharded run
+        run_id) started at started, with atomic updates: the shards of a run
+        finish concurrently, and each only adds its messages, durations and
+        profile. A failed shard decides the status of its run.
+        '''
+        query = {'service_id': self.service_id}
+
+        pushes = {}
+        for field, limit in (('harvest_messages', self.MAX_MESSAGES), ('durations', self.MAX_DURATIONS)):
+            new = [e for e in self[field] if e.get('date') and e['date'] >= started]
+            if new:
+                pushes[field] = {'$each': new, '$position': 0, '$slice': limit}
+        if pushes:
+            db.harvests.update(query, {'$push': pushes})
+
+        status = dict(query)
+        if run_id is not None and self.harvest_successful:
+            status['$or'] = [{'harvest_run': {'$ne': run_id}}, {'harvest_successful': {'$ne': False}}]
+        db.harvests.update(status, {'$set': {'harvest_status'     : self.harvest_status,
+                                             'harvest_date'       : self.harvest_date,
+                                             'harvest_successful' : self.harvest_successful,
+                                             'next_harvest'       : self.next_harvest,
+                                             'harvest_run'        : run_id}})
+
+        if self.profile.get('date') and self.profile['date'] >= started:
+            self.save_profile(run_id)
+
+    def save_profile(self, run_id=None):
+        '''
+        Writes the profile of this run. The first shard of a sharded run to
+        finish replaces the previous run's profile, the others add to it.
+        '''
+        profile = dict(self.profile, run_id=run_id)
+        if run_id is None:
+            db.harvests.update({'service_id': self.service_id}, {'$set': {'profile': profile}})
+            return
+
+        inc = {'profile.total': profile['total']}
+        for phase, stats in profile['phases'].iteritems():
+            for name, amount in stats.iteritems():
+                inc['profile.phases.%s.%s' % (phase, name)] = amount
+        # retried once when another shard replaces the profile meanwhile
+        for _ in range(2):
+            if db.harvests.update({'service_id': self.service_id, 'profile.run_id': run_id},
+                                  {'$inc': inc, '$set': {'profile.date': profile['date']}}).get('n'):
+                return
+            if db.harvests.update({'service_id': self.service_id, 'profile.run_id': {'$ne': run_id}},
+                                  {'$set': {'profile': profile}}).get('n'):
+                return
+
+    def schedule_next(self):
+        '''
+        Sets when the service should be harvested next: failed harvests are
+        retried after the minimum interval, otherwise the interval depends on
+        how often recent harvests changed anything.
+        '''
+        if self.harvest_successful:
+            changes = [d['changed'] for d in self.durations if d.get('successful') and 'changed' in d]
+            from ioos_catalog.tasks.harvest import harvest_interval
+            interval = harvest_interval(changes)
+        else:
+            interval = app.config.get('HARVEST_INTERVAL_MIN', 86400)
+        self.next_harvest = datetime.utcnow() + timedelta(seconds=interval)
+
     def set_status(self, status):
         if not isinstance(status, unicode):
             status = unicode(status)
@@ -175,6 +317,76 @@ class Harvest(BaseDocument):
         successes = sum([i.get('successful', False) for i in self.harvest_messages])
         return '%s/%s' % (successes, attempts)
 
+    @classmethod
+    def record_ccheck(cls, service_id, phase, seconds):
+        '''
+        Accounts the time of a compliance check or metamap to the latest
+        harvest run of the service
+        '''
+        key = CCHECK_PROFILE_KEY % service_id
+        pipe = redis_connection.pipeline()
+        pipe.hincrbyfloat(key, '%s:seconds' % phase, seconds)
+        pipe.hincrby(key, '%s:count' % phase, 1)
+        pipe.expire(key, 2 * app.config.get('HARVEST_INTERVAL_MAX', 1209600))
+        pipe.execute()
+
+    @classmethod
+    def reset_ccheck_profile(cls, service_id, pipe):
+        '''
+        Starts the ccheck profile of a new harvest run of the service
+        '''
+        pipe.delete(CCHECK_PROFILE_KEY % service_id)
+
+    @classmethod
+    def ccheck_profiles(cls, service_ids):
+        '''
+        Returns a dict of service id -> phase -> {seconds, count} of the
+        checks of the services' latest harvest runs
+        '''
+        pipe = redis_connection.pipeline()
+        for service_id in service_ids:
+            pipe.hgetall(CCHECK_PROFILE_KEY % service_id)
+
+        profiles = {}
+        for service_id, fields in zip(service_ids, pipe.execute()):
+            for field, value in fields.iteritems():
+                phase, name = field.rsplit(':', 1)
+                profiles.setdefault(service_id, {}).setdefault(phase, {})[name] = float(value)
+        return profiles
+
+    @classmethod
+    def profile_by_provider(cls):
+        """
+        Sums the profiles of the last harvest of each service by data
+        provider, ie.
+
+        MARACOOS ->
+            services -> 12
+            seconds  -> 5400.2
+            phases   -> describe_sensor -> {seconds, bytes, count, requests, retries}
+                        ...
+        """
+        providers = {s['_id']: s.get('data_provider') for s in db.services.find({}, {'data_provider': True})}
+
+        retval = {}
+        # harvests that never recorded a profile (new, migrated, or that
+        # returned before harvesting) have a skeleton one without a date
+        harvests = [h for h in db.harvests.find({'profile.date': {'$ne': None}},
+                                                {'service_id': True, 'profile': True})
+                    if providers.get(h['service_id']) is not None]
+        ccheck = cls.ccheck_profiles([h['service_id'] for h in harvests])
+        for h in harvests:
+            rollup = retval.setdefault(providers[h['service_id']], {'services': 0, 'seconds': 0.0, 'phases': {}})
+            rollup['services'] += 1
+            rollup['seconds'] += h['profile'].get('total') or 0
+            phases = (h['profile'].get('phases') or {}).items() + ccheck.get(h['service_id'], {}).items()
+            for phase, stats in phases:
+                phase_rollup = rollup['phases'].setdefault(phase, {})
+                for k, v in (stats or {}).iteritems():
+                    phase_rollup[k] = phase_rollup.get(k, 0) + (v or 0)
+
+        return retval
+
     def get_last_harvests(self, limit_number=30):
         query = [{"$match": {"service_id": self.service_id}},
                  {"$project": {"harvest_messages": 1}},
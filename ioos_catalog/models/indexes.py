@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+'''
+ioos_catalog/models/indexes.py
+
+Index management. The indexes are declared on the models (MongoKit's
+`indexes` attribute, and `array_indexes` for fields of embedded lists,
+which MongoKit rejects); ensure_indexes builds whatever is missing in the
+background, and audit_indexes explains the hot queries of the harvests and
+views and flags the ones that scan a whole collection.
+'''
+
+from bson import ObjectId
+from datetime import datetime
+from pymongo import ASCENDING
+from pymongo.errors import OperationFailure
+
+from ioos_catalog import app, db
+from ioos_catalog.models.dataset import Dataset
+from ioos_catalog.models.harvests import Harvest
+from ioos_catalog.models.map_feature import MapFeature
+from ioos_catalog.models.metadata import Metadata
+from ioos_catalog.models.ping_archive import PingArchive
+from ioos_catalog.models.ping_latest import PingLatest
+from ioos_catalog.models.service import Service
+from ioos_catalog.models.stat import Stat
+
+MODELS = [Service, Dataset, Harvest, Metadata, Stat, PingLatest, PingArchive, MapFeature]
+
+# (name, collection, query, sort) of the queries that must use an index;
+# the values only need the right types
+HOT_QUERIES = [
+    ('dataset by uid (harvest)', 'datasets', {'uid': u''}, None),
+    ('datasets of a service', 'datasets', {'services.service_id': ObjectId()}, None),
+    ('active datasets by provider', 'datasets',
+     {'services': {'$elemMatch': {'active': True, 'data_provider': u''}}}, None),
+    ('recently updated datasets', 'datasets',
+     {'updated': {'$gte': datetime.utcfromtimestamp(0)}}, [('updated', -1)]),
+    ('harvest of a service', 'harvests', {'service_id': ObjectId()}, None),
+    ('harvests of services', 'harvests', {'service_id': {'$in': [ObjectId()]}}, None),
+    ('active services', 'services', {'active': True}, None),
+    ('active services of a provider', 'services', {'data_provider': u'', 'active': True}, None),
+    ('active services by type', 'services', {'service_type': {'$in': [u'']}, 'active': True}, None),
+    ('service by provider and url (reindex)', 'services', {'data_provider': u'', 'url': u''}, None),
+    ('metadata of a record', 'metadatas', {'ref_id': ObjectId()}, None),
+    ('cached check of a digest', 'metadatas', {'metadata.digest': u''}, None),
+    ('active metadata by provider', 'metadatas',
+     {'metadata': {'$elemMatch': {'active': True, 'data_provider': u''}}}, None),
+    ('latest stat of a service', 'stats', {'service_id': ObjectId(), 'created': datetime.utcnow()}, None),
+    ('latest stats', 'stats', {}, [('created', -1)]),
+    ('latest ping of a service', 'ping_latest', {'service_id': ObjectId()}, None),
+    ('recent pings', 'ping_latest',
+     {'updated': {'$gte': datetime.utcfromtimestamp(0)}}, [('updated', -1)]),
+    ('ping archive of a service', 'ping_archive',
+     {'service_id': ObjectId(), 'start_time': datetime.utcnow()}, None),
+    ('map features of a provider', 'map_features', {'data_provider': u''}, None),
+    ('map features of a dataset', 'map_features', {'dataset_id': {'$in': [ObjectId()]}}, None),
+]
+
+def index_keys(fields):
+    '''
+    Returns the (field, direction) list of a MongoKit index declaration
+    '''
+    if isinstance(fields, basestring):
+        fields = [fields]
+    return [(f, ASCENDING) if isinstance(f, basestring) else tuple(f) for f in fields]
+
+def declared_indexes(models=None):
+    '''
+    Returns a list of (collection name, keys, unique) for the indexes
+    declared on models
+    '''
+    indexes = []
+    for model in models or MODELS:
+        for index in (getattr(model, 'indexes', None) or []) + (getattr(model, 'array_indexes', None) or []):
+            indexes.append((model.__collection__, index_keys(index['fields']),
+                            bool(index.get('unique'))))
+    return indexes
+
+def ensure_indexes(models=None):
+    '''
+    Builds the declared indexes that don't exist yet, in the background so
+    the collections stay available. Returns the (collection, keys) ensured,
+    and logs the ones that can't be built (ie. duplicates under a unique
+    index).
+    '''
+    ensured = []
+    for collection, keys, unique in declared_indexes(models):
+        try:
+            db[collection].ensure_index(keys, unique=unique, background=True)
+            ensured.append((collection, keys))
+        except OperationFailure as e:
+            app.logger.warning("Couldn't build index %s on %s: %s", keys, collection, e)
+    return ensured
+
+def plan_stages(plan):
+    '''
+    Yields the stages of a query plan tree (MongoDB 3.0 and later)
+    '''
+    if not plan:
+        return
+    yield plan.get('stage')
+    for child in [plan.get('inputStage')] + plan.get('inputStages', []):
+        for stage in plan_stages(child):
+            yield stage
+
+def collection_scan(explain):
+    '''
+    Whether an explain result shows a collection scan. MongoDB 2.x reports a
+    BasicCursor, later versions a COLLSCAN stage in the winning plan.
+    '''
+    if 'queryPlanner' in explain:
+        return 'COLLSCAN' in plan_stages(explain['queryPlanner'].get('winningPlan'))
+    return explain.get('cursor', '').startswith('BasicCursor')
+
+def audit_indexes(queries=None):
+    '''
+    Explains each hot query and returns a list of (name, collection, whether
+    it scans the collection)
+    '''
+    results = []
+    for name, collection, query, sort in queries or HOT_QUERIES:
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        results.append((name, collection, collection_scan(cursor.explain())))
+    return results
@@ -0,0 +1,57 @@
+from datetime import datetime
+
+from bson.objectid import ObjectId
+
+from ioos_catalog import db, app
+from ioos_catalog.models.base_document import BaseDocument
+
+@db.register
+class MapFeature(BaseDocument):
+    """
+    A feature of the catalog map: the location of a dataset's service
+    entry, with the fields the map filters on and the serialized GeoJSON
+    Feature it shows. Materialized from the datasets by
+    tasks.map_features, so map requests don't read datasets or services.
+    """
+
+    __collection__   = 'map_features'
+    use_dot_notation = True
+    use_schemaless   = True
+
+    structure = {
+        'dataset_id'    : ObjectId,
+        'sindex'        : int,        # index of the entry in dataset.services
+        'service_id'    : ObjectId,
+        'data_provider' : unicode,
+        'service_type'  : unicode,
+        'variables'     : [unicode],
+        'time_min'      : datetime,
+        'time_max'      : datetime,
+        'feature'       : unicode,    # JSON of the GeoJSON Feature
+        'simplified'    : [unicode],  # JSON of the Feature per map resolution, coarsest first,
+                                      # None where it is the same as the next
+        'point'         : [float],    # coordinates of Point features, which are clustered
+        'west'          : float,      # bounding box of the geometry
+        'south'         : float,
+        'east'          : float,
+        'north'         : float,
+        'updated'       : datetime
+    }
+
+    indexes = [
+        {
+            # refreshes upsert by these
+            'fields': ['dataset_id', 'sindex'],
+            'unique': True,
+        },
+        {
+            'fields': ['data_provider']
+        },
+        {
+            # features in the map view
+            'fields': ['west', 'east', 'south', 'north']
+        },
+        {
+            'fields': ['service_id']
+        },
+    ]
@@ -18,6 +18,9 @@ class Metadata(BaseDocument):
         'metadata'          : [{
             'service_id'    : ObjectId, # all metadata is refed to a service entry
             'checker'       : unicode,  # which checker (by name) was used to generate this cc run/metamap
+            'digest'        : unicode,  # tasks.ccheck.ccheck_key of the checked document, used to skip unchanged inputs
+            'active'        : bool,     # service active flag cached here, see tasks.activation
+            'data_provider' : unicode,  # service data_provider cached here
 
             'cc_score'      : {         # score via compliance checker
                 'score'     : float,
@@ -49,3 +52,15 @@ class Metadata(BaseDocument):
         },
     ]
 
+    # indexes on fields of the metadata list, which MongoKit can't validate
+    # (see models.indexes)
+    array_indexes = [
+        {
+            'fields': ['metadata.digest']
+        },
+        {
+            # metadata of active services, by provider (see tasks.activation)
+            'fields': ['metadata.active', 'metadata.data_provider']
+        },
+    ]
+
@@ -0,0 +1,130 @@
+import hashlib
+import zlib
+from collections import Counter, defaultdict
+from datetime import datetime
+
+from bson.binary import Binary
+from pymongo.errors import DuplicateKeyError
+
+from ioos_catalog import app, db
+from ioos_catalog.models.base_document import BaseDocument
+
+@db.register
+class MetadataBlob(BaseDocument):
+    """
+    Content-addressed, compressed store for large metadata documents
+    (SensorML, NcML).
+
+    Blobs are keyed by the SHA-1 of their uncompressed content, so identical
+    documents shared by several services are stored once. Each dataset
+    service entry referencing a blob by its 'metadata_hash' holds one
+    reference; a blob is removed when its last reference is released.
+    """
+    __collection__   = 'metadata_blobs'
+    use_dot_notation = True
+    use_schemaless   = True
+
+    # Mongo documents are limited to 16MB
+    MAX_COMPRESSED_SIZE = 15 * 1024 * 1024
+
+    structure = {
+        '_id'             : unicode,  # sha1 hex digest of the uncompressed content
+        'data'            : Binary,   # zlib compressed, utf-8 encoded content
+        'size'            : int,      # uncompressed size in bytes
+        'compressed_size' : int,
+        'refcount'        : int,      # number of dataset service entries referencing this blob
+        'created'         : datetime,
+    }
+
+    default_values = {
+        'created'  : datetime.utcnow,
+        'refcount' : 0,
+    }
+
+    @classmethod
+    def digest(cls, text):
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        return unicode(hashlib.sha1(text).hexdigest())
+
+    @classmethod
+    def put(cls, text):
+        """
+        Stores text (if not already stored) and adds a reference to it.
+
+        Returns the blob's hash, or None if the document is too large to
+        store even when compressed.
+
+        Safe against concurrent puts and releases: the reference is only
+        counted on a blob that exists at that moment, and the blob is
+        (re)inserted otherwise.
+        """
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        digest = cls.digest(text)
+
+        # the common case, the blob is stored already
+        if db.metadata_blobs.update({'_id': digest}, {'$inc': {'refcount': 1}}).get('n'):
+            return digest
+
+        data = zlib.compress(text)
+        if len(data) > cls.MAX_COMPRESSED_SIZE:
+            return None
+
+        insert = {'$setOnInsert': {'data'            : Binary(data),
+                                   'size'            : len(text),
+                                   'compressed_size' : len(data),
+                                   'created'         : datetime.utcnow()},
+                  '$inc': {'refcount': 1}}
+        try:
+            db.metadata_blobs.update({'_id': digest}, insert, upsert=True)
+        except DuplicateKeyError:
+            # another put inserted it meanwhile, this one adds to it
+            db.metadata_blobs.update({'_id': digest}, insert, upsert=True)
+
+        return digest
+
+    @classmethod
+    def release(cls, digest):
+        """
+        Drops a reference to a blob, removing the blob once unreferenced.
+        The removal only matches while no reference is counted, so a put
+        adding one meanwhile keeps the blob, and a put after it inserts the
+        blob again.
+        """
+        if not digest:
+            return
+        db.metadata_blobs.update({'_id': digest}, {'$inc': {'refcount': -1}})
+        db.metadata_blobs.remove({'_id': digest, 'refcount': {'$lte': 0}})
+
+    @classmethod
+    def release_services(cls, services):
+        """
+        Releases the blobs referenced by a list of dataset service entries,
+        with one update per distinct reference count. Returns the number of
+        references released.
+        """
+        counts = Counter(s.get('metadata_hash') for s in services if s.get('metadata_hash'))
+        if not counts:
+            return 0
+
+        by_count = defaultdict(list)
+        for digest, count in counts.iteritems():
+            by_count[count].append(digest)
+        for count, digests in by_count.iteritems():
+            db.metadata_blobs.update({'_id': {'$in': digests}}, {'$inc': {'refcount': -count}}, multi=True)
+        db.metadata_blobs.remove({'_id': {'$in': counts.keys()}, 'refcount': {'$lte': 0}})
+        return sum(counts.itervalues())
+
+    @classmethod
+    def get_text(cls, digest):
+        """
+        Returns the uncompressed text of a blob, or None if there is none.
+        """
+        if not digest:
+            return None
+        blob = db.metadata_blobs.find_one({'_id': digest}, {'data': True})
+        if blob is None:
+            app.logger.warn("Missing metadata blob %s", digest)
+            return None
+        return zlib.decompress(blob['data']).decode('utf-8')
@@ -0,0 +1,15 @@
+from ioos_catalog import db, app
+
+def migrate():
+    """Moves inline dataset metadata documents into the MetadataBlob store"""
+    with app.app_context():
+        datasets = db.datasets.find({'services.metadata_value': {'$exists': True}},
+                                    {'services': True})
+        for d in datasets:
+            for s in d['services']:
+                metadata_value = s.pop('metadata_value', None)
+                if metadata_value and not s.get('metadata_hash'):
+                    s['metadata_hash'] = db.MetadataBlob.put(metadata_value)
+            db.datasets.update({'_id': d['_id']},
+                               {'$set': {'services': d['services']}})
+        app.logger.info("Migration 2026-10-19 complete")
@@ -0,0 +1,18 @@
+from ioos_catalog import db, app
+from ioos_catalog.tasks.activation import apply_activation
+from ioos_catalog.tasks.cleanup import chunks
+
+def migrate():
+    """Backfills the service active flags of dataset and metadata entries"""
+    with app.app_context():
+        service_ids = [s['_id'] for s in db.services.find({}, {'_id': True})]
+        for ids in chunks(service_ids):
+            apply_activation(ids)
+
+        # entries of services that no longer exist
+        for collection, entries in ((db.datasets, 'services'), (db.metadatas, 'metadata')):
+            orphans = collection.distinct('%s.service_id' % entries)
+            known = set(service_ids)
+            for ids in chunks([sid for sid in orphans if sid not in known]):
+                apply_activation(ids)
+        app.logger.info("Migration 2026-10-20 complete")
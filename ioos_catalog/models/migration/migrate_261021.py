@@ -0,0 +1,24 @@
+from ioos_catalog import db, app
+from ioos_catalog.tasks.cleanup import chunks
+
+def migrate():
+    """
+    Backfills the service data_provider of metadata entries and builds the
+    indexes of the active service entry queries
+    """
+    with app.app_context():
+        services = list(db.services.find({}, {'data_provider': True}))
+        for chunk in chunks(services):
+            # one entry per document and round, see tasks.activation.cascade
+            while True:
+                bulk = db.metadatas.initialize_unordered_bulk_op()
+                for s in chunk:
+                    bulk.find({'metadata': {'$elemMatch': {'service_id': s['_id'],
+                                                           'data_provider': {'$ne': s.get('data_provider')}}}}) \
+                        .update({'$set': {'metadata.$.data_provider': s.get('data_provider')}})
+                if not bulk.execute().get('nMatched'):
+                    break
+
+        db.datasets.ensure_index([('services.active', 1), ('services.data_provider', 1)], background=True)
+        db.metadatas.ensure_index([('metadata.active', 1), ('metadata.data_provider', 1)], background=True)
+        app.logger.info("Migration 2026-10-21 complete")
@@ -36,6 +36,10 @@ class ServiceMigration(DocumentMigration):
         self.target = {'extra_url':{'$exists': False}}
         self.update = {'$set':{'extra_url': None}}
 
+    def allmigration08__add_describe_sensor_format_field(self):
+        self.target = {'describe_sensor_format':{'$exists': False}}
+        self.update = {'$set':{'describe_sensor_format': None}}
+
 # Datasets
 from ioos_catalog.models import dataset
 class DatasetMigration(DocumentMigration):
@@ -60,6 +64,18 @@ class HarvestMigration(DocumentMigration):
                 message['successful'] = False
             doc.save()
 
+    def allmigration_02__add_durations_field(self):
+        self.target = {'durations': {'$exists': False}}
+        self.update = {'$set': {'durations': []}}
+
+    def allmigration_03__add_profile_field(self):
+        self.target = {'profile': {'$exists': False}}
+        self.update = {'$set': {'profile': {'date': None, 'total': None, 'shards': None, 'phases': {}}}}
+
+    def allmigration_04__add_next_harvest_field(self):
+        self.target = {'next_harvest': {'$exists': False}}
+        self.update = {'$set': {'next_harvest': None}}
+
 
 
 with app.app_context():
@@ -4,8 +4,6 @@ from datetime import datetime, timedelta, time
 import pytz
 from ioos_catalog import app, db
 from ioos_catalog.models.base_document import BaseDocument
-from ioos_catalog.tasks.stat import ping_service_task
-from ioos_catalog.tasks.harvest import harvest
 import requests
 
 @db.register
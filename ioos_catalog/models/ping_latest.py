@@ -4,8 +4,6 @@ from datetime import datetime, timedelta
 import pytz
 from ioos_catalog import app, db
 from ioos_catalog.models.base_document import BaseDocument
-from ioos_catalog.tasks.stat import ping_service_task
-from ioos_catalog.tasks.harvest import harvest
 import requests
 
 @db.register
@@ -46,6 +44,10 @@ class PingLatest(BaseDocument):
         {
             'fields': ['service_id', 'updated']
         },
+        {
+            # inventory of recent pings
+            'fields': [('updated', -1)]
+        },
     ]
 
     @classmethod
@@ -7,8 +7,6 @@ import urlparse
 
 from ioos_catalog import app, db
 from ioos_catalog.models.base_document import BaseDocument
-from ioos_catalog.tasks.stat import ping_service_task
-from ioos_catalog.tasks.harvest import harvest
 
 @db.register
 class Service(BaseDocument):
@@ -32,6 +30,7 @@ class Service(BaseDocument):
         'active'                : bool,    # should this service be pinged/harvested?
         'manual'                : bool,    # if True, don't allow reindex to control active flag, it means
                                            # administrator controls active flag manually
+        'describe_sensor_format': unicode, # SOS DescribeSensor outputFormat learned by the harvester
         'created'               : datetime,
         'updated'               : datetime,
     }
@@ -40,6 +39,21 @@ class Service(BaseDocument):
         'created': datetime.utcnow
     }
 
+    indexes = [
+        {
+            # reindex_services upserts by these
+            'fields': ['data_provider', 'url'],
+            'unique': True,
+        },
+        {
+            # active services, by provider
+            'fields': ['active', 'data_provider']
+        },
+        {
+            'fields': ['service_type', 'active']
+        },
+    ]
+
     @classmethod
     def group_by_tld(cls, filter_ids=None):
         query = [{'$group':{'_id':'$tld', 'ids':{'$addToSet':'$_id'}}}]
@@ -25,6 +25,16 @@ class Stat(BaseDocument):
         'created': datetime.utcnow
     }
 
+    indexes = [
+        {
+            # latest stats of a service
+            'fields': ['service_id', 'created']
+        },
+        {
+            'fields': [('created', -1)]
+        },
+    ]
+
     def ping_service(self):
         s = db.Service.find_one({'_id':self.service_id})
         assert s is not None
@@ -1 +1,3 @@
-from ioos_catalog.tasks import stat, reindex_services, send_email, harvest
+# the harvest modules (netCDF4, pandas, paegan, compliance checker, shapely,
+# owslib...) are only imported by the workers and the routes that need them
+from ioos_catalog.tasks import stat, reindex_services, send_email
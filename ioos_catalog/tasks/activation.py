@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+'''
+ioos_catalog/tasks/activation.py
+
+Cascades service activation changes to datasets and metadata.
+
+Whatever changes a service's active flag (reindex, the monitoring and
+harvesting routes, editing or deleting a service) publishes an activation
+event for the service ids. The event is a job on the default queue that
+reads the current state of those services, so events are idempotent and
+their order doesn't matter, and updates in bulk:
+
+    - the denormalized 'active' flag of their entries in Dataset.services
+      and Metadata.metadata
+    - Dataset.active and Metadata.active: whether any of the document's
+      services is active
+'''
+
+from ioos_catalog import app, db, queue
+from ioos_catalog.tasks.cleanup import chunks
+
+def publish_activation(service_ids):
+    '''
+    Queues the cascade of the active flag of service_ids
+    '''
+    service_ids = list(service_ids)
+    if service_ids:
+        queue.enqueue(apply_activation, service_ids)
+
+def apply_activation(service_ids):
+    '''
+    Brings the datasets and metadata referencing service_ids in line with
+    the services' active flags. Deleted services count as inactive.
+    '''
+    with app.app_context():
+        active = set(s['_id'] for s in db.services.find({'_id': {'$in': service_ids}, 'active': True},
+                                                        {'_id': True}))
+        activated   = [sid for sid in service_ids if sid in active]
+        deactivated = [sid for sid in service_ids if sid not in active]
+
+        counts = {}
+        for collection, entries in ((db.datasets, 'services'), (db.metadatas, 'metadata')):
+            counts[collection.name] = cascade(collection, entries, activated, deactivated)
+
+        app.logger.info("Activation of %s services (%s active): %s", len(service_ids), len(activated), counts)
+        return counts
+
+def cascade(collection, entries, activated, deactivated):
+    '''
+    Sets the active flag of the service entries (the array field entries)
+    of collection's documents, then the documents' own flag. Returns the
+    number of documents activated and deactivated.
+    '''
+    sid = '%s.service_id' % entries
+    # the positional operator sets one entry per document, and metadata has
+    # one per service and checker: repeat until no entry is left to flip
+    while activated or deactivated:
+        bulk = collection.initialize_unordered_bulk_op()
+        for flag, ids in ((True, activated), (False, deactivated)):
+            for service_id in ids:
+                bulk.find({entries: {'$elemMatch': {'service_id': service_id, 'active': {'$ne': flag}}}}) \
+                    .update({'$set': {'%s.$.active' % entries: flag}})
+        if not bulk.execute().get('nMatched'):
+            break
+
+    counts = {'activated': 0, 'deactivated': 0}
+    for ids in chunks(activated):
+        result = collection.update({sid: {'$in': ids}, 'active': {'$ne': True}},
+                                   {'$set': {'active': True}}, multi=True)
+        counts['activated'] += result.get('n', 0) if result else 0
+    for ids in chunks(deactivated):
+        # none of the entries active
+        result = collection.update({sid: {'$in': ids}, '%s.active' % entries: {'$ne': True}, 'active': True},
+                                   {'$set': {'active': False}}, multi=True)
+        counts['deactivated'] += result.get('n', 0) if result else 0
+    return counts
@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+'''
+ioos_catalog/tasks/ccheck.py
+
+Compliance checker and metamap stage. Harvesters hand off the fetched
+metadata document and these tasks run the (CPU-bound) checks on their own
+queue, writing the results to the Metadata collection.
+'''
+
+import hashlib
+import time
+from datetime import datetime
+from functools import wraps
+
+import pkg_resources
+
+from lxml import etree
+from netCDF4 import Dataset
+from owslib.sos import SensorObservationService
+from owslib.swe.sensor.sml import SensorML
+
+from compliance_checker.runner import ComplianceCheckerCheckSuite
+from compliance_checker.ioos import IOOSSOSGCCheck, IOOSSOSDSCheck, IOOSNCCheck
+from compliance_checker.base import get_namespaces
+from wicken.xml_dogma import MultipleXmlDogma
+from wicken.netcdf_dogma import NetCDFDogma
+from petulantbear.netcdf_etree import namespaces as pb_namespaces
+from petulantbear.netcdf2ncml import dataset2ncml
+
+from ioos_catalog import app, db, ccheck_queue, redis_connection
+
+# Redis hash holding throughput counters of the ccheck stage
+STATS_KEY = 'ioos_catalog:ccheck:stats'
+
+def package_version(name):
+    try:
+        return pkg_resources.get_distribution(name).version
+    except pkg_resources.DistributionNotFound:
+        return 'unknown'
+
+# the packages producing the results, cached results of other versions are
+# stale
+CHECKER_VERSIONS = u'compliance-checker %s, wicken %s' % (package_version('compliance-checker'),
+                                                          package_version('wicken'))
+
+def with_app_ctxt(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        with app.app_context():
+            return f(*args, **kwargs)
+    return wrapper
+
+def record_stats(f):
+    '''
+    Records completions, failures and time spent for a ccheck task
+    '''
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        try:
+            retval = f(*args, **kwargs)
+        except Exception:
+            redis_connection.hincrby(STATS_KEY, 'failed', 1)
+            raise
+        finally:
+            redis_connection.hincrbyfloat(STATS_KEY, 'seconds', time.time() - start)
+        redis_connection.hincrby(STATS_KEY, 'completed', 1)
+        return retval
+    return wrapper
+
+def get_stats():
+    '''
+    Returns the backlog and throughput counters of the ccheck stage
+    '''
+    stats = redis_connection.hgetall(STATS_KEY)
+    completed = int(stats.get('completed', 0))
+    seconds = float(stats.get('seconds', 0))
+    return {'queued'     : ccheck_queue.count,
+            'completed'  : completed,
+            'failed'     : int(stats.get('failed', 0)),
+            'cache_hits' : int(stats.get('cache_hits', 0)),
+            'avg_seconds': seconds / completed if completed else None}
+
+def content_digest(*parts):
+    '''
+    Returns a hex SHA-1 digest over the given strings, used to detect
+    unchanged harvest inputs.
+    '''
+    sha = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, unicode):
+            part = part.encode('utf-8')
+        sha.update(part)
+    return unicode(sha.hexdigest())
+
+def ccheck_key(digest):
+    '''
+    Returns the key the check results of an input with the content digest
+    are cached by, which also identifies the checker versions
+    '''
+    return content_digest(CHECKER_VERSIONS, digest)
+
+@with_app_ctxt
+def is_current(service_id, checker_name, ref_id, digest):
+    '''
+    Returns True if the Metadata record of ref_id was already generated from
+    the document identified by digest (a ccheck_key).
+    '''
+    metadata = db.metadatas.find_one({'ref_id': ref_id,
+                                      'metadata': {'$elemMatch': {'service_id': service_id,
+                                                                  'checker': checker_name,
+                                                                  'digest': digest}}},
+                                     {'_id': True})
+    return metadata is not None
+
+def profiled(service_id, phase, f, *args):
+    '''
+    Calls f(*args), accounting its time to the phase of the ccheck profile
+    of the service's latest harvest run
+    '''
+    start = time.time()
+    try:
+        return f(*args)
+    finally:
+        db.Harvest.record_ccheck(service_id, phase, time.time() - start)
+
+def queue_ccheck(task, *args):
+    '''
+    Queues a ccheck task on the ccheck queue
+    '''
+    return ccheck_queue.enqueue_call(task, args=args,
+                                     timeout=app.config.get('CCHECK_TIMEOUT', 600))
+
+@record_stats
+@with_app_ctxt
+def ccheck_capabilities_task(service_id, digest, url):
+    '''
+    Checks a SOS GetCapabilities document. The harvester only streams the
+    document, so it is fetched again here when it needs checking.
+    '''
+    def run_checks():
+        sos = SensorObservationService(url)
+        return (profiled(service_id, 'compliance_check', ccheck_service, sos),
+                profiled(service_id, 'metamap', metamap_service, sos))
+
+    return cached_ccheck_and_metadata(service_id, 'ioos', service_id,
+                                      u'service', digest, run_checks)
+
+@record_stats
+@with_app_ctxt
+def ccheck_sensorml_task(service_id, dataset_id, digest, xml):
+    '''
+    Checks a station's SensorML DescribeSensor document
+    '''
+    sensor_ml = SensorML(etree.fromstring(xml))
+    return cached_ccheck_and_metadata(service_id, 'ioos', dataset_id,
+                                      u'dataset', digest,
+                                      lambda: (profiled(service_id, 'compliance_check', ccheck_station, sensor_ml),
+                                               profiled(service_id, 'metamap', metamap_station, sensor_ml)))
+
+@record_stats
+@with_app_ctxt
+def ccheck_netcdf_task(service_id, dataset_id, digest, url):
+    '''
+    Checks an OPeNDAP dataset. The dataset is opened again here, so the
+    results are recorded for the NcML header of what is actually checked,
+    which is the harvest's digest unless the dataset changed in between.
+    '''
+    ncdataset = Dataset(url)
+    try:
+        checked = ccheck_key(content_digest(unicode(dataset2ncml(ncdataset, url=url))))
+        if checked != digest:
+            app.logger.info("Dataset %s changed since it was harvested", url)
+        return cached_ccheck_and_metadata(service_id, 'ioos', dataset_id, u'dataset', checked,
+                                          lambda: (profiled(service_id, 'compliance_check', ccheck_dataset, ncdataset),
+                                                   profiled(service_id, 'metamap', metamap_dataset, ncdataset)))
+    finally:
+        ncdataset.close()
+
+def cached_ccheck_and_metadata(service_id, checker_name, ref_id, ref_type, digest, run_checks):
+    """
+    Runs the compliance checker and metamap via run_checks, which should
+    return a 2-tuple of scores and metamap, unless a result for the same
+    input (identified by its ccheck_key) already exists.
+
+    If this reference already holds the result for the digest, nothing is
+    checked or written. If another reference was checked with identical
+    input, its results are copied instead of rerunning the checks.
+    """
+    if is_current(service_id, checker_name, ref_id, digest):
+        redis_connection.hincrby(STATS_KEY, 'cache_hits', 1)
+        return "Unchanged"
+
+    cached = db.metadatas.find_one({'metadata': {'$elemMatch': {'digest': digest, 'checker': checker_name}}},
+                                   {'metadata': {'$elemMatch': {'digest': digest, 'checker': checker_name}}})
+    if cached is not None and cached.get('metadata'):
+        redis_connection.hincrby(STATS_KEY, 'cache_hits', 1)
+        cached_record = cached['metadata'][0]
+        update_doc = {k: cached_record.get(k) for k in ('cc_score', 'cc_results', 'metamap', 'digest')}
+        save_metadata_record(service_id, checker_name, ref_id, ref_type, update_doc)
+        return "Copied"
+
+    scores, metamap = run_checks()
+    save_ccheck_and_metadata(service_id, checker_name, ref_id, ref_type, scores, metamap, digest=digest)
+    return "Checked"
+
+def save_ccheck_and_metadata(service_id, checker_name, ref_id, ref_type, scores, metamap, digest=None):
+    """
+    Saves the result of a compliance checker scores and metamap document.
+    """
+    if not (scores or metamap):
+        return
+
+    def res2dict(r):
+        cl = []
+        if getattr(r, 'children', None):
+            cl = map(res2dict, r.children)
+
+        return {'name'     : unicode(r.name),
+                'score'    : float(r.value[0]),
+                'maxscore' : float(r.value[1]),
+                'weight'   : int(r.weight),
+                'children' : cl}
+
+    if isinstance(scores, tuple): # New API of compliance-checker
+        scores = scores[0]
+    cc_results = map(res2dict, scores)
+
+    # @TODO: srsly need to decouple from cchecker
+    score     = sum(((float(r.value[0])/r.value[1]) * r.weight for r in scores))
+    max_score = sum((r.weight for r in scores))
+
+    score_doc = {'score'     : float(score),
+                 'max_score' : float(max_score),
+                 'pct'       : float(score) / max_score}
+
+    update_doc = {'cc_score'   : score_doc,
+                  'cc_results' : cc_results,
+                  'metamap'    : metamap,
+                  'digest'     : digest}
+
+    return save_metadata_record(service_id, checker_name, ref_id, ref_type, update_doc)
+
+def save_metadata_record(service_id, checker_name, ref_id, ref_type, update_doc):
+    """
+    Inserts or updates the metadata record for the service/checker pair on
+    the Metadata document of ref_id.
+    """
+    metadata = db.Metadata.find_one({'ref_id': ref_id})
+    if metadata is None:
+        metadata             = db.Metadata()
+        metadata.ref_id      = ref_id
+        metadata.ref_type    = unicode(ref_type)
+
+    # kept up to date by tasks.activation afterwards
+    service = db.services.find_one({'_id': service_id}, {'active': True, 'data_provider': True}) or {}
+    update_doc = dict(update_doc, active=bool(service.get('active')),
+                      data_provider=service.get('data_provider'))
+    if update_doc['active']:
+        metadata.active = True
+
+    for mr in metadata.metadata:
+        if mr['service_id'] == service_id and mr['checker'] == checker_name:
+            mr.update(update_doc)
+            break
+    else:
+        metarecord = {'service_id': service_id,
+                      'checker'   : unicode(checker_name)}
+        metarecord.update(update_doc)
+        metadata.metadata.append(metarecord)
+
+    metadata.updated = datetime.utcnow()
+    metadata.save()
+
+    return metadata
+
+def metamap_from_beliefs(doc, beliefs, log_errors=False):
+    # now make a map out of this
+    # @TODO wicken should make this easier
+    metamap = {}
+    for k in beliefs:
+        try:
+            metamap[k] = getattr(doc, doc._fixup_belief(k)[0])
+        except Exception as e:
+            if log_errors:
+                app.logger.exception("Problem setting belief (%s)", k)
+    return metamap
+
+def ccheck_service(sos):
+    scores = None
+
+    try:
+        cs = ComplianceCheckerCheckSuite()
+        groups = cs.run(sos, 'ioos')
+        scores = groups['ioos']
+    except Exception as e:
+        app.logger.warn("Caught exception doing Compliance Checker on SOS service: %s", e)
+
+    return scores
+
+def metamap_service(sos):
+    # gets a metamap document of this service using wicken
+    beliefs = IOOSSOSGCCheck.beliefs()
+    doc = MultipleXmlDogma('sos-gc', beliefs, sos._capabilities, namespaces=get_namespaces())
+    return metamap_from_beliefs(doc, beliefs)
+
+def ccheck_station(sensor_ml):
+    scores = None
+    try:
+        cs = ComplianceCheckerCheckSuite()
+        groups = cs.run(sensor_ml, 'ioos')
+        scores = groups['ioos']
+    except Exception as e:
+        app.logger.warn("Caught exception doing Compliance Checker on SOS station: %s", e)
+
+    return scores
+
+def metamap_station(sensor_ml):
+    # gets a metamap document of this station using wicken
+    beliefs = IOOSSOSDSCheck.beliefs()
+    doc = MultipleXmlDogma('sos-ds', beliefs, sensor_ml._root, namespaces=get_namespaces())
+    return metamap_from_beliefs(doc, beliefs)
+
+def ccheck_dataset(ncdataset):
+    scores = None
+    try:
+        cs = ComplianceCheckerCheckSuite()
+        groups = cs.run(ncdataset, 'ioos')
+        scores = groups['ioos']
+    except Exception as e:
+        app.logger.warn("Caught exception doing Compliance Checker on Dataset: %s", e)
+
+    return scores
+
+def metamap_dataset(ncdataset):
+    # gets a metamap document of this dataset using wicken
+    beliefs = IOOSNCCheck.beliefs()
+    ncnamespaces = {'nc':pb_namespaces['ncml']}
+
+    doc = NetCDFDogma('nc', beliefs, ncdataset, namespaces=ncnamespaces)
+    metamap = metamap_from_beliefs(doc, beliefs, log_errors=True)
+
+    m_names, m_units = ['Variable Names*','Variable Units*']
+    metamap[m_names] = [] # Override the Wicken return to preserve the order
+    metamap[m_units] = [] # Override the Wicken return to preserve the order
+
+    # Wicken doesn't preserve the order between the names and the units,
+    # so what you wind up with is two lists that can't be related, but we
+    # want to keep the relationship between the name and the units
+
+    for k in ncdataset.variables.iterkeys():
+        var_name = k
+        standard_name = getattr(ncdataset.variables[k], 'standard_name', '')
+        units = getattr(ncdataset.variables[k], 'units', '')
+
+        # Only map metadata where we have all three
+        if var_name and standard_name and units:
+            metamap[m_names].append('%s (%s)' % (var_name, standard_name))
+            metamap[m_units].append(units)
+
+    return metamap
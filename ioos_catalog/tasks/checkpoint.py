@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+'''
+ioos_catalog/tasks/checkpoint.py
+
+Progress checkpoints of SOS harvests, kept in Redis. Each processed
+station's outcome is recorded as it completes, so a harvest that is
+interrupted (job timeout, worker restart) resumes after the last finished
+station instead of starting over. The checkpoint is shared by all shards
+of a service's harvest and cleared once every shard has finished.
+'''
+
+import zlib
+
+from ioos_catalog import app, redis_connection
+
+# procedure -> outcome of the stations processed by the current run
+PROGRESS_KEY = 'ioos_catalog:sos_progress:%s'
+# shards of the current run that have finished
+DONE_KEY     = 'ioos_catalog:sos_progress:%s:done'
+
+def in_shard(procedure, shard, shards):
+    '''
+    Returns True if procedure belongs to the shard (0 based) of shards
+    '''
+    if shards <= 1:
+        return True
+    return (zlib.crc32(procedure.encode('utf-8')) & 0xffffffff) % shards == shard
+
+class HarvestCheckpoint(object):
+    '''
+    Station outcomes of a service's current harvest run
+    '''
+    def __init__(self, service_id, shards=1):
+        self.progress_key = PROGRESS_KEY % service_id
+        self.done_key     = DONE_KEY % service_id
+        self.shards       = shards
+        # a checkpoint this old belongs to a run that won't resume
+        self.ttl          = app.config.get('SOS_CHECKPOINT_TTL', 2 * 24 * 60 * 60)
+
+    def outcomes(self):
+        return redis_connection.hgetall(self.progress_key)
+
+    def record(self, procedure, outcome):
+        pipe = redis_connection.pipeline()
+        pipe.hset(self.progress_key, procedure, outcome)
+        pipe.expire(self.progress_key, self.ttl)
+        pipe.execute()
+
+    def shard_done(self, shard):
+        '''
+        Marks a shard as finished, clearing the checkpoint once all shards
+        are. Returns True if the run is complete.
+        '''
+        pipe = redis_connection.pipeline()
+        pipe.sadd(self.done_key, shard or 0)
+        pipe.expire(self.done_key, self.ttl)
+        pipe.scard(self.done_key)
+        finished = pipe.execute()[-1]
+
+        if finished >= self.shards:
+            redis_connection.delete(self.progress_key, self.done_key)
+            return True
+        return False
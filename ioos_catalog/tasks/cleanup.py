@@ -3,10 +3,18 @@
 ioos_catalog/tasks/cleanup.py
 
 Cleanup tasks for catalog. Removes dangling resources.
+
+The cleanups are set-based: the service ids are loaded once, datasets are
+scanned with a projection of their service ids only, and the changes are
+written in bulk.
 '''
 
 from ioos_catalog import app, db, queue
 from functools import wraps
+import time
+
+# ids per $in of a bulk write
+CHUNK_SIZE = 1000
 
 def with_app_ctxt(f):
     @wraps(f)
@@ -15,6 +23,22 @@ def with_app_ctxt(f):
             return f(*args, **kwargs)
     return wrapper
 
+def chunks(items, size=CHUNK_SIZE):
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
+
+def service_sets():
+    '''
+    Returns the sets of existing and of active service ids, in one query
+    '''
+    existing = set()
+    active = set()
+    for s in db.services.find({}, {'active': True}):
+        existing.add(s['_id'])
+        if s.get('active'):
+            active.add(s['_id'])
+    return existing, active
+
 
 @with_app_ctxt
 def queue_remove_dangle():
@@ -28,34 +52,47 @@ def queue_remove_dangle():
 @with_app_ctxt
 def remove_dangling_datasets():
     '''
-    Prunes all dangling datasets
+    Prunes all dangling datasets: removes the entries of services that no
+    longer exist from datasets, and the datasets left without services
     '''
-    for dataset in db.Dataset.find({}):
-        prune_services(dataset)
+    start = time.time()
+    existing, _ = service_sets()
 
-def prune_services(dataset):
-    '''
-    Removes stale services from the dataset OR removes the dataset if there are
-    no viable services remaining.
-    '''
-    bad_services = []
-
-    for service_dict in dataset.services:
-        service_id = service_dict['service_id']
-
-        valid_service = db.Service.find_one({'_id' : service_id})
-        # The first thing to do is remove this from the list as viable services
-        if valid_service is None:
-            app.logger.critical("DANGLING DATASET %s", dataset._id)
-            bad_services.append(service_id)
-
-    if bad_services:
-        good_services = [s for s in dataset.services if s['service_id'] not in bad_services]
-        app.logger.info("Setting services to")
-        app.logger.info(good_services)
-        if not good_services:
-            app.logger.info("Deleting stale dataset: %s", dataset._id)
-            dataset.delete()
+    scanned = 0
+    pulled = []
+    deleted = []
+    released = []
+    for dataset in db.datasets.find({}, {'services.service_id': True, 'services.metadata_hash': True}):
+        scanned += 1
+        services = dataset.get('services', [])
+        bad_services = [s for s in services if s['service_id'] not in existing]
+        if not bad_services:
+            continue
+
+        app.logger.critical("DANGLING DATASET %s", dataset['_id'])
+        released.extend(bad_services)
+        if len(bad_services) == len(services):
+            deleted.append(dataset['_id'])
         else:
-            dataset.services = good_services
-            dataset.save()
+            pulled.append((dataset['_id'], list(set(s['service_id'] for s in bad_services))))
+
+    if pulled:
+        bulk = db.datasets.initialize_unordered_bulk_op()
+        for dataset_id, service_ids in pulled:
+            bulk.find({'_id': dataset_id}).update_one({'$pull': {'services': {'service_id': {'$in': service_ids}}}})
+        bulk.execute()
+
+    for ids in chunks(deleted):
+        app.logger.info("Deleting stale datasets: %s", ids)
+        db.datasets.remove({'_id': {'$in': ids}})
+
+    references = db.MetadataBlob.release_services(released)
+
+    # pulling entries shifts the service indexes of the map features
+    from ioos_catalog.tasks.map_features import refresh_features
+    refresh_features([dataset_id for dataset_id, _ in pulled] + deleted)
+
+    message = "Scanned %s datasets in %.1fs: pruned services of %s, deleted %s, released %s metadata blob references" % (
+        scanned, time.time() - start, len(pulled), len(deleted), references)
+    app.logger.info(message)
+    return message
@@ -1,16 +1,16 @@
-from bson import ObjectId
+from bson import ObjectId, json_util
 from datetime import datetime
 from lxml import etree
 import itertools
 import re
 import requests
 import math
+import time
 from urllib2 import HTTPError
 # py2/3 compat
 from six.moves.urllib.request import urlopen
 
 from owslib import ows
-from owslib.sos import SensorObservationService
 from owslib.swe.sensor.sml import SensorML
 from owslib.util import testXMLAttribute, testXMLValue
 from owslib.crs import Crs
@@ -19,112 +19,103 @@ from pyoos.parsers.ioos.describe_sensor import IoosDescribeSensor
 from paegan.cdm.dataset import CommonDataset, _possiblet, _possiblez, _possiblex, _possibley
 from petulantbear.netcdf2ncml import *
 from petulantbear.netcdf_etree import parse_nc_dataset_as_etree
-from petulantbear.netcdf_etree import namespaces as pb_namespaces
-from netCDF4 import Dataset
 import numpy as np
 
-from compliance_checker.runner import ComplianceCheckerCheckSuite
-from compliance_checker.ioos import IOOSSOSGCCheck, IOOSSOSDSCheck, IOOSNCCheck
-from compliance_checker.base import get_namespaces
-from wicken.xml_dogma import MultipleXmlDogma
-from wicken.netcdf_dogma import NetCDFDogma
-
 from shapely.geometry import mapping, box, Point, asLineString
 
 import geojson
 import json
 
-from ioos_catalog import app, db, queue
+from pymongo.errors import DuplicateKeyError
+from rq.timeouts import JobTimeoutException
+
+from ioos_catalog import app, db, queue, long_queue
 from ioos_catalog.tasks.send_email import send_service_down_email
+from ioos_catalog.tasks.sos_stream import (OWS_NS, capabilities_url,
+                                           fetch_document, parse_capabilities,
+                                           network_procedures)
+from ioos_catalog.tasks.ccheck import (is_current, queue_ccheck, content_digest, ccheck_key,
+                                       ccheck_capabilities_task,
+                                       ccheck_sensorml_task,
+                                       ccheck_netcdf_task)
+from ioos_catalog.tasks.jobs import lease, queued_key, LeaseUnavailable
+from ioos_catalog.tasks.checkpoint import HarvestCheckpoint, in_shard
+from ioos_catalog.tasks.map_features import refresh_features
 from ioos_catalog.tasks.debug import debug_wrapper, breakpoint
 #from ioos_catalog.models import MetricCount
 from functools import wraps
+from contextlib import contextmanager
 from datetime import datetime
 # mainly for conversion from np.datetime64 -> datetime.datetime
 from pandas import Timestamp
 from dateutil.parser import parse
 from netCDF4 import num2date
 
-LARGER_SERVICES = [
-    ObjectId('53d34aed8c0db37e0b538fda'),
-    ObjectId('53d49c8d8c0db37ff1370308')
-]
+def percentile(values, pct):
+    """
+    Returns the pct-th percentile of values, linearly interpolating between
+    the closest ranks.
+    """
+    values = sorted(values)
+    if not values:
+        return None
+    rank = (len(values) - 1) * pct / 100.0
+    lower = int(math.floor(rank))
+    upper = int(math.ceil(rank))
+    return values[lower] + (values[upper] - values[lower]) * (rank - lower)
 
-def queue_harvest_tasks():
+def harvest_plan(durations, dataset_count=0, max_shards=1):
     """
-    Generate a number of harvest tasks.
+    Returns the (queue, timeout, shards) to harvest a service with, given the
+    total durations (in s) of its recent harvests.
+
+    The timeout is a multiple of a high percentile of the recent durations,
+    bounded by HARVEST_TIMEOUT_MIN/MAX. Services whose percentile duration
+    exceeds HARVEST_LONG_THRESHOLD are split in up to max_shards jobs run in
+    parallel; if that doesn't bring them under the threshold they go to the
+    long queue. Without any history the timeout is estimated from the number
+    of datasets of the service.
+    """
+    min_timeout = app.config.get('HARVEST_TIMEOUT_MIN', 180)
+    max_timeout = app.config.get('HARVEST_TIMEOUT_MAX', 43200)
+    threshold   = app.config.get('HARVEST_LONG_THRESHOLD', 1800)
+
+    expected = percentile(durations, app.config.get('HARVEST_TIMEOUT_PERCENTILE', 95))
+    shards = 1
+    if expected is None:
+        # for large numbers of requests, 60 seconds should be enough for
+        # each request, on average
+        timeout = dataset_count * 60
+        target = queue
+    else:
+        shards = int(min(max(math.ceil(float(expected) / threshold), 1), max_shards))
+        expected = float(expected) / shards
+        timeout = expected * app.config.get('HARVEST_TIMEOUT_FACTOR', 2)
+        target = long_queue if expected > threshold else queue
+
+    return target, int(min(max(timeout, min_timeout), max_timeout)), shards
+
+def harvest_interval(changes):
+    """
+    Returns the seconds until a service should be harvested again, given
+    whether each of its recent successful harvests changed any content.
 
-    Meant to be called via cron. Only queues services that are active.
+    The interval is HARVEST_INTERVAL_MIN divided by the (smoothed) rate of
+    harvests that changed something, bounded by HARVEST_INTERVAL_MAX, so
+    services backing off gradually as unchanged harvests accumulate.
     """
+    min_interval = app.config.get('HARVEST_INTERVAL_MIN', 86400)
+    max_interval = app.config.get('HARVEST_INTERVAL_MAX', 1209600)
 
-    with app.app_context():
-        for s in db.Service.find({'active':True}, {'_id':True}):
-            service_id = s._id
-            if service_id in LARGER_SERVICES:
-                continue
-            # count all the datasets associated with this particular service
-            datalen = db.datasets.find({'services.service_id':
-                                         service_id}).count()
-            # handle timeouts for services with large numbers of datasets
-            if datalen <= 36:
-                timeout_secs = 180
-            else:
-                # for large numbers of requests, 5 seconds should be enough
-                # for each request, on average
-                timeout_secs = datalen * 60
-            queue.enqueue_call(harvest, args=(service_id,),
-                               timeout=timeout_secs)
-
-
-    # record dataset/service metrics after harvest
-    add_counts()
-
-def queue_provider(provider):
-    with app.app_context():
-        for s in db.Service.find({'data_provider':provider, 'active':True}):
-            service_id = s._id
-            if service_id in LARGER_SERVICES:
-                continue
-            # count all the datasets associated with this particular service
-            datalen = db.datasets.find({'services.service_id':
-                                         service_id}).count()
-            # handle timeouts for services with large numbers of datasets
-            if datalen <= 36:
-                timeout_secs = 180
-            else:
-                # for large numbers of requests, 5 seconds should be enough
-                # for each request, on average
-                timeout_secs = datalen * 60
-            queue.enqueue_call(harvest, args=(service_id,),
-                               timeout=timeout_secs)
-
-    # record dataset/service metrics after harvest
-    add_counts()
-
-
-def queue_large_service_harvest_tasks():
-    larger_services = [
-        ObjectId('53d34aed8c0db37e0b538fda'),
-        ObjectId('53d49c8d8c0db37ff1370308')
-    ]
-    with app.app_context():
-        for s in db.Service.find({'_id':{'$in':larger_services}}):
-            service_id = s._id
-            # count all the datasets associated with this particular service
-            datalen = db.datasets.find({'services.service_id':
-                                         service_id}).count()
-            # handle timeouts for services with large numbers of datasets
-            if datalen <= 36:
-                timeout_secs = 180
-            else:
-                # for large numbers of requests, 5 seconds should be enough
-                # for each request, on average
-                timeout_secs = datalen * 60
-            queue.enqueue_call(harvest, args=(service_id,),
-                               timeout=timeout_secs)
+    rate = (sum(1 for c in changes if c) + 1.0) / (len(changes) + 1)
+    return int(min(min_interval / rate, max_interval))
 
-    # record dataset/service metrics after harvest
-    add_counts()
+def harvest_key(service_id, shard=None, shards=1):
+    """
+    Returns the key harvest jobs are coalesced by, per shard for sharded
+    harvests. Runs are leased by the service id alone.
+    """
+    return queued_key(ObjectId(service_id), shard if shards > 1 else None)
 
 
 # TODO: Roll into respective model methods instead
@@ -203,17 +194,43 @@ def context_decorator(f):
 
 @debug_wrapper
 @context_decorator
-def harvest(service_id, ignore_active=False):
+def harvest(service_id, ignore_active=False, batch_id=None, shard=None, shards=1, run_id=None):
+    """
+    Harvests a service, or one shard of it. The shards of a run (same
+    run_id) run concurrently under a shared lease, and each one writes its
+    outcome to the Harvest document with atomic updates.
+    """
+    service_id = ObjectId(service_id)
+    if shards <= 1:
+        shard = run_id = None
+    elif run_id is None:
+        # queued before runs had ids
+        run_id = u'sharded:%s' % shards
 
-    # Get the harvest or make a new one
-    harvest = db.Harvest.find_one( { 'service_id' : ObjectId(service_id) } )
-    if harvest is None:
-        harvest = db.Harvest()
-        harvest.service_id = ObjectId(service_id)
+    try:
+        with lease('harvest', service_id, run_id=run_id, shard=shard):
+            # Get the harvest or make a new one
+            skeleton = dict(db.Harvest())
+            skeleton.pop('service_id', None)
+            try:
+                db.harvests.update({'service_id': service_id}, {'$setOnInsert': skeleton}, upsert=True)
+            except DuplicateKeyError:
+                # another shard of the run created it
+                pass
+            harvest = db.Harvest.find_one({'service_id': service_id})
 
-    harvest.harvest(ignore_active=ignore_active)
-    harvest.save()
-    return harvest.harvest_status
+            started = datetime.utcnow()
+            harvest.harvest(ignore_active=ignore_active, shard=shard, shards=shards)
+            harvest.schedule_next()
+            harvest.save_run(started, run_id)
+            return harvest.harvest_status
+    except LeaseUnavailable:
+        app.logger.info("Harvest of %s already running, skipping", service_id)
+        return "Harvest already running"
+    finally:
+        if batch_id is not None:
+            from ioos_catalog.tasks.planner import batch_job_done
+            batch_job_done(batch_id)
 
 
 
@@ -230,6 +247,24 @@ def unicode_or_none(thing):
         return None
 
 
+# what is accounted per phase in a harvest's profile
+PROFILE_FIELDS = ('seconds', 'bytes', 'count', 'requests', 'retries')
+
+# changed datasets whose map features a harvest refreshes at once
+MAP_REFRESH_BATCH = 100
+
+# bookkeeping fields of a dataset service entry that don't describe its content
+SERVICE_ENTRY_VOLATILE = ('created', 'updated', 'digest', 'active')
+
+def service_entry_digest(service):
+    """
+    Returns a stable digest of a dataset service entry, ignoring its
+    timestamps, used to skip rewriting datasets whose content is unchanged.
+    """
+    content = {k: v for k, v in service.iteritems() if k not in SERVICE_ENTRY_VOLATILE}
+    return content_digest(json.dumps(content, sort_keys=True, default=json_util.default))
+
+
 def get_common_name(data_type):
     """Map names from various standards to return a human readable form"""
     # TODO: should probably split this into DAP and SOS specific mappings
@@ -264,128 +299,313 @@ def get_common_name(data_type):
 class Harvester(object):
     def __init__(self, service):
         self.service = service
+        # compliance checker/metamap hand-off statistics for this harvest
+        self.ccheck_hits   = 0
+        self.ccheck_misses = 0
+        # dataset writes of this harvest
+        self.datasets_changed   = 0
+        self.datasets_unchanged = 0
+        # changed datasets whose map features aren't refreshed yet
+        self.map_pending        = []
+        # phase name -> seconds, bytes, count, requests and retries spent
+        # in that phase of this harvest
+        self.profile = {}
+
+    def record(self, name, **amounts):
+        """
+        Adds amounts (seconds, bytes, count, requests, retries) to the named
+        harvest phase.
+        """
+        stats = self.profile.setdefault(name, dict.fromkeys(PROFILE_FIELDS, 0))
+        for field, amount in amounts.iteritems():
+            stats[field] += amount
+        return stats
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Accounts the time spent in the block to the named harvest phase.
+        Yields the phase's stats so the block can add bytes or requests.
+        """
+        stats = self.record(name, count=1)
+        start = time.time()
+        try:
+            yield stats
+        finally:
+            stats['seconds'] += time.time() - start
+
+    def ccheck_cache_summary(self):
+        """
+        Returns a short message describing the compliance checker cache hit
+        rate for this harvest.
+        """
+        total = self.ccheck_hits + self.ccheck_misses
+        if total == 0:
+            return u''
+        return u'Compliance checker cache: %s/%s hits (%.0f%%), %s queued' % (self.ccheck_hits, total, 100.0 * self.ccheck_hits / total, self.ccheck_misses)
+
+    def queue_ccheck(self, ref_id, digest, task, *args):
+        """
+        Hands a fetched metadata document, identified by its content digest,
+        off to the ccheck stage, unless the Metadata record of ref_id was
+        already generated from the same input by the same checker versions.
+        """
+        key = ccheck_key(digest)
+        if is_current(self.service.get('_id'), 'ioos', ref_id, key):
+            self.ccheck_hits += 1
+            return None
 
-    @context_decorator
-    def save_ccheck_and_metadata(self, service_id, checker_name, ref_id, ref_type, scores, metamap):
+        self.ccheck_misses += 1
+        return queue_ccheck(task, self.service.get('_id'), ref_id, key, *args)
+
+    def dataset_write_summary(self):
+        """
+        Returns a short message describing how many datasets this harvest
+        changed.
         """
-        Saves the result of a compliance checker scores and metamap document.
+        total = self.datasets_changed + self.datasets_unchanged
+        if total == 0:
+            return u''
+        return u'Datasets: %s changed, %s unchanged' % (self.datasets_changed, self.datasets_unchanged)
 
-        Will be called by service/station derived methods.
+    def harvest_summary(self):
+        return u'\n'.join(m for m in (self.dataset_write_summary(),
+                                      self.ccheck_cache_summary()) if m)
+
+    def refresh_map(self):
+        """
+        Refreshes the map features of the datasets changed so far.
         """
-        if not (scores or metamap):
+        if not self.map_pending:
             return
+        with self.phase('map'):
+            refresh_features(self.map_pending)
+        self.map_pending = []
 
-        def res2dict(r):
-            cl = []
-            if getattr(r, 'children', None):
-                cl = map(res2dict, r.children)
-
-            return {'name'     : unicode(r.name),
-                    'score'    : float(r.value[0]),
-                    'maxscore' : float(r.value[1]),
-                    'weight'   : int(r.weight),
-                    'children' : cl}
-
-        metadata = db.Metadata.find_one({'ref_id': ref_id})
-        if metadata is None:
-            metadata             = db.Metadata()
-            metadata.ref_id      = ref_id
-            metadata.ref_type    = unicode(ref_type)
-
-        if isinstance(scores, tuple): # New API of compliance-checker
-            scores = scores[0]
-        cc_results = map(res2dict, scores)
-
-        # @TODO: srsly need to decouple from cchecker
-        score     = sum(((float(r.value[0])/r.value[1]) * r.weight for r in scores))
-        max_score = sum((r.weight for r in scores))
-
-        score_doc = {'score'     : float(score),
-                     'max_score' : float(max_score),
-                     'pct'       : float(score) / max_score}
-
-        update_doc = {'cc_score'   : score_doc,
-                      'cc_results' : cc_results,
-                      'metamap'    : metamap}
-
-        for mr in metadata.metadata:
-            if mr['service_id'] == service_id and mr['checker'] == checker_name:
-                mr.update(update_doc)
-                break
-        else:
-            metarecord = {'service_id': service_id,
-                          'checker'   : unicode(checker_name)}
-            metarecord.update(update_doc)
-            metadata.metadata.append(metarecord)
+    def save_service_entry(self, dataset, service, metadata_text):
+        """
+        Replaces this service's entry in dataset.services with service, whose
+        metadata document is metadata_text.
+
+        The dataset is only written (and its 'updated' time bumped) when the
+        entry's digest differs from the stored one. Returns True if the
+        dataset was changed.
+        """
+        service['metadata_hash'] = db.MetadataBlob.digest(metadata_text) if metadata_text else None
+        service['digest'] = service_entry_digest(service)
+        # kept up to date by tasks.activation afterwards
+        service['active'] = bool(self.service.get('active'))
+
+        old_entries = [d for d in dataset.services if d['service_id'] == self.service.get('_id')]
+        if dataset.get('_id') is not None and [d.get('digest') for d in old_entries] == [service['digest']]:
+            self.datasets_unchanged += 1
+            return False
+
+        with self.phase('mongo'):
+            if metadata_text:
+                service['metadata_hash'] = db.MetadataBlob.put(metadata_text)
+                if service['metadata_hash'] is None:
+                    service['messages'].append(u'Metadata document was too large to store (len: %s)' % len(metadata_text))
+
+            # Find service reference in Dataset.services and remove (to replace it)
+            for d in old_entries:
+                dataset.services.remove(d)
 
-        metadata.updated = datetime.utcnow()
-        metadata.save()
+            now = datetime.utcnow()
+            service['updated'] = now
+            dataset.services.append(service)
+            dataset.updated = now
+            if service['active']:
+                dataset['active'] = True
+            dataset.save()
+            db.MetadataBlob.release_services(old_entries)
 
-        return metadata
+        self.datasets_changed += 1
+        self.map_pending.append(dataset._id)
+        if len(self.map_pending) >= MAP_REFRESH_BATCH:
+            self.refresh_map()
+        return True
+
+# DescribeSensor outputFormats, in order of preference
+DESCRIBE_SENSOR_FORMATS = ['text/xml;subtype="sensorML/1.0.1/profiles/ioos_sos/1.0"',
+                           'text/xml;subtype="om/1.0.0/profiles/ioos_sos/1.0"',
+                           'text/xml;subtype="sensorML/1.0.1"']
 
 class SosHarvest(Harvester):
-    def __init__(self, service):
+    def __init__(self, service, shard=None, shards=1):
         Harvester.__init__(self, service)
+        # DescribeSensor outputFormat that works for this server
+        self.output_format = None
+        # this harvest only processes the stations of its shard
+        self.shard      = shard
+        self.shards     = shards
+        self.checkpoint = HarvestCheckpoint(service.get('_id'), shards)
+        # stations skipped because an interrupted run already processed them
+        self.resumed    = 0
+
+    def harvest_summary(self):
+        messages = [Harvester.harvest_summary(self)]
+        if self.shards > 1:
+            messages.append(u'Shard %s/%s' % ((self.shard or 0) + 1, self.shards))
+        if self.resumed:
+            messages.append(u'Resumed an interrupted harvest, skipped %s already processed stations' % self.resumed)
+        return u'\n'.join(m for m in messages if m)
+
+    def harvest_station(self, uid, offering, outcomes):
+        """
+        Processes a station of this harvest's shard unless an interrupted run
+        already did, recording its outcome in the checkpoint.
+        """
+        if not in_shard(uid, self.shard, self.shards):
+            return
+        if uid in outcomes:
+            self.resumed += 1
+            return
 
-    def _handle_ows_exception(self, **kwargs):
         try:
-            return self.sos.describe_sensor(**kwargs)
-        except ows.ExceptionReport as e:
-            if e.code == 'InvalidParameterValue':
-                # TODO: use SOS getCaps to determine valid formats
-                # some only work with plain SensorML as the format
+            result = self.process_station(uid, offering)
+        except JobTimeoutException:
+            # the run ran out of time, the resumed run retries the station
+            raise
+        except Exception as e:
+            # don't retry a failing station when resuming
+            self.checkpoint.record(uid, u'failed: %s' % e)
+            raise
+        self.checkpoint.record(uid, u'ok' if result else u'skipped')
 
-                # see if O&M will work instead
-                try:
-                    kwargs['outputFormat'] = 'text/xml;subtype="om/1.0.0/profiles/ioos_sos/1.0"'
-                    return self.sos.describe_sensor(**kwargs)
-
-                # see if plain sensorml wll work
-                except ows.ExceptionReport as e:
-                    # if this fails, just raise the exception without handling
-                    # here
-                    kwargs['outputFormat'] = 'text/xml;subtype="sensorML/1.0.1"'
-                    return self.sos.describe_sensor(**kwargs)
-            elif e.msg == 'No data found for this station':
-                raise e
-
-    def _describe_sensor(self, uid, timeout=120,
-                         outputFormat='text/xml;subtype="sensorML/1.0.1/profiles/ioos_sos/1.0"'):
+    def describe_sensor(self, outputFormat, procedure, timeout=None, parse=None,
+                        phase='describe_sensor'):
+        """
+        Issues a SOS 1.0.0 DescribeSensor GET request, accounted to the named
+        profile phase.
+
+        Without a parse function the response document is returned as a
+        string. Otherwise the response is streamed to a temporary file and
+        the result of parse(file) is returned, which lets large network
+        documents be parsed incrementally.
+
+        Raises ows.ExceptionReport if the server returns an exception report.
+        """
+        url = self.capabilities.operation_url('DescribeSensor', self.service.get('url').split('?')[0])
+        params = {'service'      : 'SOS',
+                  'version'      : '1.0.0',
+                  'request'      : 'DescribeSensor',
+                  'outputFormat' : outputFormat,
+                  'procedure'    : procedure}
+
+        if parse is not None:
+            with self.phase(phase) as stats:
+                stats['requests'] += 1
+                with fetch_document(url, params=params, timeout=timeout) as doc:
+                    stats['bytes'] += doc.size
+                    return parse(doc.file)
+
+        with self.phase(phase) as stats:
+            stats['requests'] += 1
+            response = requests.get(url, params=params, timeout=timeout)
+            stats['bytes'] += len(response.content)
+        if response.status_code not in (200, 400):
+            response.raise_for_status()
+
+        tr = etree.fromstring(response.content)
+        if tr.tag == "{%s}ExceptionReport" % OWS_NS:
+            raise ows.ExceptionReport(tr)
+
+        return response.content
+
+    def output_formats(self):
         """
-        Issues a DescribeSensor request with fallback behavior for oddly-acting SOS servers.
+        Returns the DescribeSensor outputFormats to try, in order: the one
+        learned for this server first, then the IOOS SensorML profile, the
+        O&M profile and plain SensorML.
         """
-        kwargs = {
-                    'outputFormat': outputFormat,
-                    'procedure': uid,
-                    'timeout': timeout
-                 }
+        learned = self.output_format
+        return [learned] + [f for f in DESCRIBE_SENSOR_FORMATS if f != learned]
 
-        return self._handle_ows_exception(**kwargs)
+    def learn_output_format(self, output_format):
+        """
+        Remembers the outputFormat that works for this server, on the
+        Service so later harvests start with it.
+        """
+        if output_format == self.output_format:
+            return
+        app.logger.info("Using DescribeSensor outputFormat %s for %s", output_format, self.service.get('url'))
+        self.output_format = output_format
+        db.services.update({'_id': self.service.get('_id')},
+                           {'$set': {'describe_sensor_format': unicode(output_format)}})
+
+    def seed_output_format(self):
+        """
+        Starts from the outputFormat learned by a previous harvest or, when
+        there is none, the preferred format advertised in GetCapabilities, or
+        the server's first one if it spells none of them like we do.
+        """
+        self.output_format = self.service.get('describe_sensor_format')
+        if self.output_format is None:
+            advertised = self.capabilities.parameter_values('DescribeSensor', 'outputFormat')
+            self.output_format = next((f for f in DESCRIBE_SENSOR_FORMATS if f in advertised),
+                                      advertised[0] if advertised else DESCRIBE_SENSOR_FORMATS[0])
 
+    def _describe_sensor(self, uid, timeout=120, parse=None):
+        """
+        Issues a DescribeSensor request with fallback behavior for oddly-acting
+        SOS servers. Servers rejecting an outputFormat with an
+        InvalidParameterValue are retried with the next format, and the first
+        one that works is used for the following requests.
+        """
+        phase = 'network' if parse is not None else 'describe_sensor'
 
-    def harvest(self):
-        self.sos = SensorObservationService(self.service.get('url'))
+        formats = self.output_formats()
+        for i, output_format in enumerate(formats):
+            try:
+                result = self.describe_sensor(output_format, uid, timeout=timeout,
+                                              parse=parse, phase=phase)
+            except ows.ExceptionReport as e:
+                # if the last format fails, just raise the exception without
+                # handling here
+                if e.code == 'InvalidParameterValue' and i < len(formats) - 1:
+                    self.record(phase, retries=1)
+                    continue
+                elif e.code == 'InvalidParameterValue' or e.msg == 'No data found for this station':
+                    raise
+                return None
 
-        scores   = self.ccheck_service()
-        metamap  = self.metamap_service()
-        try:
-            self.save_ccheck_service('ioos', scores, metamap)
-        finally:
-        #except Exception as e:
-            #app.logger.warn("could not save compliancecheck/metamap information: %s", e)
-            pass
+            self.learn_output_format(output_format)
+            return result
 
-        # List storing the stations that have already been processed in this SOS server.
+    def harvest(self):
+        # GetCapabilities documents can be huge, stream and parse them
+        # incrementally instead of building the whole tree
+        with self.phase('capabilities') as stats:
+            stats['requests'] += 1
+            with fetch_document(capabilities_url(self.service.get('url')), timeout=120) as caps_doc:
+                stats['bytes'] += caps_doc.size
+                self.capabilities = parse_capabilities(caps_doc.file)
+        self.seed_output_format()
+
+        # the ccheck stage fetches the document itself, the digest tells
+        # whether it needs to
+        if not self.shard:
+            self.queue_ccheck(self.service._id,
+                              caps_doc.digest,
+                              ccheck_capabilities_task,
+                              self.service.get('url'))
+
+        # stations processed by an interrupted run of this harvest
+        outcomes = self.checkpoint.outcomes()
+
+        # Stations that have already been processed in this SOS server.
         # This is kept and checked later to avoid servers that have the same stations in many offerings.
-        processed = []
+        processed = set()
 
+        offerings = self.capabilities.offerings
         # handle network:all by increasing max timeout
-        net_len = len(self.sos.offerings)
+        net_len = len(offerings)
         net_timeout = 120 if net_len <= 36 else 5 * net_len
 
         # allow searching child offerings for by name for network offerings
-        name_lookup = {o.name: o for o in self.sos.offerings}
-        for offering in self.sos.offerings:
+        name_lookup = {o.name: o for o in offerings}
+        for offering in offerings:
             # TODO: We assume an offering should only have one procedure here
             # which will be the case in sos 2.0, but may not be the case right now
             # on some non IOOS supported servers.
@@ -397,26 +617,62 @@ class SosHarvest(Harvester):
             if len(sp_uid) > 2 and sp_uid[2] == "network": # Network Offering
                 if uid[-3:].lower() == 'all':
                     continue # Skip the all
-                net = self._describe_sensor(uid, timeout=net_timeout)
+                procedures = self._describe_sensor(uid, timeout=net_timeout,
+                                                   parse=network_procedures) or []
 
-                network_ds = IoosDescribeSensor(net)
                 # Iterate over stations in the network and process them individually
+                for proc in procedures:
 
-                for proc in network_ds.procedures:
-
-                    if proc is not None and proc.split(":")[2] == "station":
+                    if len(proc.split(":")) > 2 and proc.split(":")[2] == "station":
                         if not proc in processed:
                             # offering associated with this procedure
                             proc_off = name_lookup.get(proc)
-                            self.process_station(proc, proc_off)
-                        processed.append(proc)
+                            self.harvest_station(proc, proc_off, outcomes)
+                        processed.add(proc)
             else:
                 # Station Offering, or malformed urn - try it anyway as if it is a station
                 if not uid in processed:
-                    self.process_station(uid, offering)
-                processed.append(uid)
+                    self.harvest_station(uid, offering, outcomes)
+                processed.add(uid)
+
+        self.checkpoint.shard_done(self.shard)
+
+
+    def station_geojson(self, station_ds, messages):
+        """
+        Returns the GeoJSON of a station's GML location
+        """
+        GML_NS = "http://www.opengis.net/gml"
+
+        gj = None
+        loc = station_ds.location
+        if loc is not None and loc.tag == "{%s}Point" % GML_NS:
+            pos_element = loc.find("{%s}pos" % GML_NS)
+            # some older responses may uses the deprecated coordinates
+            # element
+            if pos_element is None:
+                # if pos not found use deprecated coordinates element
+                pos_element = loc.find("{%s}coordinates" % GML_NS)
+            # strip out points
+            positions = map(float, pos_element.text.split(" "))
+
+            for el in [pos_element, loc]:
+                srs_name = testXMLAttribute(el, "srsName")
+                if srs_name:
+                    crs = Crs(srs_name)
+                    if crs.axisorder == "yx":
+                        gj = json.loads(geojson.dumps(geojson.Point([positions[1], positions[0]])))
+                    else:
+                        gj = json.loads(geojson.dumps(geojson.Point([positions[0], positions[1]])))
+                    break
+            else:
+                if positions:
+                    messages.append(u"Position(s) found but could not parse SRS: %s, %s" % (positions, srs_name))
 
+        else:
+            messages.append(u"Found an unrecognized child of the sml:location element and did not attempt to process it: %s" % loc)
 
+        return gj
 
     def process_station(self, uid, offering):
         """ Makes a DescribeSensor request based on a 'uid' parameter being a
@@ -434,14 +690,16 @@ class SosHarvest(Harvester):
             if desc_sens is None:
                 app.logger.warn("Could not get a valid describeSensor response")
                 return
-            metadata_value = etree.fromstring(desc_sens)
-            sensor_ml = SensorML(metadata_value)
-            try:
-                station_ds = IoosDescribeSensor(metadata_value)
-            # if this doesn't conform to IOOS SensorML sub, fall back to
-            # manually picking apart the SensorML
-            except ows.ExceptionReport:
-                station_ds = process_sensorml(sensor_ml.members[0])
+            with self.phase('parse') as stats:
+                stats['bytes'] += len(desc_sens)
+                metadata_value = etree.fromstring(desc_sens)
+                sensor_ml = SensorML(metadata_value)
+                try:
+                    station_ds = IoosDescribeSensor(metadata_value)
+                # if this doesn't conform to IOOS SensorML sub, fall back to
+                # manually picking apart the SensorML
+                except ows.ExceptionReport:
+                    station_ds = process_sensorml(sensor_ml.members[0])
 
             unique_id = station_ds.id
             if unique_id is None:
@@ -454,12 +712,6 @@ class SosHarvest(Harvester):
                 dataset.uid = unicode(unique_id)
                 dataset['active'] = True
 
-            # Find service reference in Dataset.services and remove (to replace it)
-            tmp = dataset.services[:]
-            for d in tmp:
-                if d['service_id'] == self.service.get('_id'):
-                    dataset.services.remove(d)
-
             # Parsing messages
             messages = []
 
@@ -480,38 +732,10 @@ class SosHarvest(Harvester):
                 messages.append(u"Could not get a 'platformType' from the SensorML identifiers.  Looking for a definition of 'http://mmisw.org/ont/ioos/definition/platformType'")
 
             # LOCATION is in GML
-            gj = None
-            loc = station_ds.location
-            if loc is not None and loc.tag == "{%s}Point" % GML_NS:
-                pos_element = loc.find("{%s}pos" % GML_NS)
-                # some older responses may uses the deprecated coordinates
-                # element
-                if pos_element is None:
-                    # if pos not found use deprecated coordinates element
-                    pos_element = loc.find("{%s}coordinates" % GML_NS)
-                # strip out points
-                positions = map(float, pos_element.text.split(" "))
-
-                for el in [pos_element, loc]:
-                    srs_name = testXMLAttribute(el, "srsName")
-                    if srs_name:
-                        crs = Crs(srs_name)
-                        if crs.axisorder == "yx":
-                            gj = json.loads(geojson.dumps(geojson.Point([positions[1], positions[0]])))
-                        else:
-                            gj = json.loads(geojson.dumps(geojson.Point([positions[0], positions[1]])))
-                        break
-                else:
-                    if positions:
-                        messages.append(u"Position(s) found but could not parse SRS: %s, %s" % (positions, srs_name))
-
-            else:
-                messages.append(u"Found an unrecognized child of the sml:location element and did not attempt to process it: %s" % loc)
+            with self.phase('geometry'):
+                gj = self.station_geojson(station_ds, messages)
 
             meta_str = unicode(etree.tostring(metadata_value)).strip()
-            if len(meta_str) > 4000000:
-                messages.append(u'Metadata document was too large to store (len: %s)' % len(meta_str))
-                meta_str = u''
 
             service = {
                 # Reset service
@@ -521,7 +745,6 @@ class SosHarvest(Harvester):
                 'service_id'        : ObjectId(self.service.get('_id')),
                 'data_provider'     : self.service.get('data_provider'),
                 'metadata_type'     : u'sensorml',
-                'metadata_value'    : u'',
                 'time_min': getattr(offering, 'begin_position', None),
                 'time_max': getattr(offering, 'end_position', None),
                 'messages'          : map(unicode, messages),
@@ -529,110 +752,21 @@ class SosHarvest(Harvester):
                 'variables'         : map(unicode, sorted(station_ds.variables)),
                 'asset_type'        : get_common_name(asset_type),
                 'geojson'           : gj,
-                'updated'           : datetime.utcnow()
             }
 
-            dataset.services.append(service)
-            dataset.updated = datetime.utcnow()
-            dataset.save()
-
-            # do compliance checker / metadata now
-            scores = self.ccheck_station(sensor_ml)
-            metamap = self.metamap_station(sensor_ml)
+            self.save_service_entry(dataset, service, meta_str)
 
+            # hand off to the compliance checker / metadata stage
             try:
-                self.save_ccheck_station('ioos', dataset._id, scores, metamap)
+                self.queue_ccheck(dataset._id,
+                                  content_digest(desc_sens),
+                                  ccheck_sensorml_task,
+                                  desc_sens)
             except Exception as e:
-                app.logger.warn("could not save compliancecheck/metamap information: %s", e)
+                app.logger.warn("could not queue compliancecheck/metamap: %s", e)
 
             return "Harvest Successful"
 
-    def ccheck_service(self):
-        assert self.sos
-
-        with app.app_context():
-
-            scores = None
-
-            try:
-                cs = ComplianceCheckerCheckSuite()
-                groups = cs.run(self.sos, 'ioos')
-                scores = groups['ioos']
-            except Exception as e:
-                app.logger.warn("Caught exception doing Compliance Checker on SOS service: %s", e)
-
-            return scores
-
-    def metamap_service(self):
-        assert self.sos
-
-        with app.app_context():
-            # gets a metamap document of this service using wicken
-            beliefs = IOOSSOSGCCheck.beliefs()
-            doc = MultipleXmlDogma('sos-gc', beliefs, self.sos._capabilities, namespaces=get_namespaces())
-
-            # now make a map out of this
-            # @TODO wicken should make this easier
-            metamap = {}
-            for k in beliefs:
-                try:
-                    metamap[k] = getattr(doc, doc._fixup_belief(k)[0])
-                except Exception as e:
-                    pass
-
-            return metamap
-
-    def save_ccheck_service(self, checker_name, scores, metamap):
-        """
-        Saves the result of ccheck_service and metamap
-        """
-        return self.save_ccheck_and_metadata(self.service._id,
-                                             checker_name,
-                                             self.service._id,
-                                             u'service',
-                                             scores,
-                                             metamap)
-
-    def ccheck_station(self, sensor_ml):
-        with app.app_context():
-            scores = None
-            try:
-                cs = ComplianceCheckerCheckSuite()
-                groups = cs.run(sensor_ml, 'ioos')
-                scores = groups['ioos']
-            except Exception as e:
-                app.logger.warn("Caught exception doing Compliance Checker on SOS station: %s", e)
-
-            return scores
-
-    def metamap_station(self, sensor_ml):
-        with app.app_context():
-            # gets a metamap document of this service using wicken
-            beliefs = IOOSSOSDSCheck.beliefs()
-            doc = MultipleXmlDogma('sos-ds', beliefs, sensor_ml._root, namespaces=get_namespaces())
-
-            # now make a map out of this
-            # @TODO wicken should make this easier
-            metamap = {}
-            for k in beliefs:
-                try:
-                    metamap[k] = getattr(doc, doc._fixup_belief(k)[0])
-                except Exception as e:
-                    pass
-
-            return metamap
-
-    def save_ccheck_station(self, checker_name, dataset_id, scores, metamap):
-        """
-        Saves the result of ccheck_station and metamap
-        """
-        return self.save_ccheck_and_metadata(self.service._id,
-                                             checker_name,
-                                             dataset_id,
-                                             u'dataset',
-                                             scores,
-                                             metamap)
-
 class WmsHarvest(Harvester):
     def __init__(self, service):
         Harvester.__init__(self, service)
@@ -813,7 +947,9 @@ class DapHarvest(Harvester):
         """
 
         try:
-            cd = CommonDataset.open(self.service.get('url'))
+            with self.phase('open') as stats:
+                stats['requests'] += 1
+                cd = CommonDataset.open(self.service.get('url'))
         except Exception as e:
             app.logger.error("Could not open DAP dataset from '%s'\n"
                              "Exception %s: %s" % (self.service.get('url'),
@@ -822,6 +958,7 @@ class DapHarvest(Harvester):
 
         # rely on times in the file first over global atts for calculating
         # start/end times of dataset.
+        time_start = time.time()
         tmin, tmax = self.get_min_max_time(cd)
         # if nothing was returned, try to get from global atts
         if (tmin == None and tmax == None and
@@ -832,6 +969,7 @@ class DapHarvest(Harvester):
                                    ('time_coverage_start', 'time_coverage_end'))
             except ValueError:
                 tmin, tmax = None, None
+        self.record('time', seconds=time.time() - time_start, count=1)
         # For DAP, the unique ID is the URL
         unique_id = self.service.get('url')
 
@@ -842,12 +980,6 @@ class DapHarvest(Harvester):
                 dataset.uid = unicode(unique_id)
                 dataset['active'] = True
 
-        # Find service reference in Dataset.services and remove (to replace it)
-        tmp = dataset.services[:]
-        for d in tmp:
-            if d['service_id'] == self.service.get('_id'):
-                dataset.services.remove(d)
-
         # Parsing messages
         messages = []
 
@@ -910,6 +1042,7 @@ class DapHarvest(Harvester):
         """
 
         # LOCATION (from Paegan)
+        geometry_start = time.time()
         # Try POLYGON and fall back to BBOX
 
         # paegan does not support ugrid, so try to detect this condition and skip
@@ -995,7 +1128,7 @@ class DapHarvest(Harvester):
             for v in itertools.chain(std_variables, non_std_variables):
                 try:
                     gj = mapping(cd.getboundingpolygon(var=v, **axis_names
-                                                       ).simplify(0.5))
+                                                       ).simplify(app.config.get('DAP_SIMPLIFY_TOLERANCE', 0.5)))
                 except (AttributeError, AssertionError, ValueError,
                         KeyError, IndexError):
                     try:
@@ -1024,6 +1157,7 @@ class DapHarvest(Harvester):
                 messages.append(u"The underlying 'Paegan' data access library could not determine a bounding POLYGON for this dataset.")
                 messages.append(u"Failed to calculate geometry using all of the following variables: %s" % ", ".join(itertools.chain(std_variables, non_std_variables)))
 
+        self.record('geometry', seconds=time.time() - geometry_start, count=1)
 
 
 
@@ -1038,6 +1172,12 @@ class DapHarvest(Harvester):
         else:
             final_var_names = non_std_variables + list(map(unicode, ["%s%s" % (prefix, cd.nc.variables[x].getncattr("standard_name")) for x in std_variables]))
 
+        # the NcML header (attributes, dimensions, variables) is also the
+        # input fingerprint for the compliance checker cache
+        with self.phase('ncml') as stats:
+            ncml = unicode(dataset2ncml(cd.nc, url=self.service.get('url')))
+            stats['bytes'] += len(ncml)
+
         service = {
             'name':           name,
             'description':    description,
@@ -1045,7 +1185,6 @@ class DapHarvest(Harvester):
             'service_id':     ObjectId(self.service.get('_id')),
             'data_provider':  self.service.get('data_provider'),
             'metadata_type':  u'ncml',
-            'metadata_value': unicode(dataset2ncml(cd.nc, url=self.service.get('url'))),
             'time_min': tmin,
             'time_max': tmax,
             'messages':       map(unicode, messages),
@@ -1053,89 +1192,21 @@ class DapHarvest(Harvester):
             'variables':      map(unicode, final_var_names),
             'asset_type':     get_common_name(DapHarvest.get_asset_type(cd)),
             'geojson':        gj,
-            'updated':        datetime.utcnow()
         }
 
         with app.app_context():
-            dataset.services.append(service)
-            dataset.updated = datetime.utcnow()
-            dataset.save()
-
-        ncdataset = Dataset(self.service.get('url'))
-        scores = self.ccheck_dataset(ncdataset)
-        metamap = self.metamap_dataset(ncdataset)
+            self.save_service_entry(dataset, service, ncml)
 
         try:
-            metadata_rec = self.save_ccheck_dataset('ioos', dataset._id, scores, metamap)
+            self.queue_ccheck(dataset._id,
+                              content_digest(ncml),
+                              ccheck_netcdf_task,
+                              self.service.get('url'))
         except Exception as e:
-            metadata_rec = None
-            app.logger.error("could not save compliancecheck/metamap information", exc_info=True)
+            app.logger.error("could not queue compliancecheck/metamap", exc_info=True)
 
         return "Harvested"
 
-    def ccheck_dataset(self, ncdataset):
-        with app.app_context():
-            scores = None
-            try:
-                cs = ComplianceCheckerCheckSuite()
-                groups = cs.run(ncdataset, 'ioos')
-                scores = groups['ioos']
-            except Exception as e:
-                app.logger.warn("Caught exception doing Compliance Checker on Dataset: %s", e)
-
-            return scores
-
-    def metamap_dataset(self, ncdataset):
-        with app.app_context():
-
-            # gets a metamap document of this service using wicken
-            beliefs = IOOSNCCheck.beliefs()
-            ncnamespaces = {'nc':pb_namespaces['ncml']}
-
-            doc = NetCDFDogma('nc', beliefs, ncdataset, namespaces=ncnamespaces)
-
-            # now make a map out of this
-            # @TODO wicken should make this easier
-
-            m_names, m_units = ['Variable Names*','Variable Units*']
-            metamap = {}
-            for k in beliefs:
-                try:
-                    metamap[k] = getattr(doc, doc._fixup_belief(k)[0])
-                except Exception as e:
-                    app.logger.exception("Problem setting belief (%s)", k)
-
-            metamap[m_names] = [] # Override the Wicken return to preserve the order
-            metamap[m_units] = [] # Override the Wicken return to preserve the order
-
-
-            # Wicken doesn't preserve the order between the names and the units,
-            # so what you wind up with is two lists that can't be related, but we
-            # want to keep the relationship between the name and the units
-
-            for k in ncdataset.variables.iterkeys():
-                var_name = k
-                standard_name = getattr(ncdataset.variables[k], 'standard_name', '')
-                units = getattr(ncdataset.variables[k], 'units', '')
-
-                # Only map metadata where we have all three
-                if var_name and standard_name and units:
-                    metamap[m_names].append('%s (%s)' % (var_name, standard_name))
-                    metamap[m_units].append(units)
-
-            return metamap
-
-    def save_ccheck_dataset(self, checker_name, dataset_id, scores, metamap):
-        """
-        Saves the result of ccheck_station and metamap
-        """
-        return self.save_ccheck_and_metadata(self.service._id,
-                                             checker_name,
-                                             dataset_id,
-                                             u'dataset',
-                                             scores,
-                                             metamap)
-
     @staticmethod
     def get_bbox_or_point(bbox):
         """
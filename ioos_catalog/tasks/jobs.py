@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+'''
+ioos_catalog/tasks/jobs.py
+
+Deduplication and mutual exclusion of per-service jobs (harvests, pings).
+
+Enqueueing is keyed by (task, service_id), or (task, service_id:shard) for
+the shards of a sharded harvest: while a job for the key is queued or
+running, further requests coalesce with it instead of queueing another
+job. Independently, a job holds a Redis lease on (task, service_id) while
+it runs, so the same task never runs concurrently for one service (ie. a
+manual harvest from the web interface while the nightly one is running).
+The shards of one run share the lease.
+'''
+
+import uuid
+from contextlib import contextmanager
+
+from rq.exceptions import NoSuchJobError
+from rq.job import Job, JobStatus, get_current_job
+from rq.utils import utcnow
+
+from ioos_catalog import app, redis_connection
+
+# Redis hash holding the coalesced/rejected counters
+STATS_KEY  = 'ioos_catalog:jobs:stats'
+# job id of the queued or running job for a (task, service_id)
+QUEUED_KEY = 'ioos_catalog:jobs:queued:%s:%s'
+# token of the run currently holding a (task, service_id), and the set of
+# its jobs (shards) holding it
+LEASE_KEY  = 'ioos_catalog:jobs:lease:%s:%s'
+HOLDERS_KEY = LEASE_KEY + ':holders'
+
+# how long a queued job may wait for a worker before it is no longer
+# coalesced with, on top of its own timeout
+QUEUED_TTL = 24 * 60 * 60
+DEFAULT_LEASE_TTL = 60 * 60
+
+# deletes a key only if it still holds the given value
+_delete_if_equal = redis_connection.register_script('''
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+''')
+
+# takes the lease KEYS[1] for the token ARGV[1], or joins it if the token
+# already holds it, adding the holder ARGV[2] to KEYS[2]; ARGV[3] is the ttl
+_acquire_lease = redis_connection.register_script('''
+local current = redis.call("get", KEYS[1])
+if current and current ~= ARGV[1] then
+    return 0
+end
+redis.call("set", KEYS[1], ARGV[1], "EX", ARGV[3])
+redis.call("sadd", KEYS[2], ARGV[2])
+redis.call("expire", KEYS[2], ARGV[3])
+return 1
+''')
+
+# removes the holder ARGV[2] of the token ARGV[1], releasing the lease when
+# it was the last one
+_release_lease = redis_connection.register_script('''
+if redis.call("get", KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call("srem", KEYS[2], ARGV[2])
+if redis.call("scard", KEYS[2]) == 0 then
+    redis.call("del", KEYS[1], KEYS[2])
+end
+return 1
+''')
+
+class LeaseUnavailable(Exception):
+    pass
+
+def get_stats():
+    '''
+    Returns the coalesced and rejected job counters
+    '''
+    stats = redis_connection.hgetall(STATS_KEY)
+    return {'coalesced' : int(stats.get('coalesced', 0)),
+            'rejected'  : int(stats.get('rejected', 0))}
+
+def is_pending(job_id):
+    '''
+    Returns True if the job is still queued or running
+    '''
+    if job_id is None or not Job.exists(job_id, connection=redis_connection):
+        return False
+    status = redis_connection.hget(Job.key_for(job_id), 'status')
+    return status not in (JobStatus.FINISHED, JobStatus.FAILED)
+
+def reserve(entries):
+    '''
+    Reserves the (task, service_id) keys for new jobs. entries is a list of
+    (task, service_id, job) tuples, where job is created but not yet
+    enqueued. Returns the list of entries whose job should be enqueued; the
+    others coalesce with the job already queued or running for the key.
+    '''
+    pipe = redis_connection.pipeline()
+    for task, service_id, job in entries:
+        pipe.set(QUEUED_KEY % (task, service_id), job.id, nx=True,
+                 ex=QUEUED_TTL + (job.timeout or 0))
+    reserved = pipe.execute()
+
+    accepted = []
+    for (task, service_id, job), ok in zip(entries, reserved):
+        key = QUEUED_KEY % (task, service_id)
+        if not ok:
+            # a job that died without clearing its key doesn't count
+            if is_pending(redis_connection.get(key)):
+                redis_connection.hincrby(STATS_KEY, 'coalesced', 1)
+                continue
+            redis_connection.set(key, job.id, ex=QUEUED_TTL + (job.timeout or 0))
+        accepted.append((task, service_id, job))
+    return accepted
+
+def enqueue_unique(target, task, func, service_id, timeout=None, kwargs=None):
+    '''
+    Enqueues func(service_id, **kwargs) on the target queue unless a job for
+    (task, service_id) is already queued or running. Returns the new job, or
+    the one the request was coalesced with (None if it has just finished).
+    '''
+    job = Job.create(func, args=(service_id,), kwargs=kwargs,
+                     connection=redis_connection, status=JobStatus.QUEUED,
+                     timeout=timeout)
+    if not reserve([(task, service_id, job)]):
+        job_id = redis_connection.get(QUEUED_KEY % (task, service_id))
+        try:
+            return Job.fetch(job_id, connection=redis_connection) if job_id else None
+        except NoSuchJobError:
+            return None
+    return target.enqueue_job(job)
+
+def push_jobs(target_jobs, pipe):
+    '''
+    Adds the writes enqueueing each (queue, job) to the pipeline
+    '''
+    for target, job in target_jobs:
+        job.origin = target.name
+        job.enqueued_at = utcnow()
+        job.save(pipeline=pipe)
+        pipe.sadd(target.redis_queues_keys, target.key)
+        pipe.rpush(target.key, job.id)
+
+def queued_key(service_id, shard=None):
+    '''
+    Returns the key jobs are coalesced by, per shard for sharded jobs
+    '''
+    if shard is None:
+        return service_id
+    return '%s:%s' % (service_id, shard)
+
+@contextmanager
+def lease(task, service_id, ttl=None, run_id=None, shard=None):
+    '''
+    Holds the lease of (task, service_id) while the block runs. Raises
+    LeaseUnavailable if another job holds it. The shards of a sharded run,
+    identified by the same run_id, hold it together.
+
+    The lease expires after ttl seconds, by default the timeout of the
+    current job, in case the holder dies without releasing it.
+    '''
+    job = get_current_job(connection=redis_connection)
+    if ttl is None:
+        ttl = (job.timeout if job is not None else None) or DEFAULT_LEASE_TTL
+
+    keys = [LEASE_KEY % (task, service_id), HOLDERS_KEY % (task, service_id)]
+    token = run_id or unicode(uuid.uuid4())
+    holder = shard or 0
+    if not _acquire_lease(keys=keys, args=[token, holder, int(ttl)]):
+        redis_connection.hincrby(STATS_KEY, 'rejected', 1)
+        raise LeaseUnavailable("%s is already running for %s" % (task, service_id))
+
+    try:
+        yield
+    finally:
+        _release_lease(keys=keys, args=[token, holder])
+        # requests from now on queue a new job
+        if job is not None:
+            _delete_if_equal(keys=[QUEUED_KEY % (task, queued_key(service_id, shard))], args=[job.id])
@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+'''
+ioos_catalog/tasks/map_features.py
+
+Keeps the features of the catalog map (models.map_feature) in line with
+the datasets. Harvests refresh the features of the datasets they change,
+and the GeoJSON of a provider's map (or of all providers, 'null') is
+serialized once and cached in Redis until one of its features changes.
+
+Cached documents are keyed by a generation number per provider, which
+refreshes increment once their features are written: a document built
+from features that were changing is never served after the change.
+
+Views of the map (a zoom level and bounding box) get the features in the
+box, with their geometries simplified to about a pixel at that zoom from
+precomputed resolutions. Below MAP_CLUSTER_ZOOM, points are clustered on a
+grid, coarser as needed to keep a view within MAP_FEATURE_BUDGET features;
+views over the budget at any zoom are clustered, other geometries too.
+'''
+
+import hashlib
+import json
+import math
+from collections import defaultdict
+from datetime import datetime
+
+from ioos_catalog import app, db, redis_connection
+from ioos_catalog.tasks.cleanup import chunks
+
+# Redis hash of provider -> generation of its map features
+GENERATION_KEY = 'ioos_catalog:map:generation'
+# Redis hash of the body and ETag of a provider's GeoJSON, per generation
+GEOJSON_KEY = 'ioos_catalog:map:geojson:%s:%s'
+# the map of all providers
+ALL_PROVIDERS = 'null'
+
+# the highest zoom level of each precomputed resolution; finer zooms get
+# the full geometry
+RESOLUTION_ZOOMS = [3, 6, 9]
+
+# the fields of the dataset service entries the features are built from
+DATASET_FIELDS = dict.fromkeys(['services.service_id', 'services.name', 'services.description',
+                                'services.data_provider', 'services.service_type',
+                                'services.variables', 'services.time_min', 'services.time_max',
+                                'services.geojson'], True)
+
+def pixel_degrees(zoom):
+    '''
+    Returns the width of a pixel, in degrees of longitude, at a zoom level
+    of 256 pixel tiles
+    '''
+    return 360.0 / (256 * 2 ** zoom)
+
+def resolution(zoom):
+    '''
+    Returns the index of the precomputed resolution for a zoom level, or
+    None for full resolution
+    '''
+    if zoom is None:
+        return None
+    for level, max_zoom in enumerate(RESOLUTION_ZOOMS):
+        if zoom <= max_zoom:
+            return level
+    return None
+
+def count_coordinates(coordinates):
+    '''
+    Returns the number of positions in GeoJSON coordinates
+    '''
+    if coordinates and isinstance(coordinates[0], (int, long, float)):
+        return 1
+    return sum(count_coordinates(c) for c in coordinates)
+
+def geometry_fields(feature):
+    '''
+    Returns the bounding box, point coordinates and simplified resolutions
+    of a GeoJSON Feature, as MapFeature fields
+    '''
+    # only the harvests build features, the web process doesn't load shapely
+    from shapely.geometry import shape, mapping
+
+    geometry = feature['geometry']
+    try:
+        geom = shape(geometry)
+        west, south, east, north = geom.bounds
+    except (ValueError, AttributeError, TypeError, KeyError, IndexError):
+        app.logger.warning("Invalid geometry of map feature %s", feature['properties'])
+        return {'simplified': [], 'point': None}
+
+    fields = {'west': west, 'south': south, 'east': east, 'north': north,
+              'point': list(geometry['coordinates'][:2]) if geometry['type'] == 'Point' else None,
+              'simplified': []}
+    if geometry['type'] in ('Point', 'MultiPoint') or 'coordinates' not in geometry:
+        return fields
+
+    # finest first, so each resolution is compared to the next finer one
+    finer = count_coordinates(geometry['coordinates'])
+    for max_zoom in reversed(RESOLUTION_ZOOMS):
+        try:
+            simplified = mapping(geom.simplify(pixel_degrees(max_zoom)))
+        except (ValueError, AttributeError, TypeError):
+            simplified = None
+        if simplified is None or not simplified.get('coordinates') or \
+                count_coordinates(simplified['coordinates']) >= finer:
+            fields['simplified'].insert(0, None)
+            continue
+        finer = count_coordinates(simplified['coordinates'])
+        fields['simplified'].insert(0, unicode(json.dumps(dict(feature, geometry=simplified))))
+    return fields
+
+def entry_features(dataset, service_names, now):
+    '''
+    Returns the MapFeature documents of a dataset's service entries that
+    have a location
+    '''
+    features = []
+    for idx, s in enumerate(dataset.get('services', [])):
+        if s.get('geojson') is None:
+            continue
+        if s['service_id'] not in service_names:
+            app.logger.critical("UNLINKED DATASET: %s", dataset['_id'])
+            continue
+        feature = {'type': 'Feature',
+                   'properties': {'id': str(dataset['_id']),
+                                  'sindex': idx,        # service index
+                                  'name': s.get('name'),
+                                  'service_name': service_names[s['service_id']],
+                                  'description': s.get('description')},
+                   'geometry': s['geojson']}
+        doc = {'dataset_id'    : dataset['_id'],
+               'sindex'        : idx,
+               'service_id'    : s['service_id'],
+               'data_provider' : s.get('data_provider'),
+               'service_type'  : s.get('service_type'),
+               'variables'     : s.get('variables') or [],
+               'time_min'      : s.get('time_min'),
+               'time_max'      : s.get('time_max'),
+               'feature'       : unicode(json.dumps(feature)),
+               'updated'       : now}
+        doc.update(geometry_fields(feature))
+        features.append(doc)
+    return features
+
+def invalidate(providers):
+    '''
+    Moves the maps of providers, and the map of all providers, to a new
+    generation
+    '''
+    pipe = redis_connection.pipeline()
+    for provider in set(p for p in providers if p) | set([ALL_PROVIDERS]):
+        pipe.hincrby(GENERATION_KEY, provider, 1)
+    pipe.execute()
+
+def refresh_features(dataset_ids):
+    '''
+    Rebuilds the map features of dataset_ids, removing those of entries and
+    datasets that no longer exist, and invalidates the maps they are on.
+    Returns the number of features written.
+    '''
+    written = 0
+    for ids in chunks(list(set(dataset_ids))):
+        now = datetime.utcnow()
+        providers = set(db.map_features.find({'dataset_id': {'$in': ids}}).distinct('data_provider'))
+
+        datasets = list(db.datasets.find({'_id': {'$in': ids}}, DATASET_FIELDS))
+        service_ids = list(set(s['service_id'] for d in datasets for s in d.get('services', [])))
+        names = {s['_id']: s.get('name') for s in db.services.find({'_id': {'$in': service_ids}}, {'name': True})}
+        features = [f for d in datasets for f in entry_features(d, names, now)]
+
+        if features:
+            bulk = db.map_features.initialize_unordered_bulk_op()
+            for f in features:
+                bulk.find({'dataset_id': f['dataset_id'], 'sindex': f['sindex']}).upsert().replace_one(f)
+            bulk.execute()
+        # the features not written now are gone
+        db.map_features.remove({'dataset_id': {'$in': ids}, 'updated': {'$lt': now}})
+
+        providers.update(f['data_provider'] for f in features)
+        invalidate(providers)
+        written += len(features)
+    return written
+
+def refresh_service(service_id):
+    '''
+    Refreshes the map features of a service's datasets, ie. after the
+    service was renamed
+    '''
+    with app.app_context():
+        features = list(db.map_features.find({'service_id': service_id}, {'dataset_id': True}))
+        return refresh_features([f['dataset_id'] for f in features])
+
+def remove_service(service_id):
+    '''
+    Removes the map features of a deleted service
+    '''
+    providers = db.map_features.find({'service_id': service_id}).distinct('data_provider')
+    db.map_features.remove({'service_id': service_id})
+    invalidate(providers)
+
+def rebuild_features():
+    '''
+    Rebuilds all map features, ie. to populate the collection, and removes
+    the ones of deleted datasets
+    '''
+    with app.app_context():
+        start = datetime.utcnow()
+        written = refresh_features([d['_id'] for d in db.datasets.find({}, {'_id': True})])
+
+        stale = {'updated': {'$lt': start}}
+        providers = db.map_features.find(stale).distinct('data_provider')
+        db.map_features.remove(stale)
+        invalidate(providers)
+
+        message = "Rebuilt %s map features" % written
+        app.logger.info(message)
+        return message
+
+def serialize(features):
+    body = u'{"type": "FeatureCollection", "features": [%s]}' % u', '.join(features)
+    return body.encode('utf-8')
+
+def feature_collection(query):
+    '''
+    Returns the GeoJSON FeatureCollection of the map features matching
+    query, serialized
+    '''
+    return serialize(f['feature'] for f in db.map_features.find(query, {'feature': True}))
+
+def bbox_query(west, south, east, north):
+    '''
+    Returns the query of the map features intersecting a bounding box. A box
+    crossing the antimeridian has west > east.
+    '''
+    query = {'south': {'$lte': north}, 'north': {'$gte': south}}
+    if west <= east:
+        query.update(west={'$lte': east}, east={'$gte': west})
+    else:
+        query['$or'] = [{'east': {'$gte': west}}, {'west': {'$lte': east}}]
+    return query
+
+def feature_at(feature, level):
+    '''
+    Returns the JSON of a map feature at a resolution
+    '''
+    if level is not None:
+        for simplified in feature.get('simplified', [])[level:]:
+            if simplified:
+                return simplified
+    return feature['feature']
+
+def cluster_points(points, cell, budget):
+    '''
+    Groups map features with point coordinates on a grid of cell degrees,
+    doubled until there are at most budget cells. Returns the JSON of the
+    features: lone points as they are, the others as a cluster Feature at
+    their mean location, with their count and bounding box.
+    '''
+    while True:
+        cells = defaultdict(list)
+        for p in points:
+            x, y = p['point']
+            if cell >= 360:
+                # the whole world, one cell
+                cells[(0, 0)].append(p)
+            else:
+                cells[(int(math.floor(x / cell)), int(math.floor(y / cell)))].append(p)
+        if len(cells) <= budget or cell >= 360:
+            break
+        cell *= 2
+
+    features = []
+    for key in sorted(cells):
+        members = cells[key]
+        if len(members) == 1:
+            features.append(members[0]['feature'])
+            continue
+        xs = [p['point'][0] for p in members]
+        ys = [p['point'][1] for p in members]
+        features.append(unicode(json.dumps({
+            'type': 'Feature',
+            'properties': {'cluster': True,
+                           'count': len(members),
+                           'bbox': [min(xs), min(ys), max(xs), max(ys)]},
+            'geometry': {'type': 'Point',
+                         'coordinates': [sum(xs) / len(xs), sum(ys) / len(ys)]}})))
+    return features
+
+def view_collection(query, zoom=None, bbox=None):
+    '''
+    Returns the GeoJSON FeatureCollection of the map features matching query
+    in a view of the map: within bbox (west, south, east, north), simplified
+    for zoom and, below MAP_CLUSTER_ZOOM, with points clustered, serialized.
+
+    A view has at most MAP_FEATURE_BUDGET features: over it, points are
+    clustered at any zoom, and once the other geometries take more than
+    half of it they are clustered too, at the center of their bounding box.
+    '''
+    query = dict(query)
+    if bbox is not None:
+        query.update(bbox_query(*bbox))
+    level = resolution(zoom)
+    budget = app.config.get('MAP_FEATURE_BUDGET', 2000)
+    clustered = zoom is not None and zoom < app.config.get('MAP_CLUSTER_ZOOM', 9)
+
+    shapes = []
+    points = []
+    fields = dict.fromkeys(['feature', 'simplified', 'point', 'west', 'south', 'east', 'north'], True)
+    for f in db.map_features.find(query, fields):
+        (points if f.get('point') else shapes).append(f)
+
+    if not clustered and len(shapes) + len(points) <= budget:
+        return serialize(feature_at(f, level) for f in shapes + points)
+
+    if len(shapes) > budget / 2:
+        for f in shapes:
+            if f.get('west') is None:
+                continue
+            f['point'] = [(f['west'] + f['east']) / 2, (f['south'] + f['north']) / 2]
+            f['feature'] = feature_at(f, level)
+            points.append(f)
+        shapes = [f for f in shapes if not f.get('point')]
+
+    features = [feature_at(f, level) for f in shapes]
+    if points:
+        cell = pixel_degrees(zoom or 0) * app.config.get('MAP_CLUSTER_CELL', 60)
+        features.extend(cluster_points(points, cell, max(budget - len(features), 1)))
+    return serialize(features)
+
+def provider_geojson(provider):
+    '''
+    Returns the (body, ETag) of the GeoJSON of a provider's map, or of all
+    providers' for ALL_PROVIDERS, from the cache when it is current
+    '''
+    generation = redis_connection.hget(GENERATION_KEY, provider) or 0
+    key = GEOJSON_KEY % (provider, generation)
+    body, etag = redis_connection.hmget(key, ['body', 'etag'])
+    if body is None:
+        body = feature_collection({} if provider == ALL_PROVIDERS else {'data_provider': provider})
+        etag = hashlib.sha1(body).hexdigest()
+        pipe = redis_connection.pipeline()
+        pipe.hmset(key, {'body': body, 'etag': etag})
+        pipe.expire(key, app.config.get('MAP_GEOJSON_TTL', 86400))
+        pipe.execute()
+    return body, etag
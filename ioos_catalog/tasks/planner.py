@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+'''
+ioos_catalog/tasks/planner.py
+
+Plans and enqueues batches of harvest jobs. The inputs for every job
+(recent harvest durations, dataset counts) are fetched with a couple of
+queries for the whole batch, and the jobs are written to Redis in a single
+pipeline. The metric snapshot is taken once the last job of the batch is
+done rather than when the batch is queued.
+
+The scheduled run (hourly from cron) only queues the services that are
+due: never harvested, edited since their last harvest, or past the
+next_harvest time set from how often their harvests change anything.
+'''
+
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from itertools import izip_longest
+
+from rq.job import Job, JobStatus
+
+from ioos_catalog import app, db, queue, priority_queue, redis_connection
+from ioos_catalog.tasks.harvest import harvest, harvest_plan, harvest_key, add_counts
+from ioos_catalog.tasks.jobs import reserve, push_jobs
+
+# Redis counter of the unfinished jobs of a harvest batch
+BATCH_KEY = 'ioos_catalog:harvest_batch:%s'
+# batches whose jobs never all report back (ie. a killed worker) expire
+BATCH_TTL = 2 * 24 * 60 * 60
+# set while the daily metric snapshot is taken, so hourly runs take one a day
+COUNTS_KEY = 'ioos_catalog:harvest_counts'
+COUNTS_INTERVAL = 23 * 60 * 60
+
+def dataset_counts(service_ids):
+    '''
+    Returns a dict of service id -> number of datasets, in one aggregation
+    '''
+    counts = db.Dataset.aggregate([
+        {'$match'  : {'services.service_id': {'$in': service_ids}}},
+        {'$unwind' : '$services'},
+        {'$match'  : {'services.service_id': {'$in': service_ids}}},
+        {'$group'  : {'_id': '$services.service_id', 'count': {'$sum': 1}}}
+    ])
+    return {c['_id']: c['count'] for c in counts}
+
+def harvest_history(service_ids):
+    '''
+    Returns a dict of service id -> (recent harvest durations, whether the
+    last harvest failed), in one query
+    '''
+    harvests = db.harvests.find({'service_id': {'$in': service_ids}},
+                                {'service_id': True, 'harvest_successful': True,
+                                 'durations.total': True, 'durations.shards': True})
+    # sharded harvests record the duration of one shard
+    return {h['service_id']: ([d['total'] * d.get('shards', 1) for d in h.get('durations', [])],
+                              h.get('harvest_successful') is False)
+            for h in harvests}
+
+def due_services(services, now=None):
+    '''
+    Returns the services due for a harvest, most urgent first: never
+    harvested, then edited since the last harvest, then by how long they
+    are overdue
+    '''
+    now = now or datetime.utcnow()
+    harvests = {h['service_id']: h for h in
+                db.harvests.find({'service_id': {'$in': [s['_id'] for s in services]}},
+                                 {'service_id': True, 'harvest_date': True, 'next_harvest': True})}
+    due = []
+    for s in services:
+        h = harvests.get(s['_id'], {})
+        last, next_harvest = h.get('harvest_date'), h.get('next_harvest')
+        if last is None:
+            due.append(((0, None), s))
+        elif s.get('updated') and s['updated'] > last:
+            due.append(((1, s['updated']), s))
+        elif next_harvest is None or next_harvest <= now:
+            due.append(((2, next_harvest or last), s))
+    return [s for _, s in sorted(due, key=lambda d: d[0])]
+
+def round_robin(items, key):
+    '''
+    Interleaves items so consecutive items have different keys where
+    possible, keeping the order of items with the same key
+    '''
+    groups = OrderedDict()
+    for item in items:
+        groups.setdefault(key(item), []).append(item)
+    return [item for row in izip_longest(*groups.values()) for item in row if item is not None]
+
+def plan_harvests(services, priority=False):
+    '''
+    Returns a list of (queue, timeout, service_id, shard, shards) harvest
+    jobs for a list of service documents, round-robin across data providers
+    so no provider's services hold up all others. Long SOS harvests are
+    split into shards of their station list.
+
+    Harvests that failed last time, or all if priority is set (ie. manually
+    triggered), go to the priority queue unless they belong on the long one.
+    '''
+    service_ids = [s['_id'] for s in services]
+    history = harvest_history(service_ids)
+    counts = dataset_counts(service_ids)
+
+    plan = []
+    for s in round_robin(services, lambda s: s.get('data_provider')):
+        durations, failed = history.get(s['_id'], ([], False))
+        max_shards = app.config.get('SOS_HARVEST_MAX_SHARDS', 4) if s.get('service_type') == 'SOS' else 1
+        target, timeout, shards = harvest_plan(durations,
+                                               counts.get(s['_id'], 0),
+                                               max_shards)
+        if target is queue and (priority or failed):
+            target = priority_queue
+
+        if shards == 1:
+            plan.append((target, timeout, s['_id'], None, 1))
+        else:
+            plan.extend((target, timeout, s['_id'], shard, shards) for shard in range(shards))
+    return plan
+
+def enqueue_batch(plan, ignore_active=False, record_counts=True):
+    '''
+    Creates the jobs of a plan and enqueues them in a single Redis pipeline.
+    Services with a harvest already queued or running are skipped. With
+    record_counts, each job reports its completion to the batch counter and
+    the last one queues the metric snapshot.
+    '''
+    batch_id = unicode(uuid.uuid4())
+    entries = []
+    targets = {}
+    # the shards of a service's run share its id
+    runs = {}
+    for target, timeout, service_id, shard, shards in plan:
+        kwargs = {}
+        if record_counts:
+            kwargs['batch_id'] = batch_id
+        if ignore_active:
+            kwargs['ignore_active'] = True
+        if shards > 1:
+            kwargs.update(shard=shard, shards=shards,
+                          run_id=runs.setdefault(service_id, unicode(uuid.uuid4())))
+        job = Job.create(harvest, args=(service_id,), kwargs=kwargs,
+                         connection=redis_connection, status=JobStatus.QUEUED,
+                         timeout=timeout)
+        entries.append(('harvest', harvest_key(service_id, shard, shards), job))
+        targets[job.id] = target
+
+    jobs = [job for _, _, job in reserve(entries)]
+    if not jobs:
+        return None
+
+    pipe = redis_connection.pipeline()
+    if record_counts:
+        pipe.set(BATCH_KEY % batch_id, len(jobs))
+        pipe.expire(BATCH_KEY % batch_id, BATCH_TTL)
+    # the checks these harvests queue are profiled from scratch
+    for service_id in set(job.args[0] for job in jobs):
+        db.Harvest.reset_ccheck_profile(service_id, pipe)
+    push_jobs([(targets[job.id], job) for job in jobs], pipe)
+    pipe.execute()
+
+    app.logger.info("Queued harvest batch %s of %s jobs (%s already queued)",
+                    batch_id, len(jobs), len(plan) - len(jobs))
+    return batch_id
+
+def batch_job_done(batch_id):
+    '''
+    Called by each harvest job of a batch when it finishes. Queues the
+    metric snapshot once the whole batch is done.
+    '''
+    key = BATCH_KEY % batch_id
+    remaining = redis_connection.decr(key)
+    if remaining <= 0:
+        redis_connection.delete(key)
+        # record dataset/service metrics after harvest
+        queue.enqueue(add_counts)
+
+def queue_harvest_tasks():
+    """
+    Generate a number of harvest tasks.
+
+    Meant to be called via cron. Only queues services that are active and
+    due for a harvest.
+    """
+    with app.app_context():
+        services = list(db.services.find({'active': True},
+                                         {'service_type': True, 'data_provider': True,
+                                          'updated': True}))
+        services = due_services(services)
+        if not services:
+            return None
+        record_counts = bool(redis_connection.set(COUNTS_KEY, 1, nx=True, ex=COUNTS_INTERVAL))
+        return enqueue_batch(plan_harvests(services), record_counts=record_counts)
+
+def queue_provider(provider):
+    with app.app_context():
+        services = list(db.services.find({'data_provider': provider, 'active': True},
+                                         {'service_type': True, 'data_provider': True}))
+        return enqueue_batch(plan_harvests(services, priority=True))
+
+def queue_service(service_id, ignore_active=False):
+    '''
+    Queues a manually triggered harvest of a service on the priority queue
+    '''
+    with app.app_context():
+        services = list(db.services.find({'_id': service_id},
+                                         {'service_type': True, 'data_provider': True}))
+        return enqueue_batch(plan_harvests(services, priority=True),
+                             ignore_active=ignore_active, record_counts=False)
@@ -1,15 +1,18 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+from functools import partial
+from multiprocessing.pool import ThreadPool
 from urlparse import urlparse
 import re
+import time
 
 import requests
 import xml.etree.ElementTree as ET
 
-from owslib import fes, csw
-from owslib.util import nspath_eval
-from owslib.namespaces import Namespaces
+from pymongo.errors import BulkWriteError
 
-from ioos_catalog import app,db
+from ioos_catalog import app,db,redis_connection
+from ioos_catalog.tasks.cleanup import service_sets, chunks
+from ioos_catalog.tasks.activation import publish_activation
 import requests
 
 region_map =    {'AOOS'             : '1706F520-2647-4A33-B7BF-592FAFDE4B45',
@@ -44,166 +47,402 @@ opendap_form_schema = 'urn:x-esri:specification:ServiceType:distribution:url'
 
 endpoint = 'http://www.ngdc.noaa.gov/geoportal/csw' # NGDC Geoportal
 
-def reindex_services(filter_regions=None, filter_service_types=None):
-    c = csw.CatalogueServiceWeb(endpoint, timeout=120)
-
-    ns = Namespaces()
-
-    filter_regions = filter_regions or region_map.keys()
-    filter_service_types = filter_service_types or services.keys()
-
-    with app.app_context():
-
-        new_services    = []
-        update_services = []
-
-        # get a set of all non-manual, active services for possible deactivation later
-        current_services = set((s._id for s in db.Service.find({'manual':False, 'active':True, 'data_provider':{'$in':filter_regions}}, {'_id':True})))
-
-        # FIXME: find a more robust mechanism for detecting ERDDAP instances
-        # this would fail if behind a url rewriting/proxying mechanism which
-        # remove the 'erddap' portion from the URL.  May want to have GeoPortal
-        # use a separate 'scheme' dedicated to ERDDAP for CSW record
-        # 'references'
-
-        # workaround for matching ERDDAP endpoints
-        # match griddap or tabledap endpoints with html or graph
-        # discarding any query string parameters (i.e. some datasets on PacIOOS)
-        re_string = r'(^.*erddap/(?:grid|table)dap.*)\.(?:html|graph)(:?\?.*)?$'
-        erddap_re = re.compile(re_string)
-        erddap_all_re = re.compile(r'(^.*erddap/(?:(?:grid|table|)dap|wms).*)'
-                                   r'\.(?:html|graph)(:?\?.*)?$')
-
-        for region,uuid in region_map.iteritems():
-
-            if region not in filter_regions:
-                app.logger.info("Skipping region %s due to filter", region)
+# FIXME: find a more robust mechanism for detecting ERDDAP instances
+# this would fail if behind a url rewriting/proxying mechanism which
+# remove the 'erddap' portion from the URL.  May want to have GeoPortal
+# use a separate 'scheme' dedicated to ERDDAP for CSW record
+# 'references'
+
+# workaround for matching ERDDAP endpoints
+# match griddap or tabledap endpoints with html or graph
+# discarding any query string parameters (i.e. some datasets on PacIOOS)
+erddap_re = re.compile(r'(^.*erddap/(?:grid|table)dap.*)\.(?:html|graph)(:?\?.*)?$')
+
+# result of probing an ERDDAP dataset's ISO 19115 endpoint, '1' or '0'
+ERDDAP_PROBE_KEY = 'ioos_catalog:erddap_probe:%s'
+# start time of the last complete reindex of a region, and of the last full one
+SYNCED_KEY = 'ioos_catalog:reindex:synced:%s'
+FULL_SYNC_KEY = 'ioos_catalog:reindex:full:%s'
+SYNC_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+def erddap_metadata_url(ref_url):
+    """
+    Returns the ISO 19115 metadata url of an ERDDAP dataset page, or None
+    """
+    erddap_match = erddap_re.search(ref_url)
+    if erddap_match:
+        return erddap_match.group(1) + '.iso19115'
+    return None
+
+def probe_url(url):
+    """
+    Returns True if url answers with a 200, None if it can't be reached
+    """
+    try:
+        r = requests.get(url, timeout=app.config.get('ERDDAP_PROBE_TIMEOUT', 10), stream=True)
+        r.close()
+        return r.status_code == 200
+    except requests.RequestException as e:
+        app.logger.warn("Could not probe %s: %s", url, e)
+        return None
+
+def probe_erddap(records, pool):
+    """
+    Returns a dict of ERDDAP metadata url -> whether it is valid for the
+    ERDDAP references of a page of records. Probes run concurrently on
+    pool, and their results are cached for ERDDAP_PROBE_TTL seconds.
+    """
+    urls = set()
+    for name, record in records:
+        for ref in record.references:
+            if ref['scheme'] not in services.values():
+                url = erddap_metadata_url(ref['url'])
+                if url:
+                    urls.add(url)
+    urls = list(urls)
+    if not urls:
+        return {}
+
+    cached = redis_connection.mget([ERDDAP_PROBE_KEY % url for url in urls])
+    probes = {url: c == '1' for url, c in zip(urls, cached) if c is not None}
+
+    missing = [url for url in urls if url not in probes]
+    ttl = app.config.get('ERDDAP_PROBE_TTL', 7 * 24 * 60 * 60)
+    pipe = redis_connection.pipeline()
+    for url, ok in zip(missing, pool.map(probe_url, missing)):
+        probes[url] = bool(ok)
+        # unreachable servers are probed again next time
+        if ok is not None:
+            pipe.setex(ERDDAP_PROBE_KEY % url, '1' if ok else '0', ttl)
+    pipe.execute()
+    return probes
+
+def region_constraints(uuid, since=None):
+    """
+    Returns the CSW constraints selecting a region's records, only the ones
+    modified after since if given
+    """
+    # only the reindex job queries the CSW, the web process doesn't load owslib
+    from owslib import fes
+
+    # Setup uuid filter
+    uuid_filter = fes.PropertyIsEqualTo(propertyname='sys.siteuuid', literal="{%s}" % uuid)
+    if since is None:
+        return [uuid_filter]
+
+    modified_filter = fes.PropertyIsGreaterThan(propertyname=app.config.get('CSW_MODIFIED_PROPERTY', 'apiso:Modified'),
+                                                literal=since.strftime(SYNC_FORMAT))
+    # a nested list is ANDed
+    return [[uuid_filter, modified_filter]]
+
+def sync_plan(region, full=False):
+    """
+    Returns the time to reindex a region's records modified since, or None
+    for a full reindex: when asked, never synced, or the last full one is
+    older than REINDEX_FULL_INTERVAL. Only full reindexes deactivate
+    services, as deleted records don't show up as modified.
+    """
+    synced, full_synced = redis_connection.mget([SYNCED_KEY % region, FULL_SYNC_KEY % region])
+    if full or synced is None or full_synced is None:
+        return None
+
+    now = datetime.utcnow()
+    if now - datetime.strptime(full_synced, SYNC_FORMAT) > timedelta(seconds=app.config.get('REINDEX_FULL_INTERVAL', 7 * 24 * 60 * 60)):
+        return None
+    # records modified during the last run, or by a skewed clock, aren't missed
+    return datetime.strptime(synced, SYNC_FORMAT) - timedelta(seconds=app.config.get('REINDEX_SYNC_OVERLAP', 3600))
+
+def record_sync(region, started, full):
+    pipe = redis_connection.pipeline()
+    pipe.set(SYNCED_KEY % region, started.strftime(SYNC_FORMAT))
+    if full:
+        pipe.set(FULL_SYNC_KEY % region, started.strftime(SYNC_FORMAT))
+    pipe.execute()
+
+def region_pages(c, region, constraints, stats):
+    """
+    Yields the CSW records of a region a page at a time, as lists of
+    (name, record), so only one page is held in memory. Each page is
+    retried up to CSW_PAGE_RETRIES times.
+    """
+    page_size = app.config.get('CSW_PAGE_SIZE', 100)
+    retries   = app.config.get('CSW_PAGE_RETRIES', 3)
+
+    position = 1
+    while True:
+        for attempt in range(retries + 1):
+            try:
+                c.getrecords2(constraints, esn='full', startposition=position, maxrecords=page_size)
+                break
+            except Exception as e:
+                if attempt == retries:
+                    raise
+                app.logger.warn("Retrying page at %s of region %s: %s", position, region, e)
+                stats['retries'] += 1
+                time.sleep(2 ** attempt)
+
+        records = list(c.records.iteritems())
+        stats['pages']   += 1
+        stats['records'] += len(records)
+        yield records
+
+        # CSW reports 0 as the next record after the last page
+        next_record = int(c.results.get('nextrecord') or 0)
+        if not records or next_record <= position or next_record > int(c.results.get('matches') or 0):
+            break
+        position = next_record
+
+def record_services(region, name, record, probes):
+    """
+    Returns the (url, fields) of the services referenced by a CSW record.
+    probes holds the results of probe_erddap.
+    """
+    # @TODO: unfortunately CSW does not provide us with contact info, so
+    # we must request it manually
+    contact_email = ""
+    metadata_url = None
+    url = None
+
+    found = []
+    for ref in record.references:
+        try:
+            # TODO: Use a more robust mechanism for detecting
+            # ERDDAP instances aside from relying on the url
+            erddap_match = erddap_re.search(ref['url'])
+            # We are only interested in the 'services'
+            if (ref["scheme"] in services.values()):
+                metadata_url = next((r['url'] for r in
+                               record.references
+                               if r['scheme'] == 'urn:x-esri:specification:ServiceType:ArcIMS:Metadata:Document'),
+                               None)
+                # strip extension if erddap endpoint
+                url = unicode(ref['url'])
+            elif erddap_match:
+                test_url = erddap_metadata_url(ref['url'])
+                # if we have a valid ERDDAP metadata endpoint,
+                # store it.
+                if probes.get(test_url):
+                    metadata_url = unicode(test_url)
+            # next record if not one of the previously mentioned
+            else:
                 continue
+            # end metadata find block
 
-            app.logger.info("Requesting region %s", region)
-
-            # Setup uuid filter
-            uuid_filter = fes.PropertyIsEqualTo(propertyname='sys.siteuuid', literal="{%s}" % uuid)
-
-            # Make CSW request
-            c.getrecords2([uuid_filter], esn='full', maxrecords=999999)
+            # an ERDDAP reference updates the service found before it
+            if url is None:
+                continue
 
-            for name, record in c.records.iteritems():
+            fields = {
+                'service_id'   : unicode(name),
+                'name'         : unicode(record.title),
+                'service_type' : unicode('DAP' if erddap_match
+                                         else next((k for k,v in services.items() if v == ref["scheme"]))),
+                'interval'     : 3600, # 1 hour
+                'tld'          : unicode(urlparse(url).netloc),
+                'contact'      : unicode(contact_email),
+                'metadata_url' : metadata_url,
+            }
+
+            # grab opendap form url if present
+            if fields['service_type'] == 'DAP':
+                possible_refs = [r['url'] for r in record.references if r['scheme'] == opendap_form_schema]
+                if len(possible_refs):
+                    # this is bad, it can grab any associated
+                    # record from the dataset
+                    fields['extra_url'] = unicode(possible_refs[0])
+
+            found.append((url, fields))
+
+        except Exception as e:
+            app.logger.warn("Could not read service: %s", e)
+
+    return found
+
+def write_services(region, existing, found, stats):
+    """
+    Writes the new and changed services of a page as one unordered bulk
+    upsert. existing is the dict of url -> current service document of the
+    region, kept up to date. Services whose fields didn't change aren't
+    written, so their 'updated' date stays put.
+    """
+    bulk = db.services.initialize_unordered_bulk_op()
+    writes = 0
+    now = datetime.utcnow()
+
+    for url, fields in found:
+        # will run twice if erddap services have
+        # both .html and .graph, but resultant
+        # data should be the same
+        stats['seen'].add(url)
+        current = existing.get(url)
+
+        # if we see the service, this is "Active", unless we've set manual (then we don't touch)
+        if current is None or not current.get('manual'):
+            fields['active'] = True
+
+        update = {'$set': dict(fields, updated=now)}
+        if current is None:
+            stats['new'] += 1
+            # the other fields of a new service get their defaults
+            defaults = dict(db.Service(), manual=False)
+            update['$setOnInsert'] = {k: v for k, v in defaults.iteritems()
+                                      if k not in update['$set'] and k not in ('_id', 'url', 'data_provider')}
+            current = existing[url] = {'url': url, 'manual': False}
+        elif all(current.get(k) == v for k, v in fields.iteritems()):
+            stats['unchanged'] += 1
+            continue
+        else:
+            stats['updated'] += 1
+            if fields.get('active') and not current.get('active'):
+                stats['activated'].append(current['_id'])
+
+        bulk.find({'data_provider': unicode(region), 'url': url}).upsert().update_one(update)
+        current.update(fields)
+        writes += 1
+
+    if writes:
+        try:
+            bulk.execute()
+        except BulkWriteError as e:
+            errors = e.details.get('writeErrors', [])
+            app.logger.warn("Could not save %s services of %s: %s", len(errors), region, errors[:1])
+
+# fields of a service the CSW records determine
+SERVICE_FIELDS = ['url', 'service_id', 'name', 'service_type', 'interval', 'tld',
+                  'contact', 'metadata_url', 'extra_url', 'active', 'manual']
+
+def reindex_region(region, uuid, probe_pool, since=None):
+    """
+    Pages through a region's CSW records, or the ones modified after since,
+    saving the services of each page as it arrives. Returns the region's
+    stats; 'complete' is False if a page could not be fetched.
+
+    Runs in a thread of the region pool, ERDDAP probes run on probe_pool.
+    """
+    stats = {'region': region, 'pages': 0, 'records': 0, 'retries': 0,
+             'new': 0, 'updated': 0, 'unchanged': 0, 'seen': set(), 'activated': [], 'complete': False,
+             'full': since is None, 'started': datetime.utcnow()}
+    start = time.time()
+    app.logger.info("Requesting %s region %s", 'all records of' if since is None else 'records modified since %s of' % since, region)
+
+    try:
+        # the region's services, to diff the records against in memory
+        existing = {s['url']: s for s in db.services.find({'data_provider': unicode(region)},
+                                                           SERVICE_FIELDS)}
+
+        from owslib import csw
+        c = csw.CatalogueServiceWeb(endpoint, timeout=app.config.get('CSW_TIMEOUT', 120))
+        for page in region_pages(c, region, region_constraints(uuid, since), stats):
+            probes = probe_erddap(page, probe_pool)
+            found = []
+            for name, record in page:
                 try:
-                    # @TODO: unfortunately CSW does not provide us with contact info, so
-                    # we must request it manually
-                    contact_email = ""
-                    metadata_url = None
-
-                    for ref in record.references:
-                        try:
-                            # TODO: Use a more robust mechanism for detecting
-                            # ERDDAP instances aside from relying on the url
-                            erddap_match = erddap_re.search(ref['url'])
-                            # We are only interested in the 'services'
-                            if (ref["scheme"] in services.values()):
-                                metadata_url = next((r['url'] for r in
-                                               record.references
-                                               if r['scheme'] == 'urn:x-esri:specification:ServiceType:ArcIMS:Metadata:Document'),
-                                               None)
-                                # strip extension if erddap endpoint
-                                url = unicode(ref['url'])
-                            elif erddap_match:
-                                test_url = (erddap_match.group(1) +
-                                                '.iso19115')
-                                req = requests.get(test_url)
-                                # if we have a valid ERDDAP metadata endpoint,
-                                # store it.
-                                if req.status_code == 200:
-                                    metadata_url = unicode(test_url)
-                            # next record if not one of the previously mentioned
-                            else:
-                                continue
-                            # end metadata find block
-                            s = db.Service.find_one({'data_provider':
-                                                        unicode(region),
-                                                        'url': url})
-                            if s is None:
-                                s               = db.Service()
-                                s.url           = url
-                                s.data_provider = unicode(region)
-                                s.manual        = False
-                                s.active        = True
-
-                                new_services.append(s)
-                            else:
-                                # will run twice if erddap services have
-                                # both .html and .graph, but resultant
-                                # data should be the same
-                                update_services.append(s)
-
-                            s.service_id   = unicode(name)
-                            s.name         = unicode(record.title)
-                            s.service_type = unicode('DAP' if erddap_match
-                                                        else next((k for k,v in services.items() if v == ref["scheme"])))
-                            s.interval     = 3600 # 1 hour
-                            s.tld          = unicode(urlparse(url).netloc)
-                            s.updated      = datetime.utcnow()
-                            s.contact      = unicode(contact_email)
-                            s.metadata_url = metadata_url
-
-                            # grab opendap form url if present
-                            if s.service_type == 'DAP':
-                                possible_refs = [r['url'] for r in record.references if r['scheme'] == opendap_form_schema]
-                                if len(possible_refs):
-                                    # this is bad, it can grab any associated
-                                    # record from the dataset
-                                    s.extra_url = unicode(possible_refs[0])
-
-                            # if we see the service, this is "Active", unless we've set manual (then we don't touch)
-                            if not s.manual:
-                                s.active = True
-
-                            s.save()
-
-                        except Exception as e:
-                            app.logger.warn("Could not save service: %s", e)
-
+                    found.extend(record_services(region, name, record, probes))
                 except Exception as e:
                     app.logger.warn("Could not save region info: %s", e)
+            write_services(region, existing, found, stats)
+        stats['complete'] = True
+    except Exception as e:
+        app.logger.warn("Could not fetch region %s: %s", region, e)
+
+    stats['seconds'] = time.time() - start
+    app.logger.info("Region %s: %s records in %s pages, %.1fs (%.1f records/s)%s",
+                    region, stats['records'], stats['pages'], stats['seconds'],
+                    stats['records'] / stats['seconds'] if stats['seconds'] else 0,
+                    '' if stats['complete'] else ', incomplete')
+    return stats
+
+def reindex_region_task(region_plan, probe_pool):
+    region, uuid, since = region_plan
+    with app.app_context():
+        return reindex_region(region, uuid, probe_pool, since)
+
+def reindex_services(filter_regions=None, filter_service_types=None, full=False):
+    """
+    Reindexes the services of the Geoportal records of each region. Only
+    records modified since the region's last reindex are requested, except
+    every REINDEX_FULL_INTERVAL (or with full) when all are, and the
+    services no longer listed are deactivated.
+    """
+    filter_regions = filter_regions or region_map.keys()
+    filter_service_types = filter_service_types or services.keys()
 
-        # DEACTIVATE KNOWN SERVICES
-        updated_ids = set((s._id for s in update_services))
-        deactivate = list(current_services.difference(updated_ids))
+    regions = []
+    for region,uuid in region_map.iteritems():
+        if region not in filter_regions:
+            app.logger.info("Skipping region %s due to filter", region)
+            continue
+        regions.append((region, uuid, sync_plan(region, full)))
+
+    # regions are fetched concurrently, each thread with its own app context
+    region_pool = ThreadPool(app.config.get('REINDEX_REGION_WORKERS', 4))
+    probe_pool  = ThreadPool(app.config.get('ERDDAP_PROBE_WORKERS', 8))
+    try:
+        region_stats = region_pool.map(partial(reindex_region_task, probe_pool=probe_pool), regions)
+    finally:
+        region_pool.close()
+        probe_pool.close()
 
-        # bulk update (using pymongo syntax)
-        db.services.update({'_id':{'$in':deactivate}},
-                           {'$set':{'active':False,
-                                    'updated':datetime.utcnow()}},
-                           multi=True,
-                           upsert=False)
+    with app.app_context():
 
-        return "New services: %s, updated services: %s, deactivated services: %s" % (len(new_services), len(update_services), len(deactivate))
+        # DEACTIVATE KNOWN SERVICES
+        # the non-manual, active services not seen, only in regions whose
+        # records were all read: a failed page doesn't mean they are gone
+        deactivated = []
+        for r in region_stats:
+            if not r['complete']:
+                continue
+            if not r['full']:
+                record_sync(r['region'], r['started'], False)
+                continue
+            ids = [s['_id'] for s in db.services.find({'data_provider':unicode(r['region']),
+                                                        'manual':False,
+                                                        'active':True,
+                                                        'url':{'$nin':list(r['seen'])}},
+                                                       {'_id':True})]
+            # bulk update (using pymongo syntax)
+            for chunk in chunks(ids):
+                db.services.update({'_id':{'$in':chunk}},
+                                   {'$set':{'active':False,
+                                            'updated':datetime.utcnow()}},
+                                   multi=True,
+                                   upsert=False)
+            deactivated.extend(ids)
+            record_sync(r['region'], r['started'], True)
+
+        # cascade to the datasets and metadata of the services
+        publish_activation(deactivated + [sid for r in region_stats for sid in r['activated']])
+
+        incomplete = [r['region'] for r in region_stats if not r['complete']]
+        return "Full regions: %s, new services: %s, updated services: %s, unchanged services: %s, deactivated services: %s, records: %s, incomplete regions: %s" % (
+            sum(1 for r in region_stats if r['full']),
+            sum(r['new'] for r in region_stats),
+            sum(r['updated'] for r in region_stats),
+            sum(r['unchanged'] for r in region_stats),
+            len(deactivated),
+            sum(r['records'] for r in region_stats),
+            ', '.join(incomplete) or 'none')
 
 def cleanup_datasets():
+    """
+    Deactivates the active datasets without any active service, in one scan
+    of the datasets' service ids and bulk updates
+    """
     with app.app_context():
-        datasets = db.Dataset.find({'active':True})
-        for d in datasets:
-            services = d['services'] # a list of services
-            service_ids = [s['service_id'] for s in services]
-            if not service_ids:
-                app.logger.info('Deactivating %s', d['uid'])
-                d['active'] = False
-                d.save()
-                continue
-
-            # Go through each of the services
-            #
-            # if we don't find at least one service that is active, set
-            # dataset.active to False
-            for service_id in service_ids:
-                related_services = db.Service.find({'_id':service_id})
-                for service in related_services:
-                    if service['active']:
-                        break
-                else: # reached the end of the loop
-                    app.logger.info('Deactivating %s', d['uid'])
-                    d['active'] = False
-                    d.save()
-                    break
-
+        start = time.time()
+        _, active = service_sets()
+
+        scanned = 0
+        deactivate = []
+        for d in db.datasets.find({'active':True}, {'services.service_id':True}):
+            scanned += 1
+            if not any(s['service_id'] in active for s in d.get('services', [])):
+                deactivate.append(d['_id'])
+
+        for ids in chunks(deactivate):
+            app.logger.info('Deactivating %s', ids)
+            db.datasets.update({'_id':{'$in':ids}}, {'$set':{'active':False}}, multi=True)
+
+        message = "Scanned %s active datasets in %.1fs, deactivated %s" % (scanned, time.time() - start, len(deactivate))
+        app.logger.info(message)
+        return message
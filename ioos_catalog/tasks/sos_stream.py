@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+'''
+ioos_catalog/tasks/sos_stream.py
+
+Incremental parsing of (potentially very large) SOS documents.
+
+GetCapabilities and network DescribeSensor responses from servers such as
+NDBC or CO-OPS can be tens of MB. Rather than building a full lxml tree, the
+response is streamed to a temporary file and parsed element by element,
+keeping only what the harvester needs and freeing each subtree after use.
+'''
+
+import hashlib
+import tempfile
+from collections import namedtuple
+from contextlib import contextmanager
+
+import requests
+from lxml import etree
+from owslib import ows
+from owslib.util import extract_time
+
+SOS_NS   = 'http://www.opengis.net/sos/1.0'
+OWS_NS   = 'http://www.opengis.net/ows/1.1'
+GML_NS   = 'http://www.opengis.net/gml'
+SML_NS   = 'http://www.opengis.net/sensorML/1.0.1'
+XLINK_NS = 'http://www.w3.org/1999/xlink'
+
+CHUNK_SIZE = 64 * 1024
+
+FetchedDocument = namedtuple('FetchedDocument', ['file', 'digest', 'size'])
+
+class StreamedOffering(object):
+    '''
+    Lightweight stand-in for an OWSLib SosObservationOffering holding only
+    the attributes used by the harvester.
+    '''
+    __slots__ = ('name', 'procedures', 'begin_position', 'end_position')
+
+    def __init__(self, name, procedures, begin_position, end_position):
+        self.name           = name
+        self.procedures     = procedures
+        self.begin_position = begin_position
+        self.end_position   = end_position
+
+class StreamedCapabilities(object):
+    '''
+    Summary of a SOS 1.0.0 GetCapabilities document: the offerings and, for
+    each operation, its GET endpoint and advertised parameter values.
+    '''
+    def __init__(self):
+        self.offerings  = []
+        self.operations = {}
+
+    def operation_url(self, name, default=None):
+        return self.operations.get(name, {}).get('get') or default
+
+    def parameter_values(self, operation, parameter):
+        return self.operations.get(operation, {}).get('parameters', {}).get(parameter, [])
+
+def capabilities_url(service_url, version='1.0.0'):
+    '''
+    Returns the GetCapabilities request URL for a SOS service URL, keeping
+    any parameters already present on the URL.
+    '''
+    from owslib.swe.observation.sos100 import SosCapabilitiesReader
+    return SosCapabilitiesReader(version=version).capabilities_url(service_url)
+
+@contextmanager
+def fetch_document(url, params=None, timeout=None):
+    '''
+    Streams an HTTP response body into a temporary file, hashing it along
+    the way. Yields a FetchedDocument whose file is positioned at the start.
+
+    OGC servers commonly answer exception reports with a 400, so those
+    bodies are kept for the parser to raise on.
+    '''
+    response = requests.get(url, params=params, timeout=timeout, stream=True)
+    if response.status_code not in (200, 400):
+        response.raise_for_status()
+
+    sha = hashlib.sha1()
+    size = 0
+    with tempfile.TemporaryFile() as fp:
+        for chunk in response.iter_content(CHUNK_SIZE):
+            fp.write(chunk)
+            sha.update(chunk)
+            size += len(chunk)
+        response.close()
+        fp.seek(0)
+        yield FetchedDocument(fp, unicode(sha.hexdigest()), size)
+
+def free(elem):
+    '''
+    Clears a processed element and any already processed siblings before it
+    so the partially built tree does not grow with the document.
+    '''
+    elem.clear()
+    while elem.getprevious() is not None:
+        del elem.getparent()[0]
+
+def iterparse_elements(source, tags):
+    '''
+    Yields each completed element whose tag is in tags. Raises an
+    ows.ExceptionReport if the document is an OWS exception report.
+
+    Callers must not hold on to yielded elements: they are freed as soon as
+    the caller asks for the next one.
+    '''
+    exception_tag = '{%s}ExceptionReport' % OWS_NS
+    root = None
+    for event, elem in etree.iterparse(source, events=('start', 'end')):
+        if root is None:
+            root = elem
+            continue
+        # exception reports are small, let them parse completely
+        if root.tag == exception_tag:
+            continue
+
+        if event == 'end' and elem.tag in tags:
+            yield elem
+            free(elem)
+
+    if root is not None and root.tag == exception_tag:
+        raise ows.ExceptionReport(root)
+
+def parse_capabilities(source):
+    '''
+    Incrementally parses a SOS 1.0.0 GetCapabilities document.
+    '''
+    offering_tag  = '{%s}ObservationOffering' % SOS_NS
+    operation_tag = '{%s}Operation' % OWS_NS
+    href          = '{%s}href' % XLINK_NS
+
+    caps = StreamedCapabilities()
+    for elem in iterparse_elements(source, (offering_tag, operation_tag)):
+        if elem.tag == operation_tag:
+            get = elem.find('{%s}DCP/{%s}HTTP/{%s}Get' % (OWS_NS, OWS_NS, OWS_NS))
+            parameters = {}
+            for param in elem.findall('{%s}Parameter' % OWS_NS):
+                parameters[param.get('name')] = [v.text for v in param.iter('{%s}Value' % OWS_NS) if v.text]
+            caps.operations[elem.get('name')] = {'get'        : get.get(href) if get is not None else None,
+                                                 'parameters' : parameters}
+        else:
+            name = elem.findtext('{%s}name' % GML_NS)
+            procedures = [p.get(href) for p in elem.findall('{%s}procedure' % SOS_NS)]
+            period = '{%s}time/{%s}TimePeriod/{%s}%%s' % (SOS_NS, GML_NS, GML_NS)
+            caps.offerings.append(StreamedOffering(name, procedures,
+                                                   extract_time(elem.find(period % 'beginPosition')),
+                                                   extract_time(elem.find(period % 'endPosition'))))
+    return caps
+
+def network_procedures(source):
+    '''
+    Incrementally parses a network DescribeSensor document, returning the
+    sorted, unique station procedures of its components.
+    '''
+    component_tag = '{%s}component' % SML_NS
+    station_id = ".//{%s}identifier[@name='stationID']/{%s}Term/{%s}value" % (SML_NS, SML_NS, SML_NS)
+
+    procedures = set()
+    for elem in iterparse_elements(source, (component_tag,)):
+        proc = elem.findtext(station_id)
+        if proc:
+            procedures.add(proc.strip())
+    return sorted(procedures)
@@ -1,22 +1,27 @@
 from datetime import datetime
-from ioos_catalog import app, db, queue
+from ioos_catalog import app, db, queue, ping_queue
 from bson import ObjectId
 from ioos_catalog.tasks.send_email import send_service_down_email
+from ioos_catalog.tasks.jobs import lease, LeaseUnavailable, enqueue_unique
 
 def ping_service_task(service_id):
     with app.app_context():
-
-        pl = db.PingLatest.get_for_service(ObjectId(service_id))
-        wasnew, flip = pl.ping_service()
-        pl.save()
-
-        # save to WeeklyArchive
-        if wasnew:
-            utcnow = datetime.utcnow()
-            pa = db.PingArchive.get_for_service(ObjectId(service_id), utcnow)
-            pa.add_ping_data(pl.last_response_time, pl.last_operational_status)
-            pa.updated = utcnow
-            pa.save()
+        try:
+            with lease('ping', ObjectId(service_id)):
+                pl = db.PingLatest.get_for_service(ObjectId(service_id))
+                wasnew, flip = pl.ping_service()
+                pl.save()
+
+                # save to WeeklyArchive
+                if wasnew:
+                    utcnow = datetime.utcnow()
+                    pa = db.PingArchive.get_for_service(ObjectId(service_id), utcnow)
+                    pa.add_ping_data(pl.last_response_time, pl.last_operational_status)
+                    pa.updated = utcnow
+                    pa.save()
+        except LeaseUnavailable:
+            app.logger.info("Ping of %s already running, skipping", service_id)
+            return None
 
         if flip:
             queue.enqueue(send_service_down_email, ObjectId(service_id))
@@ -32,5 +37,5 @@ def queue_ping_tasks():
     with app.app_context():
         sids = [s._id for s in db.Service.find({'active':True}, {'_id':True})]
         for sid in sids:
-            queue.enqueue(ping_service_task, sid)
+            enqueue_unique(ping_queue, 'ping', ping_service_task, sid)
 
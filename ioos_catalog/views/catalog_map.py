@@ -8,12 +8,14 @@ from wtforms import TextField, IntegerField, SelectField
 from bson import json_util
 from collections import defaultdict
 from itertools import chain
+import hashlib
 import re
-import shapely.geometry
 import dateutil.parser
 
 from ioos_catalog import app, db, support_jsonp, requires_auth
 from ioos_catalog.tasks.reindex_services import region_map
+from ioos_catalog.tasks.map_features import (provider_geojson, feature_collection, view_collection,
+                                             ALL_PROVIDERS)
 
 @app.route('/map/', defaults={'filter_provider': 'SECOORA'}, methods=['GET'])
 @app.route('/map/<path:filter_provider>', methods=['GET'])
@@ -45,15 +47,11 @@ def geoj(filter_provider):
         # similar to SQL LIKE -- cannot use index
         vars_regex = re.compile(r".*(?:{}).*".format(vars_str),
                                 re.IGNORECASE) # make case insensitive
-        query_params['services.variables'] = vars_regex
-
-
-    if filter_provider != 'null':
-        query_params['services.data_provider'] = filter_provider
+        query_params['variables'] = vars_regex
 
     asset_type = request.args.get('asset_type')
     if asset_type is not None:
-        query_params['services.service_type'] = asset_type
+        query_params['service_type'] = asset_type
 
     def try_parse_date(dt_str):
         """Try to parse a date string"""
@@ -75,71 +73,39 @@ def geoj(filter_provider):
         # return filter clauses for date query
         filt = {}
         if start is not None:
-            filt['services.time_max'] = {'$gte': start}
+            filt['time_max'] = {'$gte': start}
         if end is not None:
-            filt['services.time_min'] = {'$lte': end}
+            filt['time_min'] = {'$lte': end}
         return filt
 
     query_params.update(get_date_query(start_date, end_date))
-    datasets = list(db.Dataset.find(query_params))
-
-    features = []
-
-    grouped = defaultdict(list)
-    nongrouped = []
-
-    for d in datasets:
-        # FIXME: How should multipoints be handled?
-        # if not d.uid.startswith('urn'):
-        for idx, s in enumerate(d.services):
-            if s.get('geojson', None) is None:
-                continue
-            service = db.Service.find_one({'_id' : s['service_id']})
-            if service is None:
-                app.logger.critical("UNLINKED DATASET: %s", d._id)
-                continue
-            service_name = service['name']
-            feat = {'type':'Feature',
-                    'properties':{'id':str(d._id),
-                                  'sindex': idx,        # service index
-                                  'name': s['name'],
-                                  'service_name': service_name,
-                                  'description':s['description']},
-                    'geometry': s.get('geojson')}
-            features.append(feat)
-
-    #        continue
-
-    #    splits = d.uid.split(':')
-    #    grouped[":".join(splits[0:4])].append(d)
-
-    ## grouped
-    #for g, vals in grouped.iteritems():
-
-    #    coords = []
-
-    #    for v in vals:
-    #        for s in v.services:
-    #            if s.get('geojson', None) is None:
-    #                continue
-
-    #            coords.append(s.get('geojson')['coordinates'])
-
-    #    feat = {'type':'Feature',
-    #            'properties':{'group':g,
-    #                          'name':g,
-    #                          'id':grouped.keys().index(g)},
-    #            'geometry': {
-    #                'type':'MultiPoint',
-    #                'coordinates':coords,
-    #            }}
-
-    #    features.append(feat)
-
-    doc = {'type':'FeatureCollection',
-           'features':features}
-
-    return jsonify(doc)
+
+    # the view of the map: zoom level and west,south,east,north bounds
+    zoom = request.args.get('zoom', type=int)
+    try:
+        bbox = [float(c) for c in request.args['bbox'].split(',')]
+        if len(bbox) != 4:
+            bbox = None
+    except (KeyError, ValueError):
+        bbox = None
+
+    # the unfiltered map of a provider is served from the cache
+    if not query_params and zoom is None and bbox is None:
+        body, etag = provider_geojson(filter_provider)
+    else:
+        if filter_provider != ALL_PROVIDERS:
+            query_params['data_provider'] = filter_provider
+        if zoom is None and bbox is None:
+            body = feature_collection(query_params)
+        else:
+            body = view_collection(query_params, zoom, bbox)
+        etag = hashlib.sha1(body).hexdigest()
+
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    # browsers revalidate, which costs a 304 while the map is unchanged
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 @app.route('/map/details/<ObjectId:dataset_id>/<int:sindex>', methods=['GET'])
 def details(dataset_id, sindex):
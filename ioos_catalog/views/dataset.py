@@ -7,10 +7,11 @@ from flask import render_template, redirect, url_for, request, flash, jsonify, R
 from wtforms import TextField, IntegerField, SelectField
 from bson import json_util
 
-from ioos_catalog import app, db, requires_auth
+from ioos_catalog import app, db, queue, requires_auth
 from ioos_catalog.models.stat import Stat
 from ioos_catalog.tasks.stat import ping_service_task
 from ioos_catalog.tasks.reindex_services import reindex_services
+from ioos_catalog.tasks.map_features import rebuild_features
 
 
 class DatasetFilterForm(Form):
@@ -24,13 +25,13 @@ class DatasetFilterForm(Form):
 @app.route('/datasets/filter/<path:filter_provider>/<filter_type>/', methods=['GET'])
 def datasets(filter_provider, filter_type):
     # only get datasets that are active for this list!
-    service_ids = [s._id for s in db.Service.find({'active':True}, {'_id':1})]
-    filters = {'services.service_id':{'$in':service_ids}}
+    service_filters = {'active':True}
+    filters = {'services':{'$elemMatch':service_filters}}
     titleparts = []
 
     if filter_provider is not None and filter_provider != "none":
         titleparts.append(filter_provider)
-        filters['services.data_provider'] = {'$in': filter_provider.split(',')}
+        service_filters['data_provider'] = {'$in': filter_provider.split(',')}
 
     if filter_type is not None and filter_type != "none":
         titleparts.append(filter_type)
@@ -39,7 +40,7 @@ def datasets(filter_provider, filter_type):
         if filter_type == "(NONE)":
             filter_type = None
 
-        filters['services.asset_type'] = {'$in' : filter_type.split(',')}
+        service_filters['asset_type'] = {'$in' : filter_type.split(',')}
 
     # build title
     titleparts.append("Datasets")
@@ -57,8 +58,7 @@ def datasets(filter_provider, filter_type):
             dataset['name'] = 'None'
     try:
         # find all service ids with an associated active service endpoint
-        assettypes = (db.Dataset.find({'services.service_id':
-                                       {'$in': service_ids}},
+        assettypes = (db.Dataset.find({'services.active': True},
                                       {'services.asset_type': True})
                                       .distinct('services.asset_type'))
     except:
@@ -81,6 +81,8 @@ def show_dataset(dataset_id, oformat):
     for s in dataset.services:
         s['geojson'] = json.dumps(s['geojson'])
         s['metadata'] = {}
+        # the metadata document lives in the blob store, load it on demand
+        s['metadata_value'] = db.MetadataBlob.get_text(s.get('metadata_hash')) or u''
         if metadata_parent:
             s['metadata'] = {m['checker']:m for m in metadata_parent.metadata if m['service_id'] == s['service_id']}
 
@@ -95,5 +97,7 @@ def show_dataset(dataset_id, oformat):
 def removeall():
     dataset = db.Dataset.find()
     for d in dataset:
+        db.MetadataBlob.release_services(d.services)
         d.delete()
+    queue.enqueue(rebuild_features)
     return redirect(url_for('datasets'))
@@ -0,0 +1,15 @@
+from flask import jsonify
+
+from ioos_catalog import app, db, support_jsonp
+
+@app.route('/harvests/profile/', defaults={'filter_provider': None}, methods=['GET'])
+@app.route('/harvests/profile/<path:filter_provider>', methods=['GET'])
+@support_jsonp
+def harvest_profile(filter_provider):
+    '''
+    Where the time of the last harvests went, by data provider and phase
+    '''
+    profiles = db.Harvest.profile_by_provider()
+    if filter_provider is not None:
+        profiles = {filter_provider: profiles.get(filter_provider, {})}
+    return jsonify(profiles)
@@ -21,25 +21,15 @@ class MetadataForm(Form):
                                                           (u'SOS', u'SOS')])
     asset_type    = SelectField(u'Asset Type')
 
-def get_service_ids(filters=None):
-    """
-    Gets a list of service ids to be used with get_metadatas.
-
-    By default will find all active services. If you specify your own filters, this won't occur.
-    """
-    if filters is None:
-        filters = {'active':True}
-
-    services = db.Service.find(filters, {'_id':True})
-    return [s._id for s in services]
-
-def get_metadatas(service_ids, filters=None):
+def get_metadatas(data_provider=None, filters=None):
     """
     Helper method to get metadatas to be transformed/outputted by routed methods below.
 
-    You're required to pass in a list of service ids you want to get metadata for (see get_service_ids).
+    Only the metadata of active services is returned, of data_provider's
+    services if given, using the flags cached on the metadata entries (see
+    tasks.activation).
 
-    Filters are applied to the Metadata query. The filters will always include the passed in list of services.
+    Filters are applied to the Metadata query.
 
     Returns 3-tuple of metadata dicts, columns (random order), and dataset ids.
     """
@@ -47,7 +37,11 @@ def get_metadatas(service_ids, filters=None):
     if filters is None:
         filters = {}
 
-    filters['metadata.service_id'] = {'$in':service_ids}
+    entry_filters = {'active':True}
+    if data_provider is not None:
+        entry_filters['data_provider'] = data_provider
+
+    filters['metadata'] = {'$elemMatch':entry_filters}
     filters['active'] = True
 
     db_metadatas = db.Metadata.find(filters)
@@ -64,9 +58,9 @@ def get_metadatas(service_ids, filters=None):
 
         mdict = dict(m)
         for s in m.metadata:
-            # our query above returns all Metadata top level documents that have ANY matching service_ids
-            # so we need to skip any that aren't in this list
-            if s['service_id'] not in service_ids:
+            # our query above returns all Metadata top level documents that have ANY matching entry
+            # so we need to skip any that don't match
+            if not s.get('active') or (data_provider is not None and s.get('data_provider') != data_provider):
                 continue
             mdict['service_id'] = s['service_id']
 
@@ -125,11 +119,10 @@ def view_metadatas(filter_provider):
     if filter_provider is not None:
         service_filters['data_provider'] = filter_provider
 
-    sids = get_service_ids(service_filters)
-    metadatas, cols, dids = get_metadatas(sids)
+    metadatas, cols, dids = get_metadatas(filter_provider)
 
     # get mappings of services/datasets
-    services = {s._id:s for s in db.Service.find({'_id':{'$in':list(sids)}})}
+    services = {s._id:s for s in db.Service.find(service_filters)}
     #datasets = {d._id:d.name for d in db.Dataset.find({'_id':{'$in':list(dids)}})}
 
     return render_template("metadatas.html",
@@ -165,11 +158,10 @@ def metadatas_csv(filter_provider):
     if filter_provider is not None:
         service_filters['data_provider'] = filter_provider
 
-    sids = get_service_ids(service_filters)
-    metadatas, cols, dids = get_metadatas(sids)
+    metadatas, cols, dids = get_metadatas(filter_provider)
 
     # get mappings of services/datasets
-    #services = {s._id:s for s in db.Service.find({'_id':{'$in':list(sids)}})}
+    #services = {s._id:s for s in db.Service.find(service_filters)}
     #datasets = {d._id:d.name for d in db.Dataset.find({'_id':{'$in':list(dids)}})}
 
     output = StringIO()
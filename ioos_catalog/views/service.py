@@ -11,7 +11,8 @@ from ioos_catalog import app, db, queue, support_jsonp, requires_auth
 from ioos_catalog.models.stat import Stat
 from ioos_catalog.tasks.stat import ping_service_task
 from ioos_catalog.tasks.reindex_services import reindex_services
-from ioos_catalog.tasks.harvest import harvest
+from ioos_catalog.tasks.activation import publish_activation
+from ioos_catalog.tasks.map_features import refresh_service, remove_service
 
 class ServiceForm(Form):
     name               = TextField(u'Name')
@@ -192,7 +193,12 @@ def edit_service_submit(service_id):
 
     url = urlparse.urlparse(service.url)
     service.tld = url.hostname
+    # edited services are harvested at the next scheduler run
+    service.updated = datetime.utcnow()
     service.save()
+    publish_activation([service._id])
+    # the map shows the service names
+    queue.enqueue(refresh_service, service._id)
 
     flash("Service '%s' updated" % service.name, 'success')
     return redirect(url_for('show_service', service_id=service_id))
@@ -202,6 +208,8 @@ def edit_service_submit(service_id):
 def delete_service(service_id):
     service = db.Service.find_one( { '_id' : service_id } )
     service.delete()
+    publish_activation([service_id])
+    remove_service(service_id)
 
     flash("Deleted service %s" % service.name)
     return redirect(url_for('services'))
@@ -216,10 +224,12 @@ def ping_service(service_id):
 @app.route('/services/<ObjectId:service_id>/harvest', methods=['GET'])
 @requires_auth
 def harvest_service(service_id):
-    s = db.Service.find_one({ '_id' : service_id })
-
-    h = harvest(service_id, ignore_active=True)
-    flash(h)
+    # the planner pulls in the harvesters, which the web process doesn't load otherwise
+    from ioos_catalog.tasks.planner import queue_service
+    if queue_service(service_id, ignore_active=True) is None:
+        flash("A harvest of this service is already queued or running")
+    else:
+        flash("Harvest queued")
     return redirect(url_for('show_service', service_id=service_id))
 
 @app.route('/services/<ObjectId:service_id>/start_monitoring', methods=['POST'])
@@ -230,6 +240,7 @@ def start_monitoring_service(service_id):
 
     s.active = True
     s.save()
+    publish_activation([s._id])
 
     flash("Started monitoring the '%s' service" % s.name)
     return redirect(url_for('show_service', service_id=service_id))
@@ -242,6 +253,7 @@ def stop_monitoring_service(service_id):
 
     s.active = False
     s.save()
+    publish_activation([s._id])
 
     flash("Stopped monitoring the '%s' service" % s.name)
     return redirect(url_for('show_service', service_id=service_id))
@@ -254,6 +266,7 @@ def start_harvesting_service(service_id):
 
     s.active = True
     s.save()
+    publish_activation([s._id])
 
     flash("Started harvesting the '%s' service" % s.name)
     return redirect(url_for('show_service', service_id=service_id))
@@ -266,6 +279,7 @@ def stop_harvesting_service(service_id):
 
     s.active = False
     s.save()
+    publish_activation([s._id])
 
     flash("Stopped harvesting the '%s' service" % s.name)
     return redirect(url_for('show_service', service_id=service_id))
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+'''
+ioos_catalog/workers.py
+
+RQ workers. The stock Worker forks a work horse for every job, and the
+horse pays for importing the task modules and warming up connections
+again; for a ping, which takes milliseconds, that is most of the job.
+
+PreloadedWorker runs each job in its own process instead of a horse, and
+WorkerPool runs several of them as long-lived children of a parent that
+imported the app and the harvest libraries once (shared copy-on-write).
+Each child is replaced after WORKER_MAX_TASKS jobs, so leaks in the native
+libraries (netCDF4) don't accumulate.
+
+Both kinds record, per queue, the wall time of their jobs and the part of
+it spent in the job itself; the rest is worker overhead (forking, imports,
+job bookkeeping).
+'''
+
+import errno
+import importlib
+import os
+import random
+import signal
+import time
+
+from rq import Worker, Queue
+from rq.timeouts import UnixSignalDeathPenalty
+
+from ioos_catalog import app, redis_connection
+
+# Redis hash of <mode>:<queue>:<jobs|wall|work> counters
+STATS_KEY = 'ioos_catalog:workers:stats'
+
+# imported by the pool before it forks its workers
+PRELOAD_MODULES = [
+    'ioos_catalog.models',
+    'ioos_catalog.tasks.stat',
+    'ioos_catalog.tasks.harvest',
+    'ioos_catalog.tasks.ccheck',
+    'ioos_catalog.tasks.planner',
+    'ioos_catalog.tasks.reindex_services',
+    'ioos_catalog.tasks.cleanup',
+]
+
+def get_stats():
+    '''
+    Returns a dict of worker mode -> queue -> job count, wall and work
+    seconds, and the average overhead per job
+    '''
+    stats = {}
+    for field, value in redis_connection.hgetall(STATS_KEY).iteritems():
+        mode, queue_name, name = field.rsplit(':', 2)
+        stats.setdefault(mode, {}).setdefault(queue_name, {})[name] = float(value)
+
+    for queues in stats.itervalues():
+        for s in queues.itervalues():
+            jobs = s.get('jobs', 0)
+            s['overhead'] = (s.get('wall', 0) - s.get('work', 0)) / jobs if jobs else None
+    return stats
+
+class TimedDeathPenalty(UnixSignalDeathPenalty):
+    '''
+    Job timeout that also measures how long the job itself ran. It wraps
+    exactly the call of the job's function.
+    '''
+    def __init__(self, timeout):
+        super(TimedDeathPenalty, self).__init__(timeout)
+        self.elapsed = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return super(TimedDeathPenalty, self).__enter__()
+
+    def __exit__(self, type, value, traceback):
+        self.elapsed = time.time() - self.start
+        return super(TimedDeathPenalty, self).__exit__(type, value, traceback)
+
+class StatsWorker(Worker):
+    '''
+    Forking worker recording how much of each job is overhead
+    '''
+    mode = 'fork'
+
+    def death_penalty_class(self, timeout):
+        # called by perform_job for the job it runs; the timeout is kept to
+        # read how long that job ran
+        self.penalty = TimedDeathPenalty(timeout)
+        return self.penalty
+
+    def record(self, job, name, amount):
+        redis_connection.hincrbyfloat(STATS_KEY, '%s:%s:%s' % (self.mode, job.origin, name), amount)
+
+    def execute_job(self, job):
+        start = time.time()
+        super(StatsWorker, self).execute_job(job)
+        self.record(job, 'jobs', 1)
+        self.record(job, 'wall', time.time() - start)
+
+    def perform_job(self, job):
+        # runs in the work horse when forking
+        self.penalty = None
+        try:
+            return super(StatsWorker, self).perform_job(job)
+        finally:
+            if self.penalty is not None and self.penalty.elapsed is not None:
+                self.record(job, 'work', self.penalty.elapsed)
+
+class PreloadedWorker(StatsWorker):
+    '''
+    Worker running jobs in its own process, without a fork per job. Stops
+    after max_tasks jobs.
+    '''
+    mode = 'preload'
+
+    def __init__(self, queues, max_tasks=None, **kwargs):
+        super(PreloadedWorker, self).__init__(queues, **kwargs)
+        self.max_tasks = max_tasks
+        self.tasks = 0
+
+    def execute_job(self, job):
+        start = time.time()
+        self.perform_job(job)
+        self.set_state('idle')
+        self.record(job, 'jobs', 1)
+        self.record(job, 'wall', time.time() - start)
+
+        self.tasks += 1
+        if self.max_tasks and self.tasks >= self.max_tasks:
+            self.log.info('Recycling worker after %s jobs' % self.tasks)
+            # checked by Worker.work before it dequeues the next job
+            self._stop_requested = True
+
+class WorkerPool(object):
+    '''
+    Preloads the task modules and keeps a number of PreloadedWorker
+    processes running, replacing the ones that stop or die.
+    '''
+    def __init__(self, queue_names, processes=None, max_tasks=None):
+        self.queue_names = queue_names
+        self.processes = processes or app.config.get('WORKER_PROCESSES', 4)
+        self.max_tasks = max_tasks or app.config.get('WORKER_MAX_TASKS', 500)
+        self.children = {}  # pid -> start time
+        self.stopping = False
+
+    def preload(self):
+        start = time.time()
+        for name in PRELOAD_MODULES:
+            importlib.import_module(name)
+        app.logger.info("Preloaded task modules in %.2fs", time.time() - start)
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = time.time()
+            return pid
+
+        # child
+        random.seed()
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        status = 1
+        try:
+            queues = [Queue(name, connection=redis_connection) for name in self.queue_names]
+            worker = PreloadedWorker(queues, max_tasks=self.max_tasks,
+                                     connection=redis_connection)
+            worker.work()
+            status = 0
+        finally:
+            os._exit(status)
+
+    def stop(self, signum, frame):
+        self.stopping = True
+        # Ctrl+C reaches the whole process group, a TERM only the pool
+        if signum == signal.SIGTERM:
+            for pid in self.children:
+                try:
+                    os.kill(pid, signum)
+                except OSError as e:
+                    if e.errno != errno.ESRCH:
+                        raise
+
+    def run(self):
+        self.preload()
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+
+        for _ in range(self.processes):
+            self.spawn()
+
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, 0)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            started = self.children.pop(pid, None)
+            if not self.stopping:
+                app.logger.info("Worker %s exited (status %s), starting a new one", pid, status)
+                # don't spin if workers die on startup, ie. Redis is down
+                if started is not None and time.time() - started < 1:
+                    time.sleep(1)
+                self.spawn()
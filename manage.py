@@ -2,10 +2,10 @@ from flask.ext.script import Manager
 
 from rq import Queue
 
-from ioos_catalog import app, db, queue, redis_connection
+from ioos_catalog import app, db, queue, ping_queue, priority_queue, ccheck_queue, long_queue, redis_connection
 
 from ioos_catalog.tasks.stat import queue_ping_tasks
-from ioos_catalog.tasks.harvest import queue_harvest_tasks, queue_large_service_harvest_tasks, queue_provider
+from ioos_catalog.tasks.planner import queue_harvest_tasks, queue_provider
 from ioos_catalog.tasks.reindex_services import reindex_services, cleanup_datasets as cleanup
 from ioos_catalog.tasks.send_email import send_daily_report_email
 from ioos_catalog.tasks.captcha import initialize_captcha_db
@@ -20,10 +20,6 @@ def queue_pings():
 def queue_harvests():
     queue_harvest_tasks()
 
-@manager.command
-def queue_large_service_harvests():
-    queue_large_service_harvest_tasks()
-
 @manager.command
 def queue_provider_harvest(provider):
     queue_provider(provider)
@@ -37,10 +33,31 @@ def empty_failed():
     fqueue = Queue('failed', connection=redis_connection)
     fqueue.empty()
 
+@manager.command
+def queue_status():
+    from ioos_catalog.tasks.ccheck import get_stats as ccheck_stats
+    from ioos_catalog.tasks.jobs import get_stats as job_stats
+    from ioos_catalog.workers import get_stats as worker_stats
+    print "ping queued: %s" % ping_queue.count
+    print "harvest (priority) queued: %s" % priority_queue.count
+    print "harvest (default) queued: %s" % queue.count
+    print "harvest (long) queued: %s" % long_queue.count
+    print "ccheck: %s" % ccheck_stats()
+    print "jobs: %s" % job_stats()
+    for mode, queues in sorted(worker_stats().iteritems()):
+        for name, s in sorted(queues.iteritems()):
+            print "workers (%s) %s: %d jobs, %.1fs work, %.1fs wall, %s overhead/job" % (
+                mode, name, s.get('jobs', 0), s.get('work', 0), s.get('wall', 0),
+                '%.3fs' % s['overhead'] if s['overhead'] is not None else '-')
+
 @manager.command
 def queue_reindex():
     queue.enqueue(reindex_services)
 
+@manager.command
+def queue_full_reindex():
+    queue.enqueue(reindex_services, full=True)
+
 @manager.command
 def queue_daily_status():
     queue.enqueue(send_daily_report_email)
@@ -49,6 +66,11 @@ def queue_daily_status():
 def cleanup_datasets():
     queue.enqueue(cleanup)
 
+@manager.command
+def rebuild_map():
+    from ioos_catalog.tasks.map_features import rebuild_features
+    queue.enqueue(rebuild_features)
+
 @manager.command
 def migrate_140827():
     from ioos_catalog.models.migration.migrate_140827 import migrate
@@ -69,6 +91,41 @@ def migrate_150120():
     from ioos_catalog.models.migration.migrate_150120 import migrate
     queue.enqueue(migrate)
 
+@manager.command
+def migrate_261019():
+    from ioos_catalog.models.migration.migrate_261019 import migrate
+    queue.enqueue(migrate)
+
+@manager.command
+def migrate_261020():
+    from ioos_catalog.models.migration.migrate_261020 import migrate
+    queue.enqueue(migrate)
+
+@manager.command
+def migrate_261021():
+    from ioos_catalog.models.migration.migrate_261021 import migrate
+    queue.enqueue(migrate)
+
+@manager.command
+def ensure_indexes():
+    """
+    Builds the indexes declared on the models, in the background
+    """
+    from ioos_catalog.models.indexes import ensure_indexes
+    for collection, keys in ensure_indexes():
+        print "%s: %s" % (collection, ", ".join("%s %s" % k for k in keys))
+
+@manager.command
+def audit_indexes():
+    """
+    Explains the hot queries and flags the ones scanning a whole collection
+    """
+    from ioos_catalog.models.indexes import audit_indexes
+    results = audit_indexes()
+    for name, collection, scan in results:
+        print "%-9s %s (%s)" % ('COLLSCAN' if scan else 'ok', name, collection)
+    print "%d of %d queries scan a collection" % (sum(1 for r in results if r[2]), len(results))
+
 @manager.command
 def captcha_init():
     initialize_captcha_db()
@@ -78,6 +135,31 @@ def remove_dangle():
     from ioos_catalog.tasks.cleanup import queue_remove_dangle
     queue_remove_dangle()
 
+# harvester dependencies the web process shouldn't load
+HARVEST_MODULES = ['ioos_catalog.tasks.harvest', 'netCDF4', 'pandas', 'paegan',
+                   'compliance_checker', 'wicken', 'pyoos', 'petulantbear', 'shapely', 'owslib']
+
+BENCHMARK_IMPORTS = '''
+import resource, sys, time
+start = time.time()
+from app import app
+elapsed = time.time() - start
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+print "import app:app took %%.2fs, max RSS %%.1f MB" %% (elapsed, rss)
+loaded = [m for m in %r if m in sys.modules]
+print "harvester modules loaded: %%s" %% (", ".join(loaded) or "none")
+'''
+
+@manager.command
+def benchmark_imports():
+    """
+    Measures the import time and memory of the web entry point (app:app)
+    in a fresh interpreter
+    """
+    import subprocess
+    import sys
+    print subprocess.check_output([sys.executable, '-c', BENCHMARK_IMPORTS % HARVEST_MODULES]),
+
 if __name__ == "__main__":
     manager.run()
 
@@ -13,3 +13,7 @@ class FlaskMongoTestCase(unittest.TestCase):
         self.db.drop_collection("services")
         self.db.drop_collection("stats")
         self.db.drop_collection("datasets")
+        self.db.drop_collection("metadata_blobs")
+        self.db.drop_collection("metadatas")
+        self.db.drop_collection("map_features")
+        self.db.drop_collection("harvests")
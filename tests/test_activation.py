@@ -0,0 +1,41 @@
+from ioos_catalog.tasks.activation import apply_activation
+from tests.flask_mongo import FlaskMongoTestCase
+
+class TestActivation(FlaskMongoTestCase):
+
+    def test_cascade(self):
+        on = self.db['services'].insert({'name': u'on', 'active': True})
+        off = self.db['services'].insert({'name': u'off', 'active': True})
+        both = self.db['datasets'].insert({'uid': u'both', 'active': True,
+                                           'services': [{'service_id': on, 'active': True},
+                                                        {'service_id': off, 'active': True}]})
+        only_off = self.db['datasets'].insert({'uid': u'only_off', 'active': True,
+                                               'services': [{'service_id': off, 'active': True}]})
+        metadata = self.db['metadatas'].insert({'ref_id': only_off, 'active': True,
+                                                'metadata': [{'service_id': off, 'checker': u'ioos'},
+                                                             {'service_id': off, 'checker': u'cf'}]})
+
+        self.db['services'].update({'_id': off}, {'$set': {'active': False}})
+        apply_activation([off])
+
+        d = self.db['datasets'].find_one({'_id': both})
+        assert d['active'] is True
+        assert [s['active'] for s in d['services']] == [True, False]
+        assert self.db['datasets'].find_one({'_id': only_off})['active'] is False
+        m = self.db['metadatas'].find_one({'_id': metadata})
+        assert m['active'] is False
+        assert [e['active'] for e in m['metadata']] == [False, False]
+
+        self.db['services'].update({'_id': off}, {'$set': {'active': True}})
+        apply_activation([off])
+        assert self.db['datasets'].find_one({'_id': only_off})['active'] is True
+        assert self.db['metadatas'].find_one({'_id': metadata})['active'] is True
+
+    def test_counts_use_entry_flags(self):
+        from ioos_catalog import app, db
+        self.db['datasets'].insert({'uid': u'a', 'active': True,
+                                    'services': [{'data_provider': u'GLOS', 'asset_type': u'buoy', 'active': True},
+                                                 {'data_provider': u'AOOS', 'asset_type': u'buoy', 'active': False}]})
+        with app.app_context():
+            counts = db.Dataset.count_types_by_provider()
+        assert counts == {u'GLOS': {u'buoy': 1, '_all': 1}}
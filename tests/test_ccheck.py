@@ -0,0 +1,103 @@
+import os
+import shutil
+import tempfile
+from compliance_checker.base import Result
+from netCDF4 import Dataset
+from petulantbear.netcdf2ncml import dataset2ncml
+from ioos_catalog import app, db, ccheck_queue
+from ioos_catalog.tasks.ccheck import (cached_ccheck_and_metadata, ccheck_key, content_digest,
+                                       ccheck_netcdf_task, ccheck_sensorml_task, is_current,
+                                       CHECKER_VERSIONS)
+from ioos_catalog.tasks.harvest import Harvester
+from tests.flask_mongo import FlaskMongoTestCase
+
+class TestCcheckCache(FlaskMongoTestCase):
+
+    def setUp(self):
+        super(TestCcheckCache, self).setUp()
+        self.service_id = self.db['services'].insert({'name': u'Buoys', 'data_provider': u'SECOORA'})
+        self.runs = 0
+
+    def run_checks(self):
+        self.runs += 1
+        return [Result(weight=1, value=(1, 2), name=u'title')], {'Title': u'Buoys'}
+
+    def check(self, ref_id, key):
+        with app.app_context():
+            return cached_ccheck_and_metadata(self.service_id, 'ioos', ref_id, u'dataset', key, self.run_checks)
+
+    def test_cache_hits(self):
+        key = ccheck_key(content_digest(u'<netcdf/>'))
+        first, second = self.db['datasets'].insert({}), self.db['datasets'].insert({})
+
+        assert self.check(first, key) == "Checked"
+        assert self.check(first, key) == "Unchanged"
+        # the same input of another dataset
+        assert self.check(second, key) == "Copied"
+        assert self.runs == 1
+
+        copied = self.db['metadatas'].find_one({'ref_id': second})['metadata'][0]
+        assert copied['cc_score']['pct'] == 0.5
+        assert copied['metamap'] == {'Title': u'Buoys'}
+
+    def test_cache_misses(self):
+        digest = content_digest(u'<netcdf/>')
+        ref_id = self.db['datasets'].insert({})
+
+        assert self.check(ref_id, ccheck_key(digest)) == "Checked"
+        assert self.check(ref_id, ccheck_key(content_digest(u'<netcdf>changed</netcdf>'))) == "Checked"
+        assert self.runs == 2
+
+    def test_checker_upgrade(self):
+        digest = content_digest(u'<netcdf/>')
+        ref_id = self.db['datasets'].insert({})
+        # results of a previous compliance checker release
+        old_key = content_digest(u'compliance-checker 0.0.1, wicken 0.0.1', digest)
+        assert old_key != ccheck_key(digest)
+        assert 'compliance-checker' in CHECKER_VERSIONS
+
+        assert self.check(ref_id, old_key) == "Checked"
+        assert not is_current(self.service_id, 'ioos', ref_id, ccheck_key(digest))
+        assert self.check(self.db['datasets'].insert({}), ccheck_key(digest)) == "Checked"
+        assert self.runs == 2
+
+    def test_checks_routed_to_ccheck_queue(self):
+        ccheck_queue.empty()
+        harvest = Harvester({'_id': self.service_id})
+        ref_id = self.db['datasets'].insert({})
+        digest = content_digest(u'<sml:SensorML/>')
+        try:
+            job = harvest.queue_ccheck(ref_id, digest, ccheck_sensorml_task, u'<sml:SensorML/>')
+            assert job.origin == 'ccheck'
+            assert ccheck_queue.job_ids == [job.id]
+            assert job.args == (self.service_id, ref_id, ccheck_key(digest), u'<sml:SensorML/>')
+            assert harvest.ccheck_misses == 1
+
+            # a current record isn't checked again
+            self.check(ref_id, ccheck_key(digest))
+            assert harvest.queue_ccheck(ref_id, digest, ccheck_sensorml_task, u'<sml:SensorML/>') is None
+            assert harvest.ccheck_hits == 1
+            assert ccheck_queue.count == 1
+        finally:
+            ccheck_queue.empty()
+
+    def test_dap_keyed_on_checked_dataset(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, 'test.nc')
+            nc = Dataset(path, 'w')
+            nc.createDimension('time', 1)
+            nc.createVariable('time', 'f8', ('time',)).units = 'seconds since 1970-01-01'
+            nc.title = 'changed since the harvest'
+            nc.close()
+            nc = Dataset(path)
+            checked = ccheck_key(content_digest(unicode(dataset2ncml(nc, url=path))))
+            nc.close()
+
+            ref_id = self.db['datasets'].insert({})
+            # the digest of what the harvest saw before the change
+            ccheck_netcdf_task(self.service_id, ref_id, ccheck_key(content_digest(u'<netcdf/>')), path)
+            record = self.db['metadatas'].find_one({'ref_id': ref_id})['metadata'][0]
+            assert record['digest'] == checked
+        finally:
+            shutil.rmtree(tmp)
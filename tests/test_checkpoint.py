@@ -0,0 +1,34 @@
+from bson import ObjectId
+from rq.timeouts import JobTimeoutException
+from ioos_catalog.tasks.checkpoint import in_shard
+from ioos_catalog.tasks.harvest import SosHarvest
+import unittest
+
+class TestCheckpoint(unittest.TestCase):
+
+    def test_shards_partition_stations(self):
+        procedures = [u'urn:ioos:station:test:%s' % i for i in range(100)]
+
+        assert all(in_shard(p, None, 1) for p in procedures)
+
+        shards = [[p for p in procedures if in_shard(p, shard, 3)] for shard in range(3)]
+        assert sorted(sum(shards, [])) == sorted(procedures)
+        assert all(shards)
+
+    def test_timed_out_station_is_retried(self):
+        harvest = SosHarvest({'_id': ObjectId()})
+
+        def timeout(uid, offering):
+            raise JobTimeoutException()
+        harvest.process_station = timeout
+        with self.assertRaises(JobTimeoutException):
+            harvest.harvest_station(u'urn:ioos:station:test:1', None, {})
+        assert harvest.checkpoint.outcomes() == {}
+
+        def fail(uid, offering):
+            raise ValueError('bad station')
+        harvest.process_station = fail
+        with self.assertRaises(ValueError):
+            harvest.harvest_station(u'urn:ioos:station:test:1', None, {})
+        assert harvest.checkpoint.outcomes() == {'urn:ioos:station:test:1': 'failed: bad station'}
+        harvest.checkpoint.shard_done(None)
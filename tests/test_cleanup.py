@@ -0,0 +1,32 @@
+from bson import ObjectId
+from ioos_catalog.tasks.cleanup import remove_dangling_datasets
+from ioos_catalog.tasks.reindex_services import cleanup_datasets
+from tests.flask_mongo import FlaskMongoTestCase
+
+class TestCleanup(FlaskMongoTestCase):
+
+    def add_dataset(self, uid, service_ids):
+        return self.db['datasets'].insert({'uid': uid, 'active': True,
+                                           'services': [{'service_id': s} for s in service_ids]})
+
+    def test_remove_dangling_datasets(self):
+        live = self.db['services'].insert({'name': u'live', 'active': True})
+        gone = ObjectId()
+        kept = self.add_dataset(u'kept', [live, gone])
+        dangling = self.add_dataset(u'dangling', [gone])
+
+        remove_dangling_datasets()
+
+        assert [s['service_id'] for s in self.db['datasets'].find_one({'_id': kept})['services']] == [live]
+        assert self.db['datasets'].find_one({'_id': dangling}) is None
+
+    def test_cleanup_datasets(self):
+        active = self.db['services'].insert({'name': u'active', 'active': True})
+        inactive = self.db['services'].insert({'name': u'inactive', 'active': False})
+        mixed = self.add_dataset(u'mixed', [active, inactive])
+        stale = self.add_dataset(u'stale', [inactive])
+
+        cleanup_datasets()
+
+        assert self.db['datasets'].find_one({'_id': mixed})['active'] is True
+        assert self.db['datasets'].find_one({'_id': stale})['active'] is False
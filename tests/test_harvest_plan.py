@@ -0,0 +1,157 @@
+from rq import Queue
+from ioos_catalog import app, queue, long_queue, redis_connection
+from ioos_catalog.tasks import planner
+from ioos_catalog.tasks.harvest import percentile, harvest_plan, harvest_interval, harvest_key
+from ioos_catalog.tasks.jobs import QUEUED_KEY
+from tests.flask_mongo import FlaskMongoTestCase
+import unittest
+
+class TestHarvestPlan(unittest.TestCase):
+
+    def test_percentile(self):
+        assert percentile([], 95) is None
+        assert percentile([10], 95) == 10
+        assert percentile([40, 10, 30, 20], 50) == 25
+        assert percentile(range(101), 95) == 95
+
+    def test_timeout_from_history(self):
+        target, timeout, shards = harvest_plan([100, 110, 120, 300])
+        assert target is queue
+        expected = percentile([100, 110, 120, 300], app.config.get('HARVEST_TIMEOUT_PERCENTILE', 95))
+        assert timeout == int(expected * app.config.get('HARVEST_TIMEOUT_FACTOR', 2))
+        assert shards == 1
+
+    def test_bounds(self):
+        assert harvest_plan([1, 2, 3])[1] == app.config.get('HARVEST_TIMEOUT_MIN', 180)
+        assert harvest_plan([10 ** 6])[1] == app.config.get('HARVEST_TIMEOUT_MAX', 43200)
+
+    def test_long_services(self):
+        threshold = app.config.get('HARVEST_LONG_THRESHOLD', 1800)
+        target, _, shards = harvest_plan([threshold * 2] * 5)
+        assert target is long_queue
+        assert shards == 1
+
+    def test_sharding(self):
+        threshold = app.config.get('HARVEST_LONG_THRESHOLD', 1800)
+        target, timeout, shards = harvest_plan([threshold * 3] * 5, max_shards=4)
+        assert target is queue
+        assert shards == 3
+        assert timeout == int(threshold * app.config.get('HARVEST_TIMEOUT_FACTOR', 2))
+
+        target, _, shards = harvest_plan([threshold * 10] * 5, max_shards=4)
+        assert target is long_queue
+        assert shards == 4
+
+    def test_no_history(self):
+        target, timeout, shards = harvest_plan([], dataset_count=100)
+        assert target is queue
+        assert timeout == 6000
+
+class TestHarvestInterval(unittest.TestCase):
+
+    def test_interval_backs_off(self):
+        min_interval = app.config.get('HARVEST_INTERVAL_MIN', 86400)
+        max_interval = app.config.get('HARVEST_INTERVAL_MAX', 1209600)
+        assert harvest_interval([]) == min_interval
+        assert harvest_interval([True] * 5) == min_interval
+        assert harvest_interval([False]) == min_interval * 2
+        assert harvest_interval([False] * 5) > harvest_interval([True, False, False, False, False])
+        assert harvest_interval([False] * 20) == max_interval
+
+class TestRoundRobin(unittest.TestCase):
+
+    def test_interleaves_providers(self):
+        from ioos_catalog.tasks.planner import round_robin
+        services = [('A', 1), ('A', 2), ('A', 3), ('B', 1), ('C', 1), ('C', 2)]
+        ordered = round_robin(services, lambda s: s[0])
+        assert ordered == [('A', 1), ('B', 1), ('C', 1), ('A', 2), ('C', 2), ('A', 3)]
+
+class CountingConnection(object):
+    '''
+    Wraps the Redis connection, counting the pipelines created through it
+    '''
+    def __init__(self, connection):
+        self.connection = connection
+        self.pipelines = 0
+
+    def pipeline(self, *args, **kwargs):
+        self.pipelines += 1
+        return self.connection.pipeline(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+class TestHarvestBatch(FlaskMongoTestCase):
+
+    def setUp(self):
+        super(TestHarvestBatch, self).setUp()
+        self.queue = Queue('test_harvest_batch', connection=redis_connection)
+        self.queue.empty()
+        self.service_ids = [self.db['services'].insert({'active': True, 'service_type': 'DAP',
+                                                        'data_provider': provider})
+                            for provider in ('A', 'A', 'B')]
+
+    def tearDown(self):
+        self.queue.empty()
+        for service_id in self.service_ids:
+            redis_connection.delete(QUEUED_KEY % ('harvest', harvest_key(service_id)))
+        planner.redis_connection = redis_connection
+        super(TestHarvestBatch, self).tearDown()
+
+    def services(self):
+        return list(self.db['services'].find({'active': True},
+                                             {'service_type': True, 'data_provider': True,
+                                              'updated': True}))
+
+    def test_plan_all_due_services(self):
+        # never harvested, so all of them are due
+        due = planner.due_services(self.services())
+        assert set(s['_id'] for s in due) == set(self.service_ids)
+
+        plan = planner.plan_harvests(due)
+        assert [p[2] for p in plan] == [self.service_ids[0], self.service_ids[2], self.service_ids[1]]
+        assert all(p[0] is queue and p[3] is None and p[4] == 1 for p in plan)
+
+    def test_enqueue_in_one_pipeline(self):
+        plan = [(self.queue, 180, service_id, None, 1) for service_id in self.service_ids]
+        planner.redis_connection = CountingConnection(redis_connection)
+        batch_id = planner.enqueue_batch(plan)
+
+        assert planner.redis_connection.pipelines == 1
+        assert [job.args[0] for job in self.queue.jobs] == self.service_ids
+        assert all(job.kwargs['batch_id'] == batch_id for job in self.queue.jobs)
+        assert int(redis_connection.get(planner.BATCH_KEY % batch_id)) == 3
+        redis_connection.delete(planner.BATCH_KEY % batch_id)
+
+    def test_enqueue_skips_reserved(self):
+        first = [(self.queue, 180, self.service_ids[0], None, 1)]
+        assert planner.enqueue_batch(first, record_counts=False) is not None
+
+        plan = [(self.queue, 180, service_id, None, 1) for service_id in self.service_ids]
+        planner.enqueue_batch(plan, record_counts=False)
+        assert [job.args[0] for job in self.queue.jobs] == self.service_ids
+
+        assert planner.enqueue_batch(plan, record_counts=False) is None
+        assert self.queue.count == 3
+
+    def test_counts_after_last_job(self):
+        def count_jobs():
+            return [job for job in queue.jobs if job.func_name.endswith('add_counts')]
+
+        before = set(job.id for job in count_jobs())
+        batch_id = 'test-batch'
+        redis_connection.set(planner.BATCH_KEY % batch_id, 3)
+        try:
+            planner.batch_job_done(batch_id)
+            planner.batch_job_done(batch_id)
+            assert len(count_jobs()) == len(before)
+
+            planner.batch_job_done(batch_id)
+            added = [job for job in count_jobs() if job.id not in before]
+            assert len(added) == 1
+            assert not redis_connection.exists(planner.BATCH_KEY % batch_id)
+        finally:
+            for job in count_jobs():
+                if job.id not in before:
+                    job.cancel()
+                    job.delete()
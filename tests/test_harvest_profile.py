@@ -0,0 +1,79 @@
+from datetime import datetime
+from ioos_catalog import db, redis_connection
+from tests.flask_mongo import FlaskMongoTestCase
+
+class TestHarvestProfile(FlaskMongoTestCase):
+
+    def test_profile_by_provider_skips_skeletons(self):
+        service_id = self.db['services'].insert({'name': u'Buoys', 'data_provider': u'SECOORA'})
+        # as allmigration_03 leaves them
+        self.db['harvests'].insert({'service_id': service_id,
+                                    'profile': {'date': None, 'total': None, 'shards': None, 'phases': {}}})
+        # as MongoKit creates them, and harvests returning before harvesting leave them
+        self.db['harvests'].insert({'service_id': service_id,
+                                    'profile': {'date': None, 'total': None, 'shards': None, 'phases': None}})
+        self.db['harvests'].insert({'service_id': service_id,
+                                    'profile': {'date': datetime.utcnow(), 'total': 12.5, 'shards': 1,
+                                                'phases': {'parse': {'seconds': 2.5, 'count': 3}}}})
+
+        profiles = db.Harvest.profile_by_provider()
+        assert profiles[u'SECOORA']['services'] == 1
+        assert profiles[u'SECOORA']['seconds'] == 12.5
+        assert profiles[u'SECOORA']['phases'] == {'parse': {'seconds': 2.5, 'count': 3}}
+
+    def test_new_harvest_profile(self):
+        service_id = self.db['services'].insert({'name': u'Buoys', 'data_provider': u'SECOORA'})
+        harvest = db.Harvest()
+        harvest.service_id = service_id
+        harvest.save()
+        assert db.Harvest.profile_by_provider() == {}
+
+    def test_ccheck_time_in_profile(self):
+        service_id = self.db['services'].insert({'name': u'Buoys', 'data_provider': u'SECOORA'})
+        self.db['harvests'].insert({'service_id': service_id,
+                                    'profile': {'date': datetime.utcnow(), 'total': 10.0, 'shards': 1,
+                                                'phases': {'parse': {'seconds': 2.0, 'count': 1}}}})
+        db.Harvest.record_ccheck(service_id, 'compliance_check', 4.0)
+        db.Harvest.record_ccheck(service_id, 'compliance_check', 1.0)
+
+        phases = db.Harvest.profile_by_provider()[u'SECOORA']['phases']
+        assert phases['compliance_check'] == {'seconds': 5.0, 'count': 2}
+        assert phases['parse'] == {'seconds': 2.0, 'count': 1}
+
+        # a new harvest run starts a new ccheck profile
+        pipe = redis_connection.pipeline()
+        db.Harvest.reset_ccheck_profile(service_id, pipe)
+        pipe.execute()
+        assert 'compliance_check' not in db.Harvest.profile_by_provider()[u'SECOORA']['phases']
+
+    def test_sharded_run_saves(self):
+        service_id = self.db['services'].insert({'name': u'Buoys', 'data_provider': u'SECOORA'})
+        harvest = db.Harvest()
+        harvest.service_id = service_id
+        harvest.save()
+
+        # both shards load the document before either saves
+        started = datetime.utcnow()
+        shards = [db.Harvest.find_one({'service_id': service_id}) for _ in range(2)]
+        for shard, successful in zip(shards, [False, True]):
+            shard.new_message(u'shard done', successful)
+            shard.harvest_status = u'harvested'
+            shard.harvest_successful = successful
+            shard.record_profile(3.0, {'parse': {'seconds': 1.0, 'count': 2}}, shards=2)
+            shard.save_run(started, u'run-1')
+
+        saved = self.db['harvests'].find_one({'service_id': service_id})
+        assert len(saved['harvest_messages']) == 2
+        assert len(saved['durations']) == 2
+        # the failed shard decides the run
+        assert saved['harvest_successful'] is False
+        assert saved['profile']['total'] == 6.0
+        assert saved['profile']['phases'] == {'parse': {'seconds': 2.0, 'count': 4}}
+
+        # the next run replaces the profile
+        started = datetime.utcnow()
+        shards[1].record_profile(1.0, {'parse': {'seconds': 0.5, 'count': 1}}, shards=2)
+        shards[1].save_run(started, u'run-2')
+        saved = self.db['harvests'].find_one({'service_id': service_id})
+        assert saved['harvest_successful'] is True
+        assert saved['profile']['total'] == 1.0
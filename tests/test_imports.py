@@ -0,0 +1,16 @@
+import os
+import subprocess
+import sys
+import unittest
+
+from manage import HARVEST_MODULES
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class TestImports(unittest.TestCase):
+
+    def test_web_does_not_load_harvesters(self):
+        # a fresh interpreter, the test run itself imports the harvesters
+        script = 'import sys; from app import app; print [m for m in %r if m in sys.modules]' % HARVEST_MODULES
+        output = subprocess.check_output([sys.executable, '-c', script], cwd=ROOT)
+        assert output.strip().splitlines()[-1] == '[]'
@@ -0,0 +1,32 @@
+from ioos_catalog.models.indexes import (index_keys, declared_indexes, collection_scan,
+                                        ensure_indexes, audit_indexes)
+from tests.flask_mongo import FlaskMongoTestCase
+
+class TestIndexes(FlaskMongoTestCase):
+
+    def test_index_keys(self):
+        assert index_keys('uid') == [('uid', 1)]
+        assert index_keys(['service_id', ('created', -1)]) == [('service_id', 1), ('created', -1)]
+
+    def test_declared_indexes(self):
+        indexes = declared_indexes()
+        assert ('datasets', [('uid', 1)], False) in indexes
+        assert ('datasets', [('services.service_id', 1)], False) in indexes
+        assert ('metadatas', [('metadata.digest', 1)], False) in indexes
+        assert ('harvests', [('service_id', 1)], True) in indexes
+        assert ('services', [('data_provider', 1), ('url', 1)], True) in indexes
+
+    def test_collection_scan(self):
+        # MongoDB 2.x
+        assert collection_scan({'cursor': 'BasicCursor'})
+        assert not collection_scan({'cursor': 'BtreeCursor uid_1'})
+        # MongoDB 3.0 and later
+        fetch = {'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN'}}
+        assert not collection_scan({'queryPlanner': {'winningPlan': fetch}})
+        assert collection_scan({'queryPlanner': {'winningPlan': {'stage': 'SORT',
+                                                                 'inputStage': {'stage': 'COLLSCAN'}}}})
+
+    def test_hot_queries_use_indexes(self):
+        ensure_indexes()
+        scans = [name for name, collection, scan in audit_indexes() if scan]
+        assert scans == []
@@ -0,0 +1,74 @@
+from bson import ObjectId
+from rq import Queue, SimpleWorker
+from ioos_catalog import redis_connection
+from ioos_catalog.tasks.jobs import (lease, enqueue_unique, get_stats, LeaseUnavailable,
+                                     LEASE_KEY, QUEUED_KEY)
+import unittest
+
+def leased_job(service_id):
+    try:
+        with lease('test', service_id):
+            return 'done'
+    except LeaseUnavailable:
+        return 'rejected'
+
+class TestJobs(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = Queue('test_jobs', connection=redis_connection)
+        self.queue.empty()
+        self.service_id = ObjectId()
+
+    def tearDown(self):
+        self.queue.empty()
+        redis_connection.delete(QUEUED_KEY % ('test', self.service_id))
+
+    def work(self):
+        SimpleWorker([self.queue], connection=redis_connection).work(burst=True)
+
+    def test_requests_coalesce(self):
+        coalesced = get_stats()['coalesced']
+        job = enqueue_unique(self.queue, 'test', leased_job, self.service_id)
+        again = enqueue_unique(self.queue, 'test', leased_job, self.service_id)
+
+        assert again.id == job.id
+        assert self.queue.count == 1
+        assert get_stats()['coalesced'] == coalesced + 1
+
+    def test_held_lease_rejects(self):
+        rejected = get_stats()['rejected']
+        job = enqueue_unique(self.queue, 'test', leased_job, self.service_id)
+        # ie. a harvest started from the web interface
+        with lease('test', self.service_id):
+            self.work()
+
+        assert job.result == 'rejected'
+        assert get_stats()['rejected'] == rejected + 1
+
+    def test_requeue_after_job_ran(self):
+        job = enqueue_unique(self.queue, 'test', leased_job, self.service_id)
+        self.work()
+
+        assert job.result == 'done'
+        assert redis_connection.get(QUEUED_KEY % ('test', self.service_id)) is None
+        again = enqueue_unique(self.queue, 'test', leased_job, self.service_id)
+        assert again.id != job.id
+        assert self.queue.count == 1
+
+    def test_shards_share_lease(self):
+        service_id = self.service_id
+        with lease('harvest', service_id, run_id=u'run-1', shard=0):
+            with lease('harvest', service_id, run_id=u'run-1', shard=1):
+                # neither another run nor an unsharded harvest gets in
+                with self.assertRaises(LeaseUnavailable):
+                    with lease('harvest', service_id, run_id=u'run-2', shard=0):
+                        pass
+                with self.assertRaises(LeaseUnavailable):
+                    with lease('harvest', service_id):
+                        pass
+            # still held by shard 0
+            assert redis_connection.get(LEASE_KEY % ('harvest', service_id)) == 'run-1'
+        assert redis_connection.get(LEASE_KEY % ('harvest', service_id)) is None
+
+        with lease('harvest', service_id):
+            pass
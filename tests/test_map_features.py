@@ -0,0 +1,103 @@
+import json
+from ioos_catalog import app
+from ioos_catalog.tasks.map_features import (refresh_features, feature_collection,
+                                             provider_geojson, view_collection, geometry_fields,
+                                             cluster_points, resolution, ALL_PROVIDERS)
+from tests.flask_mongo import FlaskMongoTestCase
+
+class TestMapFeatures(FlaskMongoTestCase):
+
+    def add_dataset(self, uid, service_id, provider):
+        point = {'type': 'Point', 'coordinates': [-80.0, 30.0]}
+        return self.db['datasets'].insert({'uid': uid, 'services': [
+            {'service_id': service_id, 'name': uid, 'description': u'', 'data_provider': provider,
+             'service_type': u'SOS', 'variables': [u'sea_water_temperature'], 'geojson': point},
+            # no location, not on the map
+            {'service_id': service_id, 'name': uid, 'data_provider': provider, 'geojson': None}]})
+
+    def test_refresh_features(self):
+        service_id = self.db['services'].insert({'name': u'Buoys', 'data_provider': u'SECOORA'})
+        dataset_id = self.add_dataset(u'urn:ioos:station:secoora:a', service_id, u'SECOORA')
+
+        assert refresh_features([dataset_id]) == 1
+        doc = json.loads(feature_collection({'data_provider': u'SECOORA'}))
+        assert [f['properties']['service_name'] for f in doc['features']] == [u'Buoys']
+        assert doc['features'][0]['properties']['id'] == str(dataset_id)
+
+        # the entry is gone
+        self.db['datasets'].update({'_id': dataset_id}, {'$set': {'services': []}})
+        assert refresh_features([dataset_id]) == 0
+        assert self.db['map_features'].count() == 0
+
+    def test_provider_geojson_invalidated(self):
+        service_id = self.db['services'].insert({'name': u'Buoys', 'data_provider': u'SECOORA'})
+        refresh_features([self.add_dataset(u'a', service_id, u'SECOORA')])
+        body, etag = provider_geojson(u'SECOORA')
+        assert provider_geojson(u'SECOORA') == (body, etag)
+
+        refresh_features([self.add_dataset(u'b', service_id, u'SECOORA')])
+        body, new_etag = provider_geojson(u'SECOORA')
+        assert new_etag != etag
+        assert len(json.loads(body)['features']) == 2
+        assert len(json.loads(provider_geojson(ALL_PROVIDERS)[0])['features']) == 2
+
+    def test_view_collection(self):
+        service_id = self.db['services'].insert({'name': u'Buoys', 'data_provider': u'SECOORA'})
+        refresh_features([self.add_dataset(u'a', service_id, u'SECOORA'),
+                          self.add_dataset(u'b', service_id, u'SECOORA')])
+
+        # both points in one cluster at a low zoom
+        features = json.loads(view_collection({}, zoom=2))['features']
+        assert [f['properties']['count'] for f in features] == [2]
+        # not clustered when zoomed in
+        assert len(json.loads(view_collection({}, zoom=12))['features']) == 2
+        # outside the box, also across the antimeridian
+        assert json.loads(view_collection({}, zoom=12, bbox=[-70, 20, -60, 40]))['features'] == []
+        assert len(json.loads(view_collection({}, zoom=12, bbox=[170, 20, -70, 40]))['features']) == 2
+
+    def test_view_budget(self):
+        # grid outlines, which have no point coordinates
+        for i in range(10):
+            self.db['map_features'].insert({'data_provider': u'SECOORA', 'point': None, 'simplified': [],
+                                            'west': -80.0 + i, 'south': 30.0, 'east': -79.5 + i, 'north': 30.5,
+                                            'feature': u'{"type": "Feature", "properties": {}, "geometry": null}'})
+        budget = app.config.get('MAP_FEATURE_BUDGET')
+        app.config['MAP_FEATURE_BUDGET'] = 4
+        try:
+            for zoom in (2, 12):
+                features = json.loads(view_collection({}, zoom=zoom))['features']
+                assert len(features) <= 4
+                assert sum(f['properties'].get('count', 1) for f in features) == 10
+        finally:
+            app.config['MAP_FEATURE_BUDGET'] = budget
+        assert len(json.loads(view_collection({}, zoom=12))['features']) == 10
+
+class TestMapResolutions(FlaskMongoTestCase):
+
+    def test_resolution(self):
+        assert resolution(None) is None
+        assert resolution(2) == 0
+        assert resolution(7) == 2
+        assert resolution(12) is None
+
+    def test_geometry_fields(self):
+        # a wiggly line, simplified more at lower zooms
+        coords = [[-80 + i * 0.001, 30 + (i % 2) * 0.0005] for i in range(1000)]
+        feature = {'type': 'Feature', 'properties': {},
+                   'geometry': {'type': 'LineString', 'coordinates': coords}}
+        fields = geometry_fields(feature)
+        assert fields['point'] is None
+        assert (fields['west'], fields['east']) == (-80, coords[-1][0])
+        sizes = [len(json.loads(f)['geometry']['coordinates']) for f in fields['simplified'] if f]
+        assert sizes and sizes == sorted(sizes) and sizes[-1] < len(coords)
+
+        point = {'type': 'Feature', 'properties': {},
+                 'geometry': {'type': 'Point', 'coordinates': [-80.0, 30.0]}}
+        assert geometry_fields(point)['point'] == [-80.0, 30.0]
+
+    def test_cluster_points_budget(self):
+        points = [{'point': [float(x), float(y)], 'feature': u'{}'} for x in range(20) for y in range(20)]
+        assert len(cluster_points(points, 0.5, 1000)) == 400
+        clustered = cluster_points(points, 0.5, 10)
+        assert len(clustered) <= 10
+        assert sum(json.loads(f).get('properties', {}).get('count', 1) for f in clustered) == 400
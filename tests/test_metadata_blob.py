@@ -0,0 +1,42 @@
+from ioos_catalog import app, db
+from tests.flask_mongo import FlaskMongoTestCase
+
+class TestMetadataBlob(FlaskMongoTestCase):
+
+    def test_put_dedupes_and_refcounts(self):
+        with app.app_context():
+            xml = u'<sml:SensorML>\u00b0C</sml:SensorML>'
+            h1 = db.MetadataBlob.put(xml)
+            h2 = db.MetadataBlob.put(xml)
+
+            assert h1 == h2
+            assert self.db['metadata_blobs'].find().count() == 1
+            assert self.db['metadata_blobs'].find_one()['refcount'] == 2
+            assert db.MetadataBlob.get_text(h1) == xml
+
+            db.MetadataBlob.release(h1)
+            assert db.MetadataBlob.get_text(h1) == xml
+            db.MetadataBlob.release(h1)
+            assert self.db['metadata_blobs'].find().count() == 0
+            assert db.MetadataBlob.get_text(h1) is None
+
+    def test_release_services(self):
+        with app.app_context():
+            shared = db.MetadataBlob.put(u'<shared/>')
+            db.MetadataBlob.put(u'<shared/>')
+            db.MetadataBlob.put(u'<shared/>')
+            other = db.MetadataBlob.put(u'<other/>')
+
+            services = [{'metadata_hash': shared}, {'metadata_hash': shared}, {'metadata_hash': other}, {}]
+            assert db.MetadataBlob.release_services(services) == 3
+            assert self.db['metadata_blobs'].find_one({'_id': shared})['refcount'] == 1
+            assert self.db['metadata_blobs'].find_one({'_id': other}) is None
+
+    def test_put_after_removal(self):
+        with app.app_context():
+            digest = db.MetadataBlob.put(u'<sml:SensorML/>')
+            # a release racing the put removed the blob
+            db.MetadataBlob.release(digest)
+            assert db.MetadataBlob.put(u'<sml:SensorML/>') == digest
+            assert self.db['metadata_blobs'].find_one({'_id': digest})['refcount'] == 1
+            assert db.MetadataBlob.get_text(digest) == u'<sml:SensorML/>'
@@ -0,0 +1,84 @@
+from collections import OrderedDict
+from ioos_catalog import app
+from datetime import datetime
+from ioos_catalog.tasks.reindex_services import region_pages, region_constraints, erddap_metadata_url, write_services
+from tests.flask_mongo import FlaskMongoTestCase
+import unittest
+
+class FakeCSW(object):
+    '''
+    Serves a fixed list of records the way CatalogueServiceWeb pages them
+    '''
+    def __init__(self, names, failures=0):
+        self.names = names
+        self.failures = failures
+        self.requests = []
+
+    def getrecords2(self, constraints, esn, startposition, maxrecords):
+        self.requests.append(startposition)
+        if self.failures:
+            self.failures -= 1
+            raise IOError("timed out")
+        page = self.names[startposition - 1:startposition - 1 + maxrecords]
+        self.records = OrderedDict((n, None) for n in page)
+        next_record = startposition + len(page)
+        self.results = {'matches'    : len(self.names),
+                        'returned'   : len(page),
+                        'nextrecord' : next_record if next_record <= len(self.names) else 0}
+
+class TestReindex(unittest.TestCase):
+
+    def stats(self):
+        return {'pages': 0, 'records': 0, 'retries': 0}
+
+    def test_pages(self):
+        names = ['r%s' % i for i in range(250)]
+        c = FakeCSW(names)
+        stats = self.stats()
+        pages = list(region_pages(c, 'AOOS', [], stats))
+        assert [n for page in pages for n, _ in page] == names
+        assert stats['pages'] == len(pages) == len(c.requests)
+        assert stats['records'] == 250
+
+    def test_retries_page(self):
+        c = FakeCSW(['r1', 'r2'], failures=1)
+        stats = self.stats()
+        pages = list(region_pages(c, 'AOOS', [], stats))
+        assert [n for n, _ in pages[0]] == ['r1', 'r2']
+        assert stats['retries'] == 1
+
+    def test_erddap_metadata_url(self):
+        assert erddap_metadata_url('http://host/erddap/tabledap/ds.html') == 'http://host/erddap/tabledap/ds.iso19115'
+        assert erddap_metadata_url('http://host/erddap/griddap/ds.graph?x=1') == 'http://host/erddap/griddap/ds.iso19115'
+        assert erddap_metadata_url('http://host/thredds/dodsC/ds.html') is None
+
+    def test_region_constraints(self):
+        assert len(region_constraints('uuid')) == 1
+        # incremental: the uuid and modified filters ANDed
+        constraints = region_constraints('uuid', datetime(2026, 10, 1))
+        assert len(constraints) == 1 and len(constraints[0]) == 2
+        assert constraints[0][1].literal == '2026-10-01T00:00:00Z'
+
+class TestWriteServices(FlaskMongoTestCase):
+
+    def fields(self, name):
+        return {'service_id': u'rec', 'name': name, 'service_type': u'SOS', 'interval': 3600,
+                'tld': u'host', 'contact': u'', 'metadata_url': None}
+
+    def test_writes_only_changes(self):
+        url = u'http://host/sos'
+        with app.app_context():
+            stats = {'new': 0, 'updated': 0, 'unchanged': 0, 'seen': set()}
+            existing = {}
+            write_services(u'AOOS', existing, [(url, self.fields(u'A'))], stats)
+            created = self.db['services'].find_one({'url': url})
+            assert created['active'] is True and created['manual'] is False
+
+            existing = {s['url']: s for s in self.db['services'].find({'data_provider': u'AOOS'})}
+            write_services(u'AOOS', existing, [(url, self.fields(u'A'))], stats)
+            assert self.db['services'].find_one({'url': url})['updated'] == created['updated']
+
+            write_services(u'AOOS', existing, [(url, self.fields(u'B'))], stats)
+            assert self.db['services'].find_one({'url': url})['name'] == u'B'
+            assert stats['new'] == stats['unchanged'] == stats['updated'] == 1
+            assert self.db['services'].count() == 1
@@ -0,0 +1,21 @@
+from ioos_catalog.tasks.harvest import service_entry_digest
+from bson import ObjectId
+from datetime import datetime
+import unittest
+
+class TestServiceEntryDigest(unittest.TestCase):
+
+    def test_ignores_timestamps(self):
+        entry = {'name'       : u'Station 1',
+                 'service_id' : ObjectId(),
+                 'keywords'   : [u'a', u'b'],
+                 'time_max'   : datetime(2014, 1, 1),
+                 'geojson'    : {'type': 'Point', 'coordinates': [-70.5, 41.2]},
+                 'updated'    : datetime(2014, 1, 1)}
+        digest = service_entry_digest(entry)
+
+        later = dict(entry, updated=datetime.utcnow(), digest=digest)
+        assert service_entry_digest(later) == digest
+
+        changed = dict(entry, time_max=datetime(2014, 1, 2))
+        assert service_entry_digest(changed) != digest
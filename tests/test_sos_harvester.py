@@ -1,7 +1,18 @@
-from ioos_catalog.tasks.harvest import SosHarvest
+from lxml import etree
+from owslib import ows
+from ioos_catalog.tasks.harvest import SosHarvest, DESCRIBE_SENSOR_FORMATS
+from ioos_catalog.tasks.sos_stream import StreamedCapabilities
 from tests.flask_mongo import FlaskMongoTestCase
 import json
 
+EXCEPTION = """<?xml version="1.0" encoding="UTF-8"?>
+<ows:ExceptionReport xmlns:ows="http://www.opengis.net/ows/1.1" version="1.1.0">
+  <ows:Exception exceptionCode="InvalidParameterValue" locator="outputFormat">
+    <ows:ExceptionText>Bad outputFormat</ows:ExceptionText>
+  </ows:Exception>
+</ows:ExceptionReport>
+"""
+
 class TestSosHarvester(FlaskMongoTestCase):
 
     def test_number_of_datasets(self):
@@ -31,4 +42,57 @@ class TestSosHarvester(FlaskMongoTestCase):
                                                                 u'urn:ioos:sensor:us.glos:UMBIO:sea_water_temperature',
                                                                 u'urn:ioos:sensor:us.glos:UMBIO:wind_from_direction',
                                                                 u'urn:ioos:sensor:us.glos:UMBIO:wind_speed',
-                                                                u'urn:ioos:sensor:us.glos:UMBIO:wind_speed_of_gust'])
\ No newline at end of file
+                                                                u'urn:ioos:sensor:us.glos:UMBIO:wind_speed_of_gust'])
+class TestOutputFormat(FlaskMongoTestCase):
+
+    def harvester(self, advertised, accepted, **service):
+        '''
+        Returns a SosHarvest of a server advertising and accepting the given
+        DescribeSensor outputFormats, recording the ones requested
+        '''
+        service_id = self.db['services'].insert(dict(service, url=u'http://example.com/sos', service_type=u'SOS'))
+        harvest = SosHarvest(self.db['services'].find_one({'_id': service_id}))
+        harvest.capabilities = StreamedCapabilities()
+        harvest.capabilities.operations['DescribeSensor'] = {'parameters': {'outputFormat': advertised}}
+        harvest.requested = []
+
+        def describe_sensor(output_format, procedure, **kwargs):
+            harvest.requested.append(output_format)
+            if output_format not in accepted:
+                raise ows.ExceptionReport(etree.fromstring(EXCEPTION))
+            return '<sml:SensorML/>'
+        harvest.describe_sensor = describe_sensor
+        return harvest
+
+    def test_seed_from_capabilities(self):
+        harvest = self.harvester([DESCRIBE_SENSOR_FORMATS[2]], [DESCRIBE_SENSOR_FORMATS[2]])
+        harvest.seed_output_format()
+        assert harvest.output_format == DESCRIBE_SENSOR_FORMATS[2]
+        assert harvest._describe_sensor(u'urn:ioos:station:test:1') == '<sml:SensorML/>'
+        assert harvest.requested == [DESCRIBE_SENSOR_FORMATS[2]]
+
+    def test_seed_from_unknown_spelling(self):
+        spelled = 'text/xml; subtype="sensorML/1.0.1"'
+        harvest = self.harvester([spelled, 'text/html'], [spelled])
+        harvest.seed_output_format()
+        harvest._describe_sensor(u'urn:ioos:station:test:1')
+        assert harvest.requested == [spelled]
+
+    def test_learn_from_fallback(self):
+        harvest = self.harvester([], [DESCRIBE_SENSOR_FORMATS[1]])
+        harvest.seed_output_format()
+        harvest._describe_sensor(u'urn:ioos:station:test:1')
+        assert harvest.requested == DESCRIBE_SENSOR_FORMATS[:2]
+        service = self.db['services'].find_one({'_id': harvest.service['_id']})
+        assert service['describe_sensor_format'] == DESCRIBE_SENSOR_FORMATS[1]
+
+        # the next station goes straight to it
+        harvest.requested = []
+        harvest._describe_sensor(u'urn:ioos:station:test:2')
+        assert harvest.requested == [DESCRIBE_SENSOR_FORMATS[1]]
+
+        # and so does the next harvest
+        harvest = self.harvester([], [DESCRIBE_SENSOR_FORMATS[1]], describe_sensor_format=DESCRIBE_SENSOR_FORMATS[1])
+        harvest.seed_output_format()
+        harvest._describe_sensor(u'urn:ioos:station:test:3')
+        assert harvest.requested == [DESCRIBE_SENSOR_FORMATS[1]]
@@ -0,0 +1,87 @@
+from ioos_catalog.tasks.sos_stream import parse_capabilities, network_procedures
+from owslib import ows
+from StringIO import StringIO
+import unittest
+
+CAPABILITIES = """<?xml version="1.0" encoding="UTF-8"?>
+<sos:Capabilities xmlns:sos="http://www.opengis.net/sos/1.0"
+                  xmlns:ows="http://www.opengis.net/ows/1.1"
+                  xmlns:gml="http://www.opengis.net/gml"
+                  xmlns:xlink="http://www.w3.org/1999/xlink" version="1.0.0">
+  <ows:OperationsMetadata>
+    <ows:Operation name="DescribeSensor">
+      <ows:DCP><ows:HTTP><ows:Get xlink:href="http://example.com/sos/ds"/></ows:HTTP></ows:DCP>
+      <ows:Parameter name="outputFormat">
+        <ows:AllowedValues>
+          <ows:Value>text/xml;subtype="sensorML/1.0.1"</ows:Value>
+        </ows:AllowedValues>
+      </ows:Parameter>
+    </ows:Operation>
+  </ows:OperationsMetadata>
+  <sos:Contents>
+    <sos:ObservationOfferingList>
+      <sos:ObservationOffering gml:id="network-all">
+        <gml:name>urn:ioos:network:test:all</gml:name>
+        <sos:procedure xlink:href="urn:ioos:network:test:all"/>
+      </sos:ObservationOffering>
+      <sos:ObservationOffering gml:id="station-1">
+        <gml:name>urn:ioos:station:test:1</gml:name>
+        <sos:time>
+          <gml:TimePeriod>
+            <gml:beginPosition>2014-01-01T00:00:00Z</gml:beginPosition>
+            <gml:endPosition>2014-02-01T00:00:00Z</gml:endPosition>
+          </gml:TimePeriod>
+        </sos:time>
+        <sos:procedure xlink:href="urn:ioos:station:test:1"/>
+      </sos:ObservationOffering>
+    </sos:ObservationOfferingList>
+  </sos:Contents>
+</sos:Capabilities>
+"""
+
+NETWORK = """<?xml version="1.0" encoding="UTF-8"?>
+<sml:SensorML xmlns:sml="http://www.opengis.net/sensorML/1.0.1">
+  <sml:member><sml:System><sml:components><sml:ComponentList>
+    <sml:component name="1"><sml:System><sml:identification><sml:IdentifierList>
+      <sml:identifier name="stationID"><sml:Term><sml:value>urn:ioos:station:test:2</sml:value></sml:Term></sml:identifier>
+    </sml:IdentifierList></sml:identification></sml:System></sml:component>
+    <sml:component name="2"><sml:System><sml:identification><sml:IdentifierList>
+      <sml:identifier name="stationID"><sml:Term><sml:value>urn:ioos:station:test:1</sml:value></sml:Term></sml:identifier>
+    </sml:IdentifierList></sml:identification></sml:System></sml:component>
+  </sml:ComponentList></sml:components></sml:System></sml:member>
+</sml:SensorML>
+"""
+
+EXCEPTION = """<?xml version="1.0" encoding="UTF-8"?>
+<ows:ExceptionReport xmlns:ows="http://www.opengis.net/ows/1.1" version="1.1.0">
+  <ows:Exception exceptionCode="InvalidParameterValue" locator="outputFormat">
+    <ows:ExceptionText>Bad outputFormat</ows:ExceptionText>
+  </ows:Exception>
+</ows:ExceptionReport>
+"""
+
+class TestSosStream(unittest.TestCase):
+
+    def test_parse_capabilities(self):
+        caps = parse_capabilities(StringIO(CAPABILITIES))
+
+        assert [o.name for o in caps.offerings] == ['urn:ioos:network:test:all',
+                                                    'urn:ioos:station:test:1']
+        station = caps.offerings[1]
+        assert station.procedures == ['urn:ioos:station:test:1']
+        assert station.begin_position.year == 2014
+        assert station.end_position.month == 2
+        assert caps.offerings[0].begin_position is None
+
+        assert caps.operation_url('DescribeSensor') == 'http://example.com/sos/ds'
+        assert caps.operation_url('GetObservation', 'default') == 'default'
+        assert caps.parameter_values('DescribeSensor', 'outputFormat') == ['text/xml;subtype="sensorML/1.0.1"']
+
+    def test_network_procedures(self):
+        procs = network_procedures(StringIO(NETWORK))
+        assert procs == ['urn:ioos:station:test:1', 'urn:ioos:station:test:2']
+
+    def test_exception_report(self):
+        with self.assertRaises(ows.ExceptionReport) as cm:
+            network_procedures(StringIO(EXCEPTION))
+        assert cm.exception.code == 'InvalidParameterValue'
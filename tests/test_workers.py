@@ -0,0 +1,49 @@
+from ioos_catalog import redis_connection
+from ioos_catalog.workers import TimedDeathPenalty, PreloadedWorker, STATS_KEY, get_stats
+from rq import Queue
+import time
+import unittest
+
+def sleep_job():
+    time.sleep(0.1)
+
+class TestWorkers(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = Queue('test_workers', connection=redis_connection)
+        self.queue.empty()
+        self.fields = ['preload:test_workers:%s' % name for name in ('jobs', 'wall', 'work')]
+        redis_connection.hdel(STATS_KEY, *self.fields)
+
+    def tearDown(self):
+        self.queue.empty()
+        redis_connection.hdel(STATS_KEY, *self.fields)
+
+    def test_timed_death_penalty(self):
+        penalty = TimedDeathPenalty(10)
+        with penalty:
+            time.sleep(0.1)
+        assert 0.1 <= penalty.elapsed < 1
+        # each job has its own
+        assert TimedDeathPenalty(10).elapsed is None
+
+    def test_recycle_after_max_tasks(self):
+        for _ in range(3):
+            self.queue.enqueue(sleep_job)
+        worker = PreloadedWorker([self.queue], max_tasks=2, connection=redis_connection)
+        worker.work(burst=True)
+
+        assert worker.tasks == 2
+        assert self.queue.count == 1
+
+    def test_work_and_overhead(self):
+        self.queue.enqueue(sleep_job)
+        self.queue.enqueue(sleep_job)
+        PreloadedWorker([self.queue], connection=redis_connection).work(burst=True)
+
+        stats = get_stats()['preload']['test_workers']
+        assert stats['jobs'] == 2
+        assert 0.2 <= stats['work'] < 2
+        assert stats['wall'] >= stats['work']
+        assert stats['overhead'] == (stats['wall'] - stats['work']) / 2
+        assert 0 <= stats['overhead'] < 1